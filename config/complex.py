@@ -17,7 +17,7 @@ with Fanin():
 # parse json
 Json()
 # generate statistic counts (suitable for graphite)
-Stats(timings={'rails.{controller}.{action}.duration': 'duration'})
+Stats(metrics={'rails.{controller}.{action}.duration': 'duration'})
 # write the data to a rotating log file
 File(filename='mylogs.log', max_size=1000000, compress='gz')
 # decide the destination because on some tags
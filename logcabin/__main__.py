@@ -3,6 +3,7 @@
 import logcabin
 import sys
 import os
+import time
 import json
 import gevent
 import gevent.event
@@ -12,12 +13,17 @@ import logging
 import logging.config
 import signal
 import optparse
-from util import ConfigException
-from configuration import PyConfigLoader
+from configuration import PyConfigLoader, ConfigException
+from metrics import MetricsServer
+from profiler import Profiler
+import trace
 
 class LogCabin(object):
     """Main application object"""
 
+    def __init__(self):
+        self.metrics = None
+
     def setup(self):
         """Application setup"""
         self._setup_args()
@@ -31,6 +37,8 @@ class LogCabin(object):
         self.logger = logging.getLogger('main')
 
     def _setup_config(self):
+        if self.opts.trace:
+            trace.enable()
         # load configuration
         self.config = PyConfigLoader(self.opts.config)
         self.config.configure()
@@ -41,6 +49,14 @@ class LogCabin(object):
         parser.add_option('-v', '--verbose', action='store_true', help='Verbose logging (debug)')
         parser.add_option('-l', '--log', help='Log to the given log file', default='logcabin.log')
         parser.add_option('-c', '--config', help='Configuration file to use', default='config.py')
+        parser.add_option('-t', '--drain-timeout', type='float', default=10.0,
+            help='Seconds allowed on shutdown for queued events to be processed')
+        parser.add_option('-m', '--metrics-port', type='int',
+            help='Serve per-stage metrics over http on this port (on /metrics)')
+        parser.add_option('-p', '--profile-duration', type='float', default=30.0,
+            help='Seconds to profile for, on receiving SIGUSR2')
+        parser.add_option('--trace', action='store_true',
+            help='Trace the latency of events through each stage (reported by Perf)')
         opts, args = parser.parse_args()
 
         # logging configuration
@@ -48,6 +64,7 @@ class LogCabin(object):
         self.logconfig = json.load(file(logging_cfg))
         logpath = os.path.abspath(opts.log)
         self.logconfig['handlers']['file']['filename'] = logpath
+        self.logdir = os.path.dirname(logpath)
 
         if opts.verbose:
             # output to console at DEBUG too
@@ -63,20 +80,99 @@ class LogCabin(object):
         self.shutdown = gevent.event.Event()
         gevent.signal(signal.SIGTERM, self._signal, 'SIGTERM')
         gevent.signal(signal.SIGINT, self._signal, 'SIGINT')
+        self.profiler = None
+        gevent.signal(signal.SIGUSR2, self._profile)
+        self.reloading = False
+        gevent.signal(signal.SIGHUP, self._reload)
 
     def _signal(self, name):
         self.logger.info('%s received, shutting down' % name)
         self.shutdown.set()
 
+    def _reload(self):
+        if self.reloading:
+            self.logger.info('SIGHUP received, already reloading')
+            return
+        self.logger.info('SIGHUP received, reloading configuration')
+        self.reloading = True
+        gevent.spawn(self.reload)
+
+    def reload(self):
+        """Replace the pipeline with one from the reloaded configuration.
+
+        The new pipeline takes over the sockets and state of the old, which has
+        its inputs stopped just before the new pipeline starts. The old
+        pipeline then drains the events already in it, before being stopped.
+
+        If the new pipeline fails to set up or start (eg. a port in use), the
+        old one carries on, with its inputs restarted.
+        """
+        try:
+            config = PyConfigLoader(self.opts.config)
+            try:
+                config.load()
+            except ConfigException as ex:
+                self.logger.error('Reload failed, keeping the current configuration: %s' % ex)
+                return
+
+            old, new = self.pipeline, config.pipeline
+            stopped = False
+            try:
+                new.takeover(old)
+                new.setup(None)
+                old.stop_inputs()
+                stopped = True
+                new.start()
+            except Exception as ex:
+                self.logger.exception('Reload failed, keeping the current pipeline: %s' % ex)
+                # the sockets taken over are given back, before the old
+                # inputs restart on them
+                new.handback(old)
+                if stopped:
+                    old.start_inputs()
+                return
+
+            self.config, self.pipeline = config, new
+            if self.metrics:
+                self.metrics.pipeline = new
+            self.logger.info('Started pipeline: %s' % new)
+
+            old.stop(time.time() + self.opts.drain_timeout)
+            self.logger.info('Stopped previous pipeline')
+        finally:
+            self.reloading = False
+
+    def _profile(self):
+        if self.profiler and self.profiler.running:
+            self.logger.info('SIGUSR2 received, already profiling')
+            return
+        self.logger.info('SIGUSR2 received, profiling for %.1fs' % self.opts.profile_duration)
+        self.profiler = Profiler(self.pipeline)
+        gevent.spawn(self._run_profiler, self.profiler)
+
+    def _run_profiler(self, profiler):
+        profiler.start()
+        try:
+            self.shutdown.wait(self.opts.profile_duration)
+        finally:
+            profiler.stop()
+        profiler.write(self.logdir)
+
     def start(self):
         """Start the pipeline."""
         self.pipeline.start()
         self.logger.info('Started pipeline: %s' % self.pipeline)
+        if self.opts.metrics_port:
+            self.metrics = MetricsServer(self.pipeline, self.opts.metrics_port)
+            self.metrics.start()
 
     def stop(self):
-        """Stop the pipeline."""
+        """Stop the pipeline, inputs first, draining the queued events through
+        the rest of the pipeline."""
         self.logger.info('Stopping pipeline')
-        self.pipeline.stop()
+        self.pipeline.stop(time.time() + self.opts.drain_timeout)
+        if self.metrics:
+            self.metrics.stop()
 
     def run(self):
         """Run the whole application, then wait on termination by signal."""
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+"""Benchmarks of logcabin, emitting the results as JSON so they can be compared
+between versions.
+
+- filters: microbenchmarks of each filter, run directly without greenlets
+- pipelines: end-to-end runs of configuration files, against local stand-in
+  elasticsearch and carbon servers
+- soak: a long run of a pipeline at a steady rate, tracking RSS to catch leaks
+"""
+
+import gc
+import os
+import sys
+import glob
+import json
+import time
+import random
+import logging
+import optparse
+import platform
+import shutil
+import tempfile
+import gevent
+import gevent.monkey
+import gevent.server
+import gevent.socket as socket
+from gevent.pywsgi import WSGIServer
+
+import logcabin
+from event import Event
+from context import DummyContext
+from common import ProcessingStage
+from configuration import PyConfigLoader, ConfigException
+from filters import json as json_filter, mutate, noop, python, regex, stats, syslog, url
+
+SYSLOG = '<174>Nov 30 19:56:13 host01 prog[1234]: log message %d'
+
+def _json_event(n):
+    return Event(data='{"controller": "home", "action": "index", "duration": %d.5, '
+        '"program": "app", "message": "request %d"}' % (n % 100, n))
+
+# name, class, configuration, function creating the nth test event
+FILTERS = [
+    ('Json', json_filter.Json, {}, _json_event),
+    ('Mutate', mutate.Mutate,
+        {'set': {'path': '{controller}/{action}'}, 'rename': {'msg': 'message'}, 'unset': ['duration']},
+        lambda n: Event(controller='home', action='index', message='request %d' % n, duration=n)),
+    ('Noop', noop.Noop, {}, lambda n: Event(n=n)),
+    ('Python', python.Python, {'function': lambda ev: ev.setdefault('double', ev.n * 2)},
+        lambda n: Event(n=n)),
+    ('Regex', regex.Regex, {'regex': r'(?P<timestamp>.+) - (?P<message>.+)'},
+        lambda n: Event(data='2013-01-01 12:00:00 - message %d' % n)),
+    ('Stats', stats.Stats, {'metrics': {'rails.{controller}.{action}.duration': 'duration'}},
+        lambda n: Event(controller='home', action=('index', 'login')[n % 2], duration=n % 100)),
+    ('Syslog', syslog.Syslog, {}, lambda n: Event(data=SYSLOG % n)),
+    ('Url', url.Url, {'field': 'data'}, lambda n: Event(data='/path/to?a=%d&b=x+y&c=1%%2C2' % n)),
+]
+
+def bench_filter(cls, conf, make_event, events=10000, repeat=3):
+    """Benchmark a filter processing events, taking the best of repeat runs.
+
+    Objects are the net number of gc-tracked objects allocated per event, ie.
+    those still referenced once processed (python 2 has no allocation tracer).
+    """
+    with DummyContext():
+        stage = cls(**conf)
+    stage.setup(None)
+
+    best = None
+    for r in xrange(repeat):
+        batch = [make_event(n) for n in xrange(events)]
+        gc.collect()
+        gc.disable()
+        try:
+            allocated = gc.get_count()[0]
+            start = time.time()
+            for event in batch:
+                stage._process(event)
+            elapsed = time.time() - start
+            allocated = gc.get_count()[0] - allocated
+        finally:
+            gc.enable()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, allocated)
+
+    elapsed, allocated = best
+    return {
+        'events': events,
+        'seconds': elapsed,
+        'events_per_second': events / elapsed,
+        'objects_per_event': float(allocated) / events,
+        'errors': stage.stage_metrics.errors,
+    }
+
+def bench_filters(events=10000, repeat=3):
+    results = {}
+    for name, cls, conf, make_event in FILTERS:
+        results[name] = bench_filter(cls, conf, make_event, events, repeat)
+    return results
+
+class StandIns(object):
+    """Local stand-ins for the servers outputs send to, accepting and
+    discarding everything.
+
+    Outputs in UNSERVED have no stand-in, so are skipped in the pipelines run.
+    """
+
+    UNSERVED = ('Mongodb',)
+
+    def __init__(self, elasticsearch=9200, carbon=2004):
+        self.servers = [
+            WSGIServer(('127.0.0.1', elasticsearch), self._elasticsearch, log=None),
+            gevent.server.StreamServer(('127.0.0.1', carbon), self._carbon),
+        ]
+
+    def _elasticsearch(self, environ, start_response):
+        environ['wsgi.input'].read()
+        start_response('201 Created', [('Content-Type', 'application/json')])
+        return ['{"ok": true, "_id": "%d"}' % random.randint(0, 1 << 30)]
+
+    def _carbon(self, sock, address):
+        while sock.recv(65536):
+            pass
+
+    def start(self):
+        for server in self.servers:
+            try:
+                server.start()
+            except socket.error as ex:
+                logging.warn('Stand-in not started on %s: %s' % (server.address, ex))
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+    @classmethod
+    def skip_unserved(cls, pipeline):
+        """Discard the events of the outputs that have no stand-in, rather than
+        have them fail sending each. Returns their paths."""
+        skipped = []
+        for path, s in pipeline.walk():
+            if type(s).__name__ in cls.UNSERVED:
+                s.process = lambda event: None
+                skipped.append(path)
+        return skipped
+
+def _inputs(pipeline):
+    from inputs.input import Input
+    return [s for path, s in pipeline.walk() if isinstance(s, Input)]
+
+def _entry(pipeline):
+    """The first processing stage, which all events received pass through."""
+    for path, s in pipeline.walk():
+        if isinstance(s, ProcessingStage):
+            return s
+
+def _idle(pipeline):
+    for path, s in pipeline.walk():
+        if isinstance(s, ProcessingStage) and not s.fused:
+            metrics = s.stage_metrics
+            if s.input.qsize() or metrics.events_in > metrics.processing.count:
+                return False
+    return True
+
+def _wait_received(stage, sent, quiet=1.0):
+    """Wait until a stage has received sent events, or none have arrived for
+    quiet seconds (as some were lost). Returns the time the last arrived."""
+    metrics = stage.stage_metrics
+    last, arrived = None, time.time()
+    while metrics.events_in < sent:
+        if metrics.events_in != last:
+            last, arrived = metrics.events_in, time.time()
+        elif time.time() - arrived >= quiet:
+            return arrived
+        gevent.sleep(0.01)
+    return time.time()
+
+def _feed(stage, events, start=0):
+    """Send events to an input, as a client would."""
+    from inputs import udp, zeromq, file as fileinput
+    if isinstance(stage, udp.Udp):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for n in xrange(start, start + events):
+            sock.sendto(_json_event(n).data, ('127.0.0.1', stage.port))
+            # pace it, giving the input time to read, so the socket buffer
+            # doesn't overflow
+            if n % 100 == 0:
+                gevent.sleep(0.001)
+        sock.close()
+    elif isinstance(stage, zeromq.Zeromq):
+        import zmq.green as zmq
+        address = stage.sock.getsockopt(zmq.LAST_ENDPOINT).replace('0.0.0.0', '127.0.0.1')
+        sock = stage.ctx.socket(zmq.PUSH)
+        sock.connect(address)
+        for n in xrange(start, start + events):
+            sock.send(_json_event(n).data)
+        sock.close(linger=-1)
+    elif isinstance(stage, fileinput.File):
+        paths = glob.glob(stage.path) or [stage.path]
+        with file(paths[0], 'a') as fout:
+            for n in xrange(start, start + events):
+                print >>fout, '%s - message %d' % (time.strftime('%Y-%m-%d %H:%M:%S'), n)
+
+def _run_pipeline(path, feed, timeout):
+    """Run the pipeline from a configuration file, in a temporary directory,
+    feeding it with feed(pipeline) and waiting for it to drain."""
+    path = os.path.abspath(path)
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        config = PyConfigLoader(path)
+        try:
+            config.configure()
+        except ConfigException as ex:
+            return {'error': str(ex)}
+        pipeline = config.pipeline
+        result = {}
+        skipped = StandIns.skip_unserved(pipeline)
+        if skipped:
+            result['skipped'] = skipped
+        pipeline.start()
+        try:
+            entry = _entry(pipeline)
+            start = end = time.time()
+            feed(pipeline, result)
+            with gevent.Timeout(timeout, False):
+                # the inputs may still be delivering once fed, so time until
+                # all sent have been received, then processed
+                if entry:
+                    end = _wait_received(entry, result['sent'])
+                if not _idle(pipeline):
+                    while not _idle(pipeline):
+                        gevent.sleep(0.01)
+                    end = time.time()
+            elapsed = end - start
+            received = entry.stage_metrics.events_in if entry else 0
+            lost = result['sent'] - received
+            result.update({
+                'received': received,
+                'lost': lost,
+                'seconds': elapsed,
+                'events_per_second': received / elapsed if elapsed > 0 else 0.0,
+                'errors': sum(s.stage_metrics.errors for p, s in pipeline.walk()),
+                'drained': _idle(pipeline),
+            })
+            if lost > 0:
+                # the rate of the events left isn't comparable between runs
+                result['invalid'] = '%d of %d events lost' % (lost, result['sent'])
+                result['events_per_second'] = None
+            return result
+        finally:
+            pipeline.stop(time.time() + 1.0)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+def bench_pipeline(path, events=5000, timeout=60.0):
+    """Benchmark a pipeline end-to-end, splitting events between its inputs."""
+    def feed(pipeline, result):
+        inputs = _inputs(pipeline)
+        result['sent'] = events if inputs else 0
+        feeders = []
+        for n, stage in enumerate(inputs):
+            count = events / len(inputs) + (n < events % len(inputs))
+            feeders.append(gevent.spawn(_feed, stage, count, n * events))
+        gevent.joinall(feeders, raise_error=True)
+    return _run_pipeline(path, feed, timeout)
+
+def bench_pipelines(paths, events=5000, timeout=60.0):
+    standins = StandIns()
+    standins.start()
+    try:
+        results = {}
+        for path in paths:
+            results[os.path.basename(path)] = bench_pipeline(path, events, timeout)
+        return results
+    finally:
+        standins.stop()
+
+def rss():
+    """Resident set size of this process, in kB."""
+    for line in file('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+
+def soak(path, seconds, rate=1000, interval=10.0):
+    """Run a pipeline fed at a steady rate, sampling the RSS every interval."""
+    def feed(pipeline, result):
+        inputs = _inputs(pipeline)
+        if not inputs:
+            raise ValueError('%s has no inputs to feed' % path)
+        samples = result['rss_kb'] = []
+        start = time.time()
+        sent = 0
+        while time.time() - start < seconds:
+            tick = time.time()
+            for stage in inputs:
+                _feed(stage, rate / len(inputs), sent)
+            sent += rate / len(inputs) * len(inputs)
+            if not samples or tick - start >= len(samples) * interval:
+                samples.append((round(tick - start, 1), rss()))
+            gevent.sleep(max(1.0 - (time.time() - tick), 0))
+        samples.append((round(time.time() - start, 1), rss()))
+        result['sent'] = sent
+        result['rss_growth_kb'] = samples[-1][1] - samples[0][1]
+
+    standins = StandIns()
+    standins.start()
+    try:
+        return _run_pipeline(path, feed, 60.0)
+    finally:
+        standins.stop()
+
+def main():
+    gevent.monkey.patch_all()
+    # pipelines are run in a temporary directory, so make any paths relative
+    # to the current directory absolute, for modules imported by them
+    sys.path[:] = [os.path.abspath(p) for p in sys.path]
+    for module in sys.modules.values():
+        if isinstance(getattr(module, '__path__', None), list):
+            module.__path__[:] = [os.path.abspath(p) for p in module.__path__]
+
+    parser = optparse.OptionParser(usage='%prog [options] [config.py...]')
+    parser.add_option('-f', '--filters', action='store_true', help='Benchmark the filters')
+    parser.add_option('-p', '--pipelines', action='store_true',
+        help='Benchmark the pipelines of the configuration files (default: config/*.py)')
+    parser.add_option('-s', '--soak', type='float', metavar='SECONDS',
+        help='Soak test the first configuration file for this long')
+    parser.add_option('-n', '--events', type='int', help='Number of events per benchmark')
+    parser.add_option('-r', '--rate', type='int', default=1000, help='Events/s for the soak test')
+    parser.add_option('-o', '--output', help='Write the results to this file (default: stdout)')
+    parser.add_option('-v', '--verbose', action='store_true', help='Log warnings from the stages')
+    opts, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN if opts.verbose else logging.CRITICAL)
+    if not (opts.filters or opts.pipelines or opts.soak):
+        opts.filters = opts.pipelines = True
+    paths = args or sorted(glob.glob('config/*.py'))
+
+    results = {
+        'logcabin': '.'.join(str(v) for v in logcabin.__version__[:3]),
+        'python': platform.python_version(),
+        'gevent': gevent.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    if opts.filters:
+        results['filters'] = bench_filters(opts.events or 10000)
+    if opts.pipelines:
+        results['pipelines'] = bench_pipelines(paths, opts.events or 5000)
+    if opts.soak:
+        if not paths:
+            parser.error('no configuration file to soak test')
+        results['soak'] = soak(paths[0], opts.soak, opts.rate)
+
+    fout = file(opts.output, 'w') if opts.output else sys.stdout
+    json.dump(results, fout, indent=2, sort_keys=True)
+    print >>fout
+
+if __name__ == '__main__':
+    main()
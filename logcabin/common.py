@@ -1,14 +1,15 @@
 import logging
+import time
 import gevent
-from gevent.queue import JoinableQueue
-import gevent.monkey
-gevent.monkey.patch_thread()
-import threading
+from gevent.queue import Empty, JoinableQueue
 from context import Context, ContextManager
+from util import Batch, StageQueue, put_events, requeue
+from metrics import StageMetrics
+import trace
+from template import Template
 
-# Yuck - workaround python 2.7 bug:
-# http://stackoverflow.com/questions/13193278/understand-python-threading-bug
-threading._DummyThread._Thread__stop = lambda x: 42
+# default time allowed for stages to drain their queues when stopping
+DRAIN_TIMEOUT = 10.0
 
 class Stage(object):
     """Base class for all stages.
@@ -19,13 +20,19 @@ class Stage(object):
 
     def __init__(self, on_error='reject'):
         self.logger = logging.getLogger(type(self).__name__)
-        self.busy = threading.Lock()
         self.on_error = on_error
+        self.stage_metrics = StageMetrics()
+        # path of the stage within the pipeline, eg. Pipeline/Switch/case[1]/Log
+        self.stage_path = type(self).__name__
         self.register()
 
     def __str__(self):
         return type(self).__name__
 
+    def walk(self, path=None):
+        """Yield (path, stage) for this stage and all stages within it."""
+        yield path or self.stage_path, self
+
     def register(self):
         Context.instance.current().add(self)
 
@@ -33,11 +40,30 @@ class Stage(object):
         """Configure the stage"""
         pass
 
+    def takeover(self, old):
+        """Take over the resources (eg. sockets, state) of the matching stage of
+        the pipeline being replaced on a reload, before setup() and start().
+
+        The old stage keeps running until the old pipeline is stopped. Anything
+        it stops doing (eg. periodic flushes) should only stop once this stage
+        is started, so a reload failing to start leaves the old one intact.
+        """
+        pass
+
+    def handback(self, old):
+        """Give back the resources taken over from the old stage, when the
+        reload failed and this stage is stopped or was never started. The old
+        pipeline carries on.
+        """
+        pass
+
     def _error(self, event, reason=None):
+        self.stage_metrics.errors += 1
         if self.on_error == 'tag':
             event.add_tag('error')
             if reason:
                 event['message'] = str(reason)
+            self.stage_metrics.events_out += 1
             self.output.put(event)
         else:
             # otherwise ignore
@@ -53,16 +79,31 @@ class Stage(object):
     def start(self):
         raise NotImplementedError
 
-    def stop(self):
+    def stop(self, deadline=None):
         raise NotImplementedError
 
 
 class SpawnedStage(Stage):
-    """A stage that is spawned into a separate greenlet, and _run called"""
+    """A stage that is spawned into a separate greenlet, and _run called
+
+    Common parameters to spawned stages:
+    :param integer max_queue: maximum number of events queued on the input of the stage (default: unbounded)
+    :param string overflow: behaviour when the input queue is full, one of
+      'block', 'drop_newest', 'drop_oldest' or 'drop_tagged' (default: block)
+    :param list overflow_tags: tags of events to drop with 'drop_tagged' (optional)
+    """
+
+    def __init__(self, max_queue=None, overflow='block', overflow_tags=(), **kwargs):
+        if overflow not in StageQueue.OVERFLOW:
+            raise ValueError('overflow should be one of: %s' % ', '.join(StageQueue.OVERFLOW))
+        super(SpawnedStage, self).__init__(**kwargs)
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.overflow_tags = overflow_tags
 
     def setup(self, q):
         self.output = q
-        self.input = JoinableQueue()
+        self.input = StageQueue(self.max_queue, self.overflow, self.overflow_tags)
         return self.input
 
     def start(self):
@@ -73,33 +114,305 @@ class SpawnedStage(Stage):
     def _run(self):
         pass
 
-    def stop(self):
-        """Stop the stage from running."""
-        # if necessary, avoid to more gracefully handle termination in the stage
-        with self.busy:
-            self.g.kill()
-            self.g.join()
+    def stop(self, deadline=None):
+        """Stop the stage from running, once the events already queued have
+        been processed, or the deadline (a time.time()) has passed.
+
+        Stages should be stopped in order, from the inputs onwards, so each
+        drains into the next before it in turn is stopped.
+        """
+        if deadline is None:
+            deadline = time.time() + DRAIN_TIMEOUT
+        with gevent.Timeout(max(deadline - time.time(), 0), False):
+            self.input.join()
+        if self.input.unfinished_tasks:
+            self.logger.warn('Stopping with %d items unprocessed' % self.input.unfinished_tasks)
+
+        self.g.kill()
+        self.g.join()
+        self.input.close()
         self.logger.debug('Stopped')
 
 class ProcessingStage(SpawnedStage):
-    """A spawned stage, that processes events one by one in process()"""
+    """A spawned stage, that processes events one by one in process(), or in
+    batches in process_batch().
+
+    Common parameters to processing stages (filters and outputs):
+    :param integer batch_size: maximum number of events handed to a single
+      process_batch() call (default: 1, events are processed one by one)
+    :param float batch_timeout: maximum time in seconds to wait for a batch to
+      fill, once the first event has arrived (default: 0, take only the events
+      already queued)
+    :param boolean fuse: allow the stage to be fused with its neighbours in a
+      sequence (default: true)
+    :param integer concurrency: number of greenlets consuming from the input
+      queue, so I/O bound stages can have several requests in flight (default:
+      1). Events are then no longer passed on strictly in order.
+    :param string partition_key: with concurrency, send each event to a
+      consumer by the hash of this format string (eg. '{host}'), so events with
+      the same key are still processed in order (optional)
+    """
+
+    # whether the stage can be fused, ie. run directly in the greenlet of the
+    # preceding stage in a sequence, instead of its own (see Sequence.setup).
+    # Only for stages without periodic or I/O behaviour of their own.
+    fusable = False
+
+    # items buffered for each partition's consumer
+    PARTITION_BUFFER = 100
+
+    def __init__(self, batch_size=1, batch_timeout=0.0, fuse=True, concurrency=1,
+            partition_key=None, **kwargs):
+        if concurrency < 1:
+            raise ValueError('concurrency should be at least 1')
+        super(ProcessingStage, self).__init__(**kwargs)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.fuse = fuse
+        self.fused = False
+        self.concurrency = concurrency
+        self.partition_key = partition_key
+        self.partition_template = Template(partition_key) if partition_key else None
+        self.partitions = []
+        self.consumers = []
+        # set once stopping, so consumers finishing an event take no more
+        self.stopping = False
+
+    def can_fuse(self):
+        return self.fusable and self.fuse and self.concurrency == 1
+
+    def start(self):
+        # fused stages are run by their predecessor
+        if self.fused:
+            return
+        self.stopping = False
+        if self.concurrency > 1 and self.partition_key:
+            self.partitions = [JoinableQueue(self.PARTITION_BUFFER)
+                for n in xrange(self.concurrency)]
+            self.consumers = [gevent.spawn(self._consume, q) for q in self.partitions]
+            self.g = gevent.spawn(self._dispatch)
+        else:
+            self.consumers = [gevent.spawn(self._consume, self.input)
+                for n in xrange(self.concurrency - 1)]
+            super(ProcessingStage, self).start()
+
+    def stop(self, deadline=None):
+        if self.fused:
+            return
+        if deadline is None:
+            deadline = time.time() + DRAIN_TIMEOUT
+        with gevent.Timeout(max(deadline - time.time(), 0), False):
+            self.input.join()
+            for q in self.partitions:
+                q.join()
+        if self.input.unfinished_tasks:
+            self.logger.warn('Stopping with %d items unprocessed' % self.input.unfinished_tasks)
+
+        self.stopping = True
+        self._halt()
+        self.input.close()
+        self.logger.debug('Stopped')
+
+    def _halt(self):
+        """Kill the greenlets consuming the input. Events they are part way
+        through processing are put back onto the input, along with those
+        buffered for the partitions, ahead of the rest, so none are lost when
+        the input is closed (eg. spooled to disk).
+        """
+        gevent.killall([self.g] + self.consumers, block=True)
+        for q in self.partitions:
+            while q.qsize():
+                # the partitions' items were taken from the input first
+                requeue(self.input, q.queue.pop(), 0)
 
     def _run(self):
+        self._consume(self.input)
+
+    def _consume(self, q):
+        if self.batch_size > 1:
+            return self._consume_batches(q)
+
+        while not self.stopping:
+            event = q.get()
+            try:
+                if isinstance(event, Batch):
+                    self._process_batch(event)
+                else:
+                    self._process(event)
+            except gevent.GreenletExit:
+                requeue(q, event)
+                raise
+            # marking done once processed lets stop() wait on the queue
+            q.task_done()
+
+    def _consume_batches(self, q):
+        while not self.stopping:
+            events, items = self._get_batch(q)
+            try:
+                self._process_batch(events)
+            except gevent.GreenletExit:
+                requeue(q, events, items)
+                raise
+            self._task_done(items, q)
+
+    def _dispatch(self):
+        """Pass events from the input onto the consumer of their partition."""
+        n = len(self.partitions)
+        while not self.stopping:
+            item = self.input.get()
+            if isinstance(item, Batch):
+                batches = {}
+                for event in item:
+                    batches.setdefault(hash(self.partition_template(event)) % n, Batch()).append(event)
+                parts = batches.items()
+            else:
+                parts = [(hash(self.partition_template(item)) % n, item)]
+            try:
+                while parts:
+                    i, part = parts[-1]
+                    self.partitions[i].put(part)
+                    parts.pop()
+            except gevent.GreenletExit:
+                # stopped while a partition was full, so put back the events
+                # not yet passed on
+                if isinstance(item, Batch):
+                    item = Batch(ev for i, batch in parts for ev in batch)
+                requeue(self.input, item)
+                raise
+            self.input.task_done()
+
+    def _task_done(self, items, q=None):
+        q = q if q is not None else self.input
+        for n in xrange(items):
+            q.task_done()
+
+    def _get_batch(self, q=None):
+        """Wait for the next event, then drain up to batch_size events from the
+        queue (by default the input), waiting at most batch_timeout for them to
+        arrive.
+
+        Returns the events, and the number of queue items they came from.
+        """
+        q = q if q is not None else self.input
+        events = Batch()
+        item = q.get()
+        items = 1
+        deadline = time.time() + self.batch_timeout
         while True:
-            event = self.input.get()
+            if isinstance(item, Batch):
+                events.extend(item)
+            else:
+                events.append(item)
+            if len(events) >= self.batch_size:
+                break
+
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = q.get(timeout=timeout)
+                else:
+                    item = q.get_nowait()
+            except Empty:
+                break
+            except gevent.GreenletExit:
+                # stopped while waiting for the batch to fill
+                requeue(q, events, items)
+                raise
+            items += 1
+        return events, items
+
+    def _process(self, event):
+        metrics = self.stage_metrics
+        metrics.events_in += 1
+        start = time.time()
+        dequeued = trace.now() if trace.enabled else None
+        try:
+            ret = self.process(event)
+        except Exception as ex:
+            self._done((event,), start, dequeued)
+            self._error(event, ex)
+            return
+        self._done((event,), start, dequeued)
 
-            # block exit whilst processing an event
-            with self.busy:
-                try:
-                    ret = self.process(event)
-                    if ret is not False and self.output:
-                        self.output.put(event)
-                except Exception as ex:
-                    self._error(event, ex)
+        if ret is not False and self.output is not None:
+            metrics.events_out += 1
+            try:
+                self.output.put(event)
+            except Exception as ex:
+                self._error(event, ex)
+
+    def _process_batch(self, events):
+        metrics = self.stage_metrics
+        metrics.events_in += len(events)
+        start = time.time()
+        dequeued = trace.now() if trace.enabled else None
+        try:
+            passed = self.process_batch(events)
+        except Exception as ex:
+            self._done(events, start, dequeued)
+            for event in events:
+                self._error(event, ex)
+            return
+        self._done(events, start, dequeued)
+
+        if passed and self.output is not None:
+            metrics.events_out += len(passed)
+            put_events(self.output, passed)
+
+    def _done(self, events, start, dequeued):
+        """Account for the processing of events, before they are passed on."""
+        if events:
+            self.stage_metrics.processing.observe((time.time() - start) / len(events), len(events))
+        if dequeued is not None:
+            trace.record(events, self.stage_path, dequeued, trace.now())
 
     def process(self, event):
         pass
 
+    def process_batch(self, events):
+        """Process a list of events, returning the list of events to pass on.
+
+        By default this calls process() for each event in turn, so only stages
+        that can handle a batch more efficiently (eg. bulk inserts) need to
+        override it.
+        """
+        passed = Batch()
+        for event in events:
+            try:
+                if self.process(event) is not False:
+                    passed.append(event)
+            except Exception as ex:
+                self._error(event, ex)
+        return passed
+
+class DirectQueue(object):
+    """Queue-like object that processes events put onto it directly in a
+    stage, in the caller's greenlet, rather than queueing them."""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def put(self, event):
+        if isinstance(event, Batch):
+            self.stage._process_batch(event)
+        else:
+            self.stage._process(event)
+
+    def put_batch(self, events):
+        self.stage._process_batch(events)
+
+    def qsize(self):
+        return 0
+
+    def full(self):
+        return False
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
 class MultiStage(Stage, ContextManager):
     """Base class for stages with children"""
 
@@ -115,16 +428,49 @@ class MultiStage(Stage, ContextManager):
         """Add this stage to the list"""
         self.stages.append(stage)
 
+    def named_stages(self):
+        """The child stages, named by type, and numbered where a type is
+        repeated."""
+        types = [type(s).__name__ for s in self.stages]
+        seen = {}
+        names = []
+        for name in types:
+            if types.count(name) > 1:
+                seen[name] = seen.get(name, -1) + 1
+                name = '%s[%d]' % (name, seen[name])
+            names.append(name)
+        return zip(names, self.stages)
+
+    def walk(self, path=None):
+        path = path or self.stage_path
+        yield path, self
+        for name, s in self.named_stages():
+            for child in s.walk('%s/%s' % (path, name)):
+                yield child
+
     def start(self):
-        """Spawn the greenlets for all the inputs, filters and outputs."""
-        for s in self.stages:
-            self.logger.debug('Starting %s' % s)
-            s.start()
-            self.logger.debug('Started %s' % s)
+        """Spawn the greenlets for all the inputs, filters and outputs.
+
+        If a stage fails to start, those already started are stopped again.
+        """
+        started = []
+        try:
+            for s in self.stages:
+                self.logger.debug('Starting %s' % s)
+                s.start()
+                started.append(s)
+                self.logger.debug('Started %s' % s)
+        except Exception:
+            deadline = time.time()
+            for s in started:
+                s.stop(deadline)
+            raise
 
-    def stop(self):
-        """Stop all the inputs, filters and outputs."""
+    def stop(self, deadline=None):
+        """Stop all the inputs, filters and outputs, in order."""
+        if deadline is None:
+            deadline = time.time() + DRAIN_TIMEOUT
         for s in self.stages:
             self.logger.debug('Stopping %s' % s)
-            s.stop()
+            s.stop(deadline)
             self.logger.debug('Stopped %s' % s)
@@ -0,0 +1,103 @@
+"""Compilation of the code string conditions of If and Switch.
+
+Names in a condition refer to the fields of the event, missing fields being
+None, with the attributes of Event (eg. tags) taking preference. Rather than
+evaluating the code against a proxy of every event, each name is rewritten to
+access the event directly, and the condition compiled to a plain function.
+"""
+
+import ast
+import operator
+
+from event import Event
+
+# the event, as named within compiled conditions
+EVENT = '_ev'
+
+# names which are constants, rather than fields
+CONSTANTS = ('True', 'False', 'None')
+
+def getter(name):
+    """Return a function getting the named field of an event, as names in
+    conditions are resolved.
+
+    >>> getter('a')(Event(a=1))
+    1
+    >>> getter('tags')(Event())
+    []
+    """
+    if hasattr(Event, name):
+        return operator.attrgetter(name)
+    return operator.methodcaller('get', name)
+
+class _Fields(ast.NodeTransformer):
+    """Rewrites free names to access the fields of the event."""
+
+    def __init__(self, bound):
+        self.bound = bound
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load) or node.id in self.bound or node.id in CONSTANTS:
+            return node
+        ev = ast.Name(id=EVENT, ctx=ast.Load())
+        if hasattr(Event, node.id):
+            access = ast.Attribute(value=ev, attr=node.id, ctx=ast.Load())
+        else:
+            access = ast.Call(func=ast.Attribute(value=ev, attr='get', ctx=ast.Load()),
+                args=[ast.Str(s=node.id)], keywords=[], starargs=None, kwargs=None)
+        return ast.copy_location(access, node)
+
+def compile_condition(text):
+    """Compile a condition to a function of the event.
+
+    >>> f = compile_condition('a == 1 and "x" in tags')
+    >>> f(Event(a=1, tags=['x'])), f(Event(a=1)), f(Event())
+    (True, False, False)
+    >>> compile_condition('[t for t in tags if t.startswith(prefix)]')(
+    ...     Event(tags=['ab', 'b'], prefix='a'))
+    ['ab']
+    """
+    tree = ast.parse(text.strip(), '<condition>', 'eval')
+    # names assigned within the condition, eg. comprehension variables
+    bound = set(node.id for node in ast.walk(tree)
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load))
+    body = _Fields(bound).visit(tree.body)
+    args = ast.arguments(args=[ast.Name(id=EVENT, ctx=ast.Param())],
+        vararg=None, kwarg=None, defaults=[])
+    tree = ast.Expression(body=ast.Lambda(args=args, body=body))
+    ast.fix_missing_locations(tree)
+    return eval(compile(tree, '<condition>', 'eval'), {})
+
+def _literal(node):
+    if isinstance(node, ast.Str):
+        return node.s
+    if isinstance(node, ast.Num):
+        return node.n
+    raise ValueError
+
+def equality(text):
+    """Return (field, values) if the condition only tests a field is equal to
+    one of some constant values, otherwise None.
+
+    >>> equality('type == "nginx"')
+    ('type', frozenset(['nginx']))
+    >>> equality('status in (500, 503)')
+    ('status', frozenset([500, 503]))
+    >>> equality('type == "nginx" or status == 500')
+    """
+    node = ast.parse(text.strip(), '<condition>', 'eval').body
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1):
+        return None
+    left, op, right = node.left, node.ops[0], node.comparators[0]
+    try:
+        if isinstance(op, ast.Eq):
+            if isinstance(right, ast.Name):
+                left, right = right, left
+            if isinstance(left, ast.Name) and left.id not in CONSTANTS:
+                return (left.id, frozenset([_literal(right)]))
+        elif isinstance(op, ast.In) and isinstance(left, ast.Name) and \
+                left.id not in CONSTANTS and isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+            return (left.id, frozenset(_literal(v) for v in right.elts))
+    except ValueError:
+        pass
+    return None
@@ -12,6 +12,12 @@ class PyConfigLoader(object):
         self.path = path
 
     def configure(self):
+        self.load()
+        # pipeline has no final output queue
+        self.pipeline.setup(None)
+
+    def load(self):
+        """Load the pipeline from the configuration, without setting it up."""
         self.logger.info('Loading configuration: %r' % self.path)
         # push implicit top-level context
         self.pipeline = Pipeline()
@@ -21,6 +27,3 @@ class PyConfigLoader(object):
             except Exception as ex:
                 trace = sys.exc_info()[2]
                 raise ConfigException(ex), None, trace
-
-        # pipeline has no final output queue
-        self.pipeline.setup(None)
@@ -1,56 +1,103 @@
+import copy
 import json
-from string import Formatter
+import datetime as _datetime
 from datetime import datetime
 from pprint import pformat
 import dateutil.tz
 
+from template import DefaultFormatter, compiled
+
+UTC = dateutil.tz.tzutc()
+
+# the start of the second last formatted, and its formatted prefix
+_second = [None, None]
+
+def format_datetime(obj):
+    """Format a datetime as serialized, in UTC with millisecond precision.
+
+    >>> format_datetime(datetime(2013, 1, 1, 1, 2, 3, 45678))
+    '2013-01-01T01:02:03.045Z'
+    >>> format_datetime(datetime(2013, 1, 1, 1, 2, 3, tzinfo=dateutil.tz.tzoffset(None, 3600)))
+    '2013-01-01T00:02:03.000Z'
+    """
+    if obj.tzinfo is not None:
+        # normalize all datetimes to UTC
+        obj = obj.astimezone(UTC).replace(tzinfo=None)
+
+    # events mostly arrive in time order, so the formatting of the second is
+    # cached. isoformat doesn't produce consistent output when microsecond=0
+    start, prefix = _second
+    delta = start is not None and obj - start
+    if not delta or delta.days or delta.seconds:
+        start = obj.replace(microsecond=0)
+        prefix = start.strftime("%Y-%m-%dT%H:%M:%S")
+        _second[:] = [start, prefix]
+    return '%s.%03dZ' % (prefix, obj.microsecond / 1000)
+
+def _default(obj):
+    if isinstance(obj, _datetime.datetime):
+        return format_datetime(obj)
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        import datetime
-        if isinstance(obj, datetime.datetime):
-            if obj.tzinfo is not None:
-                # normalize all datetimes to UTC
-                obj = obj.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
-
-            # isoformat doesn't produce consistent output when microsecond=0
-            ms = '.%03dZ' % (obj.microsecond/1000)
-            return obj.strftime("%Y-%m-%dT%H:%M:%S") + ms
+        if isinstance(obj, _datetime.datetime):
+            return format_datetime(obj)
         else:
             return super(JSONEncoder, self).default(obj)
 
-class DefaultFormatter(Formatter):
-    default = ''
+def use_json(module):
+    """Serialize events with the given json module, which should provide a
+    JSONEncoder compatible with the standard library's (eg. simplejson)."""
+    global _encode
+    _encode = module.JSONEncoder(default=_default, separators=(',', ':')).encode
+
+# simplejson is faster, when installed with its C extension
+try:
+    import simplejson
+    from simplejson import _speedups
+    use_json(simplejson)
+except ImportError:
+    use_json(json)
 
-    def get_value(self, key, args, kwargs):
-        # Try standard formatting, then return 'unknown key'
-        try:
-            return Formatter.get_value(self, key, args, kwargs)
-        except KeyError:
-            return self.default
+# values which may be modified in place, so are copied before being shared
+# between forks of an event
+_CONTAINERS = (dict, list, set)
 
 class Event(dict):
     """An event.
 
     This is the basic unit of communication in logcabin.
     """
+
+    # kept aside from the fields: the trace of the event (see trace), and the
+    # containers and serialization shared with its forks, and the originals of
+    # containers copied since (see fork). With no instance __dict__ or weakref
+    # support, there's no overhead over a plain dict with these.
+    __slots__ = ('_trace', '_shared', '_json', '_copied')
+
     def __init__(self, *args, **kwargs):
         """
         Create an event. A timestamp is automatically generated.
         """
         if 'timestamp' not in kwargs:
-            self['timestamp'] = datetime.utcnow()
-        super(Event, self).__init__(*args, **kwargs)
+            dict.__setitem__(self, 'timestamp', datetime.utcnow())
+        dict.__init__(self, *args, **kwargs)
 
     def add_tag(self, value):
         """
-        Add a tag to the event.
+        Add a tag to the event, unless it already has it. The tags are kept
+        as a list, as they're output.
 
         >>> ev = Event()
         >>> ev.add_tag('tag1')
+        >>> ev.add_tag('tag1')
         >>> ev.tags
         ['tag1']
         """
-        self.setdefault('tags', []).append(value)
+        tags = self.setdefault('tags', [])
+        if value not in tags:
+            tags.append(value)
 
     @property
     def tags(self):
@@ -68,7 +115,19 @@ class Event(dict):
         >>> Event().a
         >>> Event(a=2).a
         2
+
+        Special attributes are not looked up, so events can be pickled and copied:
+
+        >>> import pickle
+        >>> ev = Event(a=2, timestamp=datetime(2013, 1, 1, 1, 2, 3, 45))
+        >>> pickle.loads(pickle.dumps(ev, 2))
+        Event({'a': 2, 'timestamp': datetime.datetime(2013, 1, 1, 1, 2, 3, 45)})
         """
+        if k.startswith('__'):
+            raise AttributeError(k)
+        if k in Event.__slots__:
+            # not set
+            return None
         return self.get(k)
 
     def __setattr__(self, k, v):
@@ -93,10 +152,11 @@ class Event(dict):
         >>> Event(timestamp=datetime(2013, 1, 1, 1, 2, 3, 45)).to_json()
         '{"timestamp":"2013-01-01T01:02:03.000Z"}'
         """
-        return json.dumps(self, cls=JSONEncoder, separators=(',', ':'))
+        return _encode(self)
 
     def format(self, fmt, args=None, raise_missing=False):
-        """Format the event using string.format notation.
+        """Format the event using string.format notation. Stages formatting
+        every event should compile a Template of the format instead.
 
         >>> Event(field='x').format("field={field} missing={missing}")
         'field=x missing='
@@ -108,8 +168,59 @@ class Event(dict):
         ...     Event(field='x').format("{timestamp:%A %d. %B %Y}")
         'Tuesday 01. January 2013'
         """
-        formatter = raise_missing and Formatter() or DefaultFormatter()
-        return formatter.vformat(fmt, args, self)
+        return compiled(fmt, raise_missing).format(self, args)
+
+    def fork(self):
+        """Return a copy of the event, for another branch of the pipeline.
+
+        The copy shares the values of the event, so is cheap to make. Setting
+        fields only affects the one event, and containers (eg. the tags) are
+        copied by each event when first accessed, before they can be modified.
+        Until they're modified, the event and its forks are only serialized
+        once, by whichever is first.
+
+        >>> ev = Event(a=1, tags=['x'], timestamp=datetime(2013, 1, 1))
+        >>> fork = ev.fork()
+        >>> fork.a = 2
+        >>> fork.add_tag('y')
+        >>> ev.a, ev.tags, fork.a, fork.tags
+        (1, ['x'], 2, ['x', 'y'])
+        >>> fork = ev.fork()
+        >>> 'x' in fork.tags
+        True
+        >>> ev.to_json() is fork.to_json()
+        True
+        """
+        if isinstance(self, SharedEvent):
+            self._check()
+        shared = set(k for k, v in dict.iteritems(self) if isinstance(v, _CONTAINERS))
+        if isinstance(self, SharedEvent):
+            self._shared.update(shared)
+        else:
+            object.__setattr__(self, '_shared', set(shared))
+            object.__setattr__(self, '__class__', SharedEvent)
+        # the containers are all shared again
+        object.__setattr__(self, '_copied', {})
+        if self._json is None:
+            # modified since any previous fork
+            object.__setattr__(self, '_json', [None])
+
+        fork = dict.__new__(SharedEvent)
+        dict.update(fork, self)
+        object.__setattr__(fork, '_shared', shared)
+        object.__setattr__(fork, '_json', self._json)
+        object.__setattr__(fork, '_copied', {})
+        if self._trace is not None:
+            object.__setattr__(fork, '_trace', self._trace.copy())
+        return fork
+
+    def __reduce_ex__(self, protocol):
+        # the fields and trace, restoring a plain Event, as pickling copies
+        # any shared containers anyway
+        return (_new_event, (), self._trace, None, dict.iteritems(self))
+
+    def __setstate__(self, trace):
+        object.__setattr__(self, '_trace', trace)
 
     def __repr__(self):
         """Returns the representation of the object.
@@ -122,3 +233,153 @@ class Event(dict):
         """
         # pprint returns a stable ordering for tests
         return 'Event(%s)' % pformat(dict(self))
+
+def _new_event():
+    return dict.__new__(Event)
+
+_missing = object()
+
+def _modified(event):
+    """Stop sharing the serialization of a SharedEvent, reverting to a plain
+    Event if nothing else is shared."""
+    object.__setattr__(event, '_json', None)
+    event._copied.clear()
+    if not event._shared:
+        object.__setattr__(event, '__class__', Event)
+
+class SharedEvent(Event):
+    """An event sharing containers and its serialization with its forks.
+
+    Each container is copied when first accessed, by key or by iterating
+    over the values (eg. items() or copy()), and the serialization
+    is no longer shared once the event is modified - by setting fields, or
+    in place through a container handed out, which is found by comparing it
+    to the original. Then the event reverts to a plain Event.
+    """
+
+    __slots__ = ()
+
+    def _unshare(self, k):
+        shared = self._shared
+        if k in shared:
+            shared.discard(k)
+            if dict.__contains__(self, k):
+                original = dict.__getitem__(self, k)
+                dict.__setitem__(self, k, copy.deepcopy(original))
+                if self._json is not None:
+                    # the copy may now be modified in place
+                    self._copied[k] = original
+
+    def _check(self):
+        """Stop sharing the serialization if any container handed out has
+        been modified in place."""
+        if self._json is None:
+            return
+        for k, original in self._copied.iteritems():
+            if dict.get(self, k, _missing) != original:
+                _modified(self)
+                return
+
+    def _unshare_all(self):
+        for k in list(self._shared):
+            self._unshare(k)
+
+    def to_json(self):
+        if self._copied:
+            self._check()
+        cache = self._json
+        if cache is None:
+            return self._serialize()
+        if cache[0] is None:
+            cache[0] = self._serialize()
+        return cache[0]
+
+    def _serialize(self):
+        # the encoder would iterate over the event, copying every container
+        # shared, when they're only read
+        return _encode(dict(dict.iteritems(self)))
+
+    def __getitem__(self, k):
+        self._unshare(k)
+        return dict.__getitem__(self, k)
+
+    def get(self, k, default=None):
+        self._unshare(k)
+        return dict.get(self, k, default)
+
+    # the values are handed out, so each container is copied first
+
+    def items(self):
+        self._unshare_all()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._unshare_all()
+        return dict.iteritems(self)
+
+    def viewitems(self):
+        self._unshare_all()
+        return dict.viewitems(self)
+
+    def values(self):
+        self._unshare_all()
+        return dict.values(self)
+
+    def itervalues(self):
+        self._unshare_all()
+        return dict.itervalues(self)
+
+    def viewvalues(self):
+        self._unshare_all()
+        return dict.viewvalues(self)
+
+    def copy(self):
+        self._unshare_all()
+        return dict.copy(self)
+
+    def __copy__(self):
+        # a plain Event, with its own copies of the containers still shared,
+        # as they may be modified in place through a shallow copy
+        self._unshare_all()
+        ev = _new_event()
+        dict.update(ev, self)
+        object.__setattr__(ev, '_trace', self._trace)
+        return ev
+
+    def setdefault(self, k, default=None):
+        if dict.__contains__(self, k):
+            return self[k]
+        _modified(self)
+        return dict.setdefault(self, k, default)
+
+    def pop(self, k, *args):
+        self._unshare(k)
+        _modified(self)
+        return dict.pop(self, k, *args)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        k = next(iter(self))
+        return k, self.pop(k)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._shared.difference_update(other)
+        _modified(self)
+        dict.update(self, other)
+
+    def clear(self):
+        self._shared.clear()
+        _modified(self)
+        dict.clear(self)
+
+    def __setitem__(self, k, v):
+        self._shared.discard(k)
+        _modified(self)
+        dict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self._shared.discard(k)
+        _modified(self)
+        dict.__delitem__(self, k)
@@ -1,4 +1,4 @@
 from ..common import ProcessingStage
 
 class Filter(ProcessingStage):
-    pass
+    fusable = True
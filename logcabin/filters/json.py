@@ -15,8 +15,8 @@ class Json(Filter):
         Json()
     """
 
-    def __init__(self, field='data', consume=True, on_error='reject'):
-        super(Json, self).__init__(on_error=on_error)
+    def __init__(self, field='data', consume=True, on_error='reject', **kwargs):
+        super(Json, self).__init__(on_error=on_error, **kwargs)
         self.field = field
         self.consume = consume
 
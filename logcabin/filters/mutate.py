@@ -1,6 +1,7 @@
 import types
 
 from .filter import Filter
+from ..template import Template
 
 class Mutate(Filter):
     """Filter that allows you to add, rename, copy and drop fields
@@ -21,10 +22,12 @@ class Mutate(Filter):
 
         Mutate(unset=['junk', 'rubbish'])
     """
-    def __init__(self, set={}, rename={}, copy={}, unset=[]):
-        super(Mutate, self).__init__()
+    def __init__(self, set={}, rename={}, copy={}, unset=[], **kwargs):
+        super(Mutate, self).__init__(**kwargs)
         self.sets = set
         assert type(self.sets) == dict
+        self.templates = dict((k, Template(v)) for k, v in self.sets.iteritems()
+            if isinstance(v, types.StringTypes))
         self.renames = rename
         assert type(self.renames) == dict
         self.copies = copy
@@ -34,8 +37,8 @@ class Mutate(Filter):
     
     def process(self, event):
         for k, v in self.sets.iteritems():
-            if isinstance(v, types.StringTypes):
-                v = event.format(v)
+            if k in self.templates:
+                v = self.templates[k].format(event)
             event[k] = v
             self.logger.debug('Set %r to %r' % (k, v))
 
@@ -18,8 +18,8 @@ class Python(Filter):
         Python(function=clean)
     """
 
-    def __init__(self, function, on_error='reject'):
-        super(Python, self).__init__(on_error=on_error)
+    def __init__(self, function, on_error='reject', **kwargs):
+        super(Python, self).__init__(on_error=on_error, **kwargs)
         self.function = function
 
     def process(self, event):
@@ -19,8 +19,8 @@ class Regex(Filter):
         Regex(regex='(?P<timestamp>.+) - (?P<message>.+)')
     """
 
-    def __init__(self, regex, field='data', on_error='reject'):
-        super(Regex, self).__init__(on_error=on_error)
+    def __init__(self, regex, field='data', on_error='reject', **kwargs):
+        super(Regex, self).__init__(on_error=on_error, **kwargs)
         self.field = field
         self.regex = re.compile(regex)
 
@@ -5,6 +5,7 @@ import time
 from ..statistics import mean, percentile, stddev
 from ..util import Periodic, get_path
 from ..event import Event
+from ..template import Template
 from pprint import pformat
 
 class Stats(Filter):
@@ -40,17 +41,25 @@ class Stats(Filter):
 
         Stats(metrics={'app.{1}': 'timings.*'})
     """
-    def __init__(self, period=5, metrics=None, zero=True):
-        super(Stats, self).__init__()
+
+    # has periodic behaviour
+    fusable = False
+
+    def __init__(self, period=5, metrics=None, zero=True, **kwargs):
+        super(Stats, self).__init__(**kwargs)
         # configuration
         self.metrics = metrics or {}
         self.zero = zero
+        self.templates = dict((output, Template(output, raise_missing=True))
+            for output in self.metrics)
 
         # transient state
         self.timers = {}
 
         self.last = time.time()
         self.periodic = Periodic(period, self.flush)
+        # stage replaced on a reload, which flushes until this starts
+        self.previous = None
 
     def process(self, event):
         for output, path in self.metrics.iteritems():
@@ -61,7 +70,7 @@ class Stats(Filter):
 
     def _process_value(self, event, output, v, value):
         try:
-            k = event.format(output, [v], raise_missing=True)
+            k = self.templates[output].format(event, [v])
             try:
                 # optimise for common case
                 self.timers[k].add(value)
@@ -72,14 +81,31 @@ class Stats(Filter):
             # event didn't contain all the necessary format keys - ignore
             pass
 
+    def takeover(self, old):
+        if self.metrics == old.metrics:
+            # carry on with the old timers, which the old stage adds to until
+            # it is stopped
+            self.timers = old.timers
+            self.last = old.last
+            self.previous = old
+
+    def handback(self, old):
+        if old.periodic.dead:
+            # killed when this started
+            old.periodic = Periodic(old.periodic.period, old.flush)
+            old.periodic.start()
+
     def start(self):
         super(Stats, self).start()
+        if self.previous is not None:
+            self.previous.periodic.kill()
+            self.last = self.previous.last
         self.periodic.start()
 
-    def stop(self):
+    def stop(self, deadline=None):
         self.periodic.kill()
         self.periodic.join()
-        super(Stats, self).stop()
+        super(Stats, self).stop(deadline)
 
     def flush(self):
         count = 0
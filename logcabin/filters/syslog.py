@@ -24,8 +24,8 @@ class Syslog(Filter):
         Syslog()
     """
 
-    def __init__(self, field='data', consume=True, on_error='reject'):
-        super(Syslog, self).__init__(on_error=on_error)
+    def __init__(self, field='data', consume=True, on_error='reject', **kwargs):
+        super(Syslog, self).__init__(on_error=on_error, **kwargs)
         self.field = field
         self.consume = consume
 
@@ -13,8 +13,8 @@ class Url(Filter):
     :param string field: the field to run the regex on (default: data)
     """
 
-    def __init__(self, field='data', on_error='reject'):
-        super(Url, self).__init__(on_error=on_error)
+    def __init__(self, field='data', on_error='reject', **kwargs):
+        super(Url, self).__init__(on_error=on_error, **kwargs)
         self.field = field
 
     def process(self, event):
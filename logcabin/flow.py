@@ -1,5 +1,10 @@
-from common import ProcessingStage, MultiStage
-from util import BroadcastQueue
+from common import ProcessingStage, MultiStage, DirectQueue
+from util import Batch, BroadcastQueue, put_events, requeue
+from worker import WorkerProcess
+from filters.filter import Filter
+from condition import compile_condition, equality, getter
+import gevent
+from gevent.queue import Queue
 import inspect
 
 class Fanin(MultiStage):
@@ -25,6 +30,10 @@ class Sequence(MultiStage):
     and so on, so the event is processed by each stage one after the other, in
     order.
 
+    Consecutive filters are fused: they run in the greenlet of the first,
+    which calls each in turn, avoiding a queue and context switch between
+    each. Pass fuse=False to a filter to keep it in its own greenlet.
+
     Syntax::
 
         with Sequence():
@@ -38,11 +47,21 @@ class Sequence(MultiStage):
         # this is setup backwards, so the output from the current is
         # connected to the input of the successor, and the input of the current
         # will be connected to the output of the predecessor.
+        successor = None
         for s in reversed(self.stages):
-            q = s.setup(q)
+            if _can_fuse(s) and _can_fuse(successor):
+                # call the successor directly, bypassing its queue
+                q = s.setup(DirectQueue(successor))
+                successor.fused = True
+            else:
+                q = s.setup(q)
+            successor = s
         self.input = q
         return self.input
 
+def _can_fuse(stage):
+    return isinstance(stage, ProcessingStage) and stage.can_fuse()
+
 class Fanout(MultiStage):
     """
     This enqueues the event onto multiple input queues in parallel.
@@ -64,6 +83,136 @@ class Fanout(MultiStage):
         self.input = BroadcastQueue(queues)
         return self.input
 
+class Collector(Batch):
+    """Queue-like list, which collects the events put onto it."""
+
+    put = Batch.append
+    put_batch = Batch.extend
+
+class Parallel(ProcessingStage, MultiStage):
+    """
+    This runs the enclosed filters in a pool of worker processes, so CPU
+    intensive parsing (eg. Regex, Syslog, Json) can use multiple cores.
+
+    Batches of up to batch_size events are sent to the workers, which run them
+    through each filter in turn, and the results are passed on. Only filters
+    can be enclosed, and not those with periodic behaviour of their own (eg.
+    Stats), as their state would be split between the workers.
+
+    :param integer workers: number of worker processes (default: 2)
+    :param boolean ordered: pass on events in the order received (default:
+      true), otherwise each batch is passed on as soon as it is processed.
+
+    Syntax::
+
+        with Parallel(workers=4):
+            Syslog()
+            Regex(regex='...')
+    """
+
+    def __init__(self, workers=2, ordered=True, batch_size=100, **kwargs):
+        # events must all go through the workers, in order
+        for option in ('concurrency', 'partition_key', 'fuse'):
+            if option in kwargs:
+                raise ValueError('Parallel does not support %s' % option)
+        super(Parallel, self).__init__(batch_size=batch_size, **kwargs)
+        self.workers = workers
+        self.ordered = ordered
+        self.results = Collector()
+        self.processes = []
+        self.feeders = []
+
+    def add(self, stage):
+        if not isinstance(stage, Filter):
+            raise ValueError('Parallel can only contain filters: %s' % stage)
+        if not stage.fusable:
+            # like fusing, this needs the filter to only act on events passed
+            raise ValueError('Parallel cannot contain %s, it keeps state between events' % stage)
+        super(Parallel, self).add(stage)
+
+    def setup(self, q):
+        # the filters are chained to call each other directly, collecting the
+        # results, to be run within the worker processes.
+        chain = self.results
+        for s in reversed(self.stages):
+            s.setup(chain)
+            chain = DirectQueue(s)
+        self.chain = chain
+        return super(Parallel, self).setup(q)
+
+    def _process_batch_in_worker(self, events):
+        del self.results[:]
+        put_events(self.chain, events)
+        return Batch(self.results)
+
+    def start(self):
+        self.pending = Queue(self.workers)
+        self.completed = {}
+        self.next = 0
+        self.processes = [WorkerProcess(self._process_batch_in_worker)
+            for n in xrange(self.workers)]
+        self.feeders = [gevent.spawn(self._feed, n) for n in xrange(self.workers)]
+        # the enclosed stages are not started, they only run in the workers
+        ProcessingStage.start(self)
+
+    def stop(self, deadline=None):
+        ProcessingStage.stop(self, deadline)
+        for p in self.processes:
+            p.stop(deadline)
+        self.processes = []
+
+    def _halt(self):
+        # put back the batches waiting for or being processed by the workers,
+        # and pass on those processed but waiting on earlier ones
+        ProcessingStage._halt(self)
+        while self.pending.qsize():
+            seq, events, items = self.pending.queue.pop()
+            requeue(self.input, events, items)
+        gevent.killall(self.feeders, block=True)
+        for seq in sorted(self.completed):
+            self._emit(*self.completed.pop(seq))
+
+    def _run(self):
+        # dispatch batches for the feeders to pass to the workers
+        seq = 0
+        while True:
+            events, items = self._get_batch()
+            try:
+                self.pending.put((seq, events, items))
+            except gevent.GreenletExit:
+                requeue(self.input, events, items)
+                raise
+            seq += 1
+
+    def _feed(self, n):
+        while True:
+            seq, events, items = self.pending.get()
+            try:
+                events = self.processes[n].call(events)
+            except gevent.GreenletExit:
+                requeue(self.input, events, items)
+                raise
+            except Exception as ex:
+                self.logger.exception('Worker failed, dropping %d events: %s' % (len(events), ex))
+                self.processes[n].stop()
+                self.processes[n] = WorkerProcess(self._process_batch_in_worker)
+                events = Batch()
+
+            if not self.ordered:
+                self._emit(events, items)
+                continue
+
+            # pass on completed batches in sequence
+            self.completed[seq] = (events, items)
+            while self.next in self.completed:
+                self._emit(*self.completed.pop(self.next))
+                self.next += 1
+
+    def _emit(self, events, items):
+        if events and self.output is not None:
+            put_events(self.output, events)
+        self._task_done(items)
+
 from contextlib import contextmanager
 
 class DefaultDictProxy(object):
@@ -81,6 +230,26 @@ class DefaultDictProxy(object):
         else:
             return self.d.get(k)
 
+def _proxied(condition):
+    """Wrap a condition function to be called with a DefaultDictProxy."""
+    return lambda ev: condition(DefaultDictProxy(ev))
+
+def _always(ev):
+    return True
+
+def _test(condition, n):
+    return lambda ev: n if condition(ev) else None
+
+def _lookup(field, table):
+    get = getter(field)
+    def match(ev):
+        try:
+            return table.get(get(ev))
+        except TypeError:
+            # unhashable values can't equal any of the constants
+            return None
+    return match
+
 class Switch(ProcessingStage, MultiStage):
     """Branch flow based on a condition.
 
@@ -94,29 +263,86 @@ class Switch(ProcessingStage, MultiStage):
                 Mutate()
             with case.default:
                 Regex(regex='abc')
+
+    Code strings are compiled to functions accessing the event fields
+    directly. Consecutive cases testing the same field is equal to different
+    constants, eg. ``'type == "nginx"'`` or ``'status in (500, 503)'``, are
+    dispatched with a single dict lookup rather than tested in turn.
+
+    The events taken by each case are counted in hits. With reorder set, the
+    cases are periodically reordered to test the most taken first, keeping
+    the default last. Only use this when the conditions have no side effects
+    and no event can match more than one case, as otherwise which case takes
+    an event depends on the order.
+
+    :param boolean reorder: reorder the cases by their hits (default: false)
     """
 
-    def __init__(self, on_error='reject'):
-        super(Switch, self).__init__(on_error=on_error)
+    # events between reorderings of the cases
+    REORDER_INTERVAL = 1000
+
+    def __init__(self, on_error='reject', reorder=False, **kwargs):
+        super(Switch, self).__init__(on_error=on_error, **kwargs)
+        self.reorder = reorder
         self.cases = []
+        # the (field, constants) each case tests for equality, if it does
+        self.keys = []
+        self.hits = []
+        self.dispatch = []
 
-    @contextmanager
     def __call__(self, condition):
-        if isinstance(condition, str):
+        key = None
+        if isinstance(condition, basestring):
             # python code as string
-            code = compile(condition, 'string', 'eval')
-            condition = lambda ev: eval(code, {}, ev)
+            key = equality(condition)
+            condition = compile_condition(condition)
+        else:
+            condition = _proxied(condition)
+        return self._case(condition, key)
 
+    @contextmanager
+    def _case(self, condition, key=None):
         br = Sequence()
         self.cases.append((condition, br))
+        self.keys.append(key)
+        self.hits.append(0)
         with br:
             yield
 
     @property
     def default(self):
-        return self(lambda x: True)
+        return self._case(_always)
+
+    def named_stages(self):
+        return [('case[%d]' % n, br) for n, (t, br) in enumerate(self.cases)]
+
+    def _dispatch(self):
+        """Return the cases to test in turn as (match, case numbers), where
+        match returns the number of the matching case or None, and the
+        number of them which may be reordered."""
+        dispatch = []
+        field = table = None
+        reorderable = None
+        for n, ((condition, br), key) in enumerate(zip(self.cases, self.keys)):
+            if key is None:
+                dispatch.append((_test(condition, n), [n]))
+                if condition is _always and reorderable is None:
+                    reorderable = len(dispatch) - 1
+                field = table = None
+            elif key[0] == field and not key[1].intersection(table):
+                # extend the lookup of the preceding cases
+                table.update(dict.fromkeys(key[1], n))
+                dispatch[-1][1].append(n)
+            else:
+                field, table = key[0], dict.fromkeys(key[1], n)
+                dispatch.append((_lookup(field, table), [n]))
+        if reorderable is None:
+            reorderable = len(dispatch)
+        return dispatch, reorderable
 
     def setup(self, q):
+        self.dispatch, self.reorderable = self._dispatch()
+        self.since_reorder = 0
         # separate queue for the incoming condition,
         # and fan in on the individual pipelines.
         for t, br in self.cases:
@@ -128,22 +354,66 @@ class Switch(ProcessingStage, MultiStage):
         ProcessingStage.start(self)
         MultiStage.start(self)
 
-    def stop(self):
-        # stop the branch and our greenlet
-        ProcessingStage.stop(self)
-        MultiStage.stop(self)
+    def stop(self, deadline=None):
+        # stop our greenlet, once drained into the branch, then the branch
+        ProcessingStage.stop(self, deadline)
+        MultiStage.stop(self, deadline)
+
+    def _reorder(self):
+        hits = self.hits
+        # sorting is stable, so cases with equal hits keep their order
+        self.dispatch[:self.reorderable] = sorted(self.dispatch[:self.reorderable],
+            key=lambda (match, cases): -sum(hits[n] for n in cases))
 
     def process(self, event):
+        if self.reorder:
+            self.since_reorder += 1
+            if self.since_reorder >= self.REORDER_INTERVAL:
+                self._reorder()
+                self.since_reorder = 0
+
         # pass the event into the sub-queue for the applicable pipeline
-        ret = True
-        for case, br in self.cases:
-            if case(DefaultDictProxy(event)):
-                br.input.put(event)
-                ret = False
-                break
+        for match, cases in self.dispatch:
+            n = match(event)
+            if n is not None:
+                self.hits[n] += 1
+                self.cases[n][1].input.put(event)
+                return False
 
         # if no condition handles it, pass straight on (True)
-        return ret
+        return True
+
+class Route(Switch):
+    """Branch flow on the value of a field.
+
+    Each route takes the events with one of the given values of the field,
+    found by a dict lookup, so in constant time however many routes there
+    are. The syntax is as Switch::
+
+        with Route(field='type') as route:
+            with route('nginx'):
+                Regex(regex='...')
+            with route('rails', 'sinatra'):
+                Json()
+            with route.default:
+                Mutate(set={'unrouted': True})
+
+    :param string field: field to route on
+    """
+
+    def __init__(self, field, **kwargs):
+        super(Route, self).__init__(**kwargs)
+        self.field = field
+        self.routed = set()
+
+    def __call__(self, *values):
+        duplicates = self.routed.intersection(values)
+        if duplicates:
+            raise ValueError('duplicate routes: %s' % ', '.join(repr(v) for v in sorted(duplicates)))
+        self.routed.update(values)
+        values = frozenset(values)
+        get = getter(self.field)
+        return self._case(lambda ev: get(ev) in values, (self.field, values))
 
 class If(ProcessingStage, MultiStage):
     """
@@ -156,15 +426,15 @@ class If(ProcessingStage, MultiStage):
             Json()
     """
 
-    def __init__(self, condition, on_error='reject'):
-        super(If, self).__init__(on_error=on_error)
-        if isinstance(condition, str):
+    def __init__(self, condition, on_error='reject', **kwargs):
+        super(If, self).__init__(on_error=on_error, **kwargs)
+        if isinstance(condition, basestring):
             # python code as string
             self.condition_text = condition
-            code = compile(condition, 'string', 'eval')
-            condition = lambda ev: eval(code, {}, ev)
+            condition = compile_condition(condition)
         else:
             self.condition_text = inspect.getsource(condition)
+            condition = _proxied(condition)
         self.condition = condition
 
     # configuration contexts
@@ -187,15 +457,15 @@ class If(ProcessingStage, MultiStage):
         ProcessingStage.start(self)
         MultiStage.start(self)
 
-    def stop(self):
-        # stop the branch and our greenlet
-        ProcessingStage.stop(self)
-        MultiStage.stop(self)
+    def stop(self, deadline=None):
+        # stop our greenlet, once drained into the branch, then the branch
+        ProcessingStage.stop(self, deadline)
+        MultiStage.stop(self, deadline)
 
     def process(self, event):
         # pass the event into the sub-queue for the applicable pipeline
-        result = self.condition(DefaultDictProxy(event))
-        self.logger.debug("Condition: %s evaluated to %s" % (self.condition_text, result))
+        result = self.condition(event)
+        self.logger.debug("Condition: %s evaluated to %s", self.condition_text, result)
         if result:
             self.branch.input.put(event)
             # sub-pipeline will dequeue
@@ -0,0 +1,171 @@
+"""Waiting for changes to files with Linux inotify, through ctypes.
+
+A single Watcher watches the directories of the files, so tails are woken by
+changes to their files - including being created, moved or deleted - rather
+than polling them with stat.
+"""
+
+import os
+import errno
+import ctypes
+import struct
+import logging
+import gevent
+import gevent.event
+from gevent.socket import wait_read
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# changes to the entries of a directory, rather than the files within it
+ENTRIES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event: wd, mask, cookie, len, followed by the name
+_EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _libc = None
+
+def available():
+    """Whether inotify is supported here."""
+    return _libc is not None
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+class Watcher(object):
+    """Watches the directories of paths, waking the greenlets waiting on
+    changes to the paths, or to the entries of the directories (eg. files
+    created).
+
+    Raises OSError if inotify is unavailable.
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is unavailable')
+        self.logger = logging.getLogger('Watcher')
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        # watch descriptor => directory, and back
+        self.dirs = {}
+        self.wds = {}
+        # path => gevent.event.Event set on changes
+        self.changed = {}
+        # path as given => (absolute path, directory), resolved once
+        self.paths = {}
+        # absolute paths whose changes are ignored
+        self.ignored = set()
+        self.g = gevent.spawn(self._run)
+
+    def watch(self, path):
+        """Watch for changes to path, a file or directory. Returns False if
+        its directory can't be watched, eg. it doesn't exist yet or the limit
+        of watches is reached, so changes must be polled for.
+
+        Once its directory is watched, watching the path again is just a
+        lookup, so it can be called before each wait.
+        """
+        resolved = self.paths.get(path)
+        if resolved is not None and resolved[1] in self.wds:
+            return True
+        abspath = os.path.abspath(path)
+        if abspath not in self.changed:
+            self.changed[abspath] = gevent.event.Event()
+        directory = abspath if os.path.isdir(abspath) else os.path.dirname(abspath)
+        self.paths[path] = (abspath, directory)
+        if directory in self.wds:
+            return True
+        try:
+            wd = _check(_libc.inotify_add_watch(self.fd, directory, MASK))
+        except OSError as ex:
+            self.logger.debug('Unable to watch %s: %s' % (directory, ex))
+            return False
+        self.dirs[wd] = directory
+        self.wds[directory] = wd
+        return True
+
+    def ignore(self, *paths):
+        """Ignore changes to paths, so writing them (eg. state kept alongside
+        the files watched) doesn't wake the directory."""
+        self.ignored.update(os.path.abspath(p) for p in paths)
+
+    def wait(self, path, timeout=None):
+        """Wait until path, watched with watch(), may have changed since the
+        last wait, or timeout seconds. Returns whether it may have changed."""
+        changed = self.changed[self.paths[path][0]]
+        result = changed.wait(timeout)
+        changed.clear()
+        return result
+
+    def _wake(self, path):
+        changed = self.changed.get(path)
+        if changed is not None:
+            changed.set()
+
+    def _run(self):
+        while True:
+            wait_read(self.fd)
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as ex:
+                if ex.errno == errno.EAGAIN:
+                    continue
+                raise
+            self._dispatch(data)
+
+    def _dispatch(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so wake everything
+                for changed in self.changed.itervalues():
+                    changed.set()
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed
+                del self.dirs[wd]
+                del self.wds[directory]
+                self._wake(directory)
+                continue
+            path = os.path.join(directory, name) if name else None
+            if path in self.ignored:
+                continue
+            if mask & ENTRIES:
+                self._wake(directory)
+            if path:
+                self._wake(path)
+
+    def close(self):
+        self.g.kill()
+        os.close(self.fd)
+        for changed in self.changed.itervalues():
+            changed.set()
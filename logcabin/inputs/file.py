@@ -1,49 +1,222 @@
 import gevent
+import gevent.event
 import os
 import glob
+import time
 import logging
 import errno
+from collections import OrderedDict
 
 from ..event import Event
+from ..util import Batch, put_events
+from .. import trace
+from .. import inotify
 from .input import Input
-from gevent.queue import JoinableQueue
+
+class OpenFiles(object):
+    """Caps the number of files held open by tails, closing the least recently
+    used idle ones. They are reopened where they were left when they change.
+
+    A tail acquires a slot before opening its file: with none free, an idle
+    file is closed, or else the tail waits for one to be.
+
+    :param integer limit: maximum number of open files (None: unlimited)
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        # tails with open files, or a slot to open one
+        self.open = set()
+        # idle tails with open files, least recently used first
+        self.lru = OrderedDict()
+        # set when a file is closed or goes idle
+        self.changed = gevent.event.Event()
+
+    def acquire(self, tail):
+        """Wait for a slot for the tail to open its file in."""
+        while self.limit is not None and len(self.open) >= self.limit:
+            if self.lru:
+                t, _ = self.lru.popitem(last=False)
+                t.close()
+            else:
+                self.changed.clear()
+                self.changed.wait()
+        self.open.add(tail)
+
+    def closed(self, tail):
+        self.open.discard(tail)
+        self.lru.pop(tail, None)
+        self.changed.set()
+
+    def idle(self, tail):
+        """Mark a tail as waiting for changes, so its file may be closed."""
+        if tail in self.open:
+            self.lru[tail] = True
+            self.changed.set()
+
+    def busy(self, tail):
+        self.lru.pop(tail, None)
+
+class Registry(object):
+    """The offsets of the files tailed by a File input, saved in a single file.
+
+    Offsets are keyed by the device and inode of the files, so follow them
+    when they are renamed (eg. rotated). As a new file may reuse the inode of
+    one deleted, a file found at another path that isn't a rotation of the
+    saved one (eg. test.log.1 of test.log) is only resumed if unchanged since:
+    at least the size of the offset, and with the same modification time. The
+    file is saved atomically - written to a temporary file, synced, then
+    renamed over the registry.
+
+    :param string path: the registry file
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('Registry')
+        self.path = path
+        # (device, inode) => (path, offset, mtime) of the files loaded, not yet
+        # claimed
+        self.pending = {}
+        self.saved = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        for line in file(self.path):
+            try:
+                dev, ino, offset, mtime, path = line.rstrip('\n').split(' ', 4)
+                self.pending[int(dev), int(ino)] = (path, int(offset), float(mtime))
+            except ValueError:
+                self.logger.warn('Ignoring invalid line in %s: %r' % (self.path, line))
+        self.logger.debug('Loaded %d offsets from %s' % (len(self.pending), self.path))
+
+    def claim(self, identity, path, st):
+        """Return the saved offset of the file at path by (device, inode), or
+        None. st is the stat of the file."""
+        entry = self.pending.pop(identity, None)
+        if entry is None:
+            return None
+        saved_path, offset, mtime = entry
+        if path != saved_path and not path.startswith(saved_path) and \
+                (st.st_size < offset or st.st_mtime != mtime):
+            self.logger.debug('Not resuming %s, another file had its inode: %s' % (path, saved_path))
+            return None
+        return offset
+
+    def release(self, tail):
+        """Return the offset of a tail stopped by an error to be claimed again,
+        when the file is next tailed."""
+        if tail.identity is not None:
+            self.pending[tail.identity] = (tail.path, tail.offset, tail.mtime)
+
+    def save(self, tails):
+        """Save the offsets of the tails, and of the files loaded which are
+        still at their path but haven't been claimed yet. Unchanged offsets
+        aren't saved."""
+        lines = ['%d %d %d %r %s\n' % (t.identity + (t.offset, t.mtime, t.path))
+            for t in tails if t.identity is not None]
+        for identity, (path, offset, mtime) in self.pending.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            # a file since created at the path may reuse the inode
+            if st and (st.st_dev, st.st_ino) == identity:
+                lines.append('%d %d %d %r %s\n' % (identity + (offset, mtime, path)))
+            else:
+                del self.pending[identity]
+        data = ''.join(lines)
+        if data == self.saved:
+            return
+        with file(self.path + '.tmp', 'w') as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(self.path + '.tmp', self.path)
+        self.saved = data
 
 class Tail(gevent.Greenlet):
-    """Asynchronously tails a file by name, delivering new lines to a queue."""
-    def __init__(self, path, queue, statedir):
+    """Asynchronously tails a file by name, putting batches of events of the
+    new lines onto the output queue.
+
+    The file is read in blocks, split into lines, with an incomplete last line
+    carried over until the rest of it is written. The offset is that of the
+    lines put onto the output, resumed from and saved to the registry.
+
+    Changes to the file are waited for with the watcher if given, checking
+    every poll seconds for any it misses, otherwise polled for, backing off
+    while the file is idle.
+    """
+
+    # bytes read at a time
+    BLOCK = 1 << 16
+
+    # seconds between polls, doubled while the file is unchanged
+    POLL_MIN = 0.01
+    POLL_MAX = 1.0
+
+    def __init__(self, path, output, statedir, watcher=None, files=None, registry=None,
+            poll=30):
         super(Tail, self).__init__()
         self.logger = logging.getLogger('Tail')
         self.path = path
+        self.watcher = watcher
+        self.poll = poll
+        self.files = files or OpenFiles()
+        self.registry = registry
+        self.interval = self.POLL_MIN
+        # offset file of earlier versions, migrated to the registry
         if statedir:
             self.offset_path = os.path.join(statedir, self.path.replace('/', '_') + '.offset')
         else:
             self.offset_path = self.path + '.offset'
-        self.queue = queue
+        self.output = output
         self.fin = None
+        # (device, inode) of the file open, or last open
+        self.identity = None
+        # modification time of the file, as last seen
+        self.mtime = None
+        self.offset = 0
+        self.partial = ''
         self.start()
 
     def _run(self):
         try:
             self.tail()
-        except:
-            self._write_state_file()
+        except Exception:
+            self.logger.exception('Failed tailing %s' % self.path)
+        finally:
             if self.fin:
-                self.logger.debug('Closed: %s' % self.path)
-                self.fin.close()
+                self.close()
 
-    def _write_state_file(self):
-        with file(self.offset_path, 'w') as fout:
-            offset = self.fin.tell()
-            self.logger.debug("Writing state file: %s at offset %d" % (self.offset_path, offset))
-            print >>fout, offset
+    def _saved_offset(self):
+        offset = self.registry and self.registry.claim(self.identity, self.path,
+            os.fstat(self.fin.fileno()))
+        if offset is None and os.path.exists(self.offset_path):
+            offset = int(file(self.offset_path).read())
+            os.remove(self.offset_path)
+        return offset
+
+    def close(self):
+        """Close the file. When idle, the tail continues, reopening the file
+        when it changes."""
+        self.logger.debug('Closed: %s at offset %d' % (self.path, self.offset))
+        self.fin.close()
+        self.fin = None
+        self.files.closed(self)
 
     def tail(self):
+        if self.watcher:
+            self.watcher.watch(self.path)
         self._ensure_open()
-        if os.path.exists(self.offset_path):
-            offset = file(self.offset_path).read()
-            offset = int(offset)
+        offset = self._saved_offset()
+        if offset > os.fstat(self.fin.fileno()).st_size:
+            self.logger.debug('Truncated since stopped: %s' % self.path)
+        elif offset:
             self.logger.debug("Seeking in %s to %d" % (self.path, offset))
             self.fin.seek(offset)
+            self.offset = offset
 
         last_st = None
 
@@ -57,85 +230,262 @@ class Tail(gevent.Greenlet):
                 st = None
 
             if st == last_st:
-                gevent.sleep(0.2)
+                self._wait()
+                continue
+            self.interval = self.POLL_MIN
+
+            if self.fin is None:
+                # closed while idle
+                self._reopen()
+                last_st = None
                 continue
 
-            # read pending lines
-            line = self.fin.readline()
-            while line:
-                self.queue.put(line)
-                line = self.fin.readline()
+            self._read()
 
             # check for file rolling
             if not st or (last_st and st.st_ino != last_st.st_ino):
                 # file has rolled, close and open again
                 self.logger.debug('Detected roll: %s' % self.path)
+                self._flush()
                 self._ensure_open()
                 st = None # restart
             elif st and last_st and st.st_size < last_st.st_size:
                 self.logger.debug('Detected truncation: %s' % self.path)
+                self._flush()
                 self._ensure_open()
                 st = None # restart
+            elif st:
+                self.mtime = st.st_mtime
 
             last_st = st
 
+    def _read(self):
+        """Read the pending lines."""
+        while True:
+            block = self.fin.read(self.BLOCK)
+            if not block:
+                return
+            lines = (self.partial + block).split('\n')
+            # the last line is incomplete, or empty after a trailing newline
+            partial = lines.pop()
+            if lines:
+                self._put(lines)
+                self.offset += len(self.partial) + len(block) - len(partial)
+            self.partial = partial
+            gevent.sleep() # yield for other stages
+
+    def _flush(self):
+        """Put the incomplete last line of a file done with."""
+        if self.partial:
+            self._put([self.partial])
+            self.partial = ''
+
+    def _put(self, lines):
+        self.logger.debug('Received %d lines: %s' % (len(lines), self.path))
+        events = Batch()
+        for line in lines:
+            events.append(trace.stamp(Event(data=line)))
+        put_events(self.output, events)
+
+    def _wait(self):
+        """Wait for the file to change."""
+        self.files.idle(self)
+        try:
+            if self.watcher and self.watcher.watch(self.path):
+                # with a timeout, in case of changes inotify misses (eg. over NFS)
+                self.watcher.wait(self.path, self.poll)
+                return
+            gevent.sleep(self.interval)
+            self.interval = min(self.interval * 2, self.POLL_MAX)
+        finally:
+            self.files.busy(self)
+
+    def _reopen(self):
+        """Reopen the file at the offset it was closed at, unless it has since
+        rolled or been truncated."""
+        identity, offset = self.identity, self.offset
+        self._ensure_open()
+        if self.identity == identity and os.fstat(self.fin.fileno()).st_size >= offset:
+            # the incomplete last line is read again
+            self.fin.seek(offset)
+            self.offset = offset
+            self.partial = ''
+        else:
+            self.logger.debug('Detected roll: %s' % self.path)
+            self._flush()
+
     def _ensure_open(self):
         if self.fin:
             self.fin.close()
             self.fin = None
+            self.files.closed(self)
+        self.identity = None
+        self.offset = 0
 
         while True:
+            self.files.acquire(self)
             try:
-                self.fin = file(self.path, 'r')
-                self.logger.debug('Opened: %s' % self.path)
-                return
+                self.fin = file(self.path, 'rb')
             except IOError as ex:
+                self.files.closed(self)
                 if ex.errno == errno.ENOENT:
-                    gevent.sleep(0.01)
+                    self._wait()
                     continue
                 raise
+            st = os.fstat(self.fin.fileno())
+            self.identity = (st.st_dev, st.st_ino)
+            self.mtime = st.st_mtime
+            self.logger.debug('Opened: %s' % self.path)
+            return
 
 class File(Input):
     """Tails events from a log file on disk.
 
     Creates events with the field 'data' set to the line received.
 
+    On Linux, a single inotify watcher wakes the tails when their files change,
+    rather than each polling its file.
+
+    New files matching the path are picked up as they're created, and tails
+    of files which have been gone for rescan seconds are stopped. Tails which
+    fail (eg. on a file that can't be read) are retried along with looking
+    for new files. At most max_open files are held open: the least recently
+    used idle files are closed, and reopened when they change, and tails wait
+    for a file to go idle before opening theirs.
+
+    The offsets read up to are checkpointed every checkpoint seconds to a
+    single registry file, keyed by the device and inode of the files, and
+    resumed from on restart. By default the registry is stored in statedir,
+    or else as a hidden file in the directory of the log files.
+
     :param string path: path on the file system to the log file(s), wildcards may
       be used to match multiple files.
     :param string statedir: writable directory to store state for files
+    :param boolean inotify: wait for changes with inotify where available,
+      otherwise poll for them (default: true)
+    :param float inotify_poll: interval in seconds between checking files
+      watched with inotify for changes it misses, eg. on NFS (default: 30)
+    :param float rescan: maximum interval in seconds between looking for new
+      files matching the path (default: 10)
+    :param integer max_open: maximum number of files held open (default: 1000)
+    :param string registry: file to store the offsets in (optional)
+    :param float checkpoint: interval in seconds between saving the offsets
+      (default: 5)
 
     Example::
 
         File(path='/var/log/syslog')
+        File(path='/var/log/app/*.log', max_open=100)
     """
 
-    def __init__(self, path, statedir=None):
-        super(File, self).__init__()
+    def __init__(self, path, statedir=None, inotify=True, inotify_poll=30, rescan=10,
+            max_open=1000, registry=None, checkpoint=5, **kwargs):
+        super(File, self).__init__(**kwargs)
+        if max_open is not None and max_open < 1:
+            raise ValueError('max_open should be at least 1')
         self.path = path
         self.statedir = statedir
-        self.tails = []
+        self.inotify = inotify
+        self.inotify_poll = inotify_poll
+        self.rescan = rescan
+        self.max_open = max_open
+        self.registry_path = registry or self._registry_path()
+        self.checkpoint = checkpoint
+        self.registry = None
+        self.checkpointer = None
+        self.watcher = None
+        # path => Tail
+        self.tails = {}
+        # path of tail => time its file was first found missing
+        self.missing = {}
 
-    def _run(self):
+    def _registry_path(self):
+        name = self.path.replace('/', '_') + '.registry'
+        if self.statedir:
+            return os.path.join(self.statedir, name)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        while glob.has_magic(directory):
+            directory = os.path.dirname(directory)
+        # hidden, so not matched by the path
+        return os.path.join(directory, '.' + name)
+
+    def _watch(self):
+        if not self.inotify or not inotify.available():
+            return None
+        try:
+            return inotify.Watcher()
+        except OSError as ex:
+            self.logger.warn('Polling for changes, as unable to use inotify: %s' % ex)
+            return None
+
+    def _discover(self, files):
+        """Start tailing new files matching the path, and stop the tails of
+        files gone for rescan seconds. Tails stopped by an error are retried.
+        Returns whether there were new files."""
         paths = glob.glob(self.path)
-        while not paths:
-            gevent.sleep(0.01)
-            paths = glob.glob(self.path)
-        q = JoinableQueue()
+        for p, t in self.tails.items():
+            if t.ready():
+                self.registry.release(t)
+                del self.tails[p]
+                self.missing.pop(p, None)
+        new = [p for p in paths if p not in self.tails]
+        if new:
+            self.logger.debug('Tailing %s' % ', '.join(new))
+        for p in new:
+            self.tails[p] = Tail(p, self.output, self.statedir, self.watcher, files,
+                self.registry, self.inotify_poll)
 
-        self.logger.debug('Tailing %s' % ', '.join(paths))
-        self.tails = [Tail(p, q, self.statedir) for p in paths]
+        now = time.time()
+        found = set(paths)
+        for p in self.tails.keys():
+            if p in found:
+                self.missing.pop(p, None)
+            elif now - self.missing.setdefault(p, now) >= self.rescan:
+                self._reap(p)
+        return bool(new)
 
+    def _reap(self, path):
+        self.logger.debug('Stopped tailing %s' % path)
+        t = self.tails.pop(path)
+        del self.missing[path]
+        t.kill()
+        t.join()
+
+    def _checkpoint(self):
         while True:
-            data = q.get()
-            if data:
-                if data.endswith('\n'):
-                    data = data[0:-1]
-                self.logger.debug('Received: %r' % data)
-                self.output.put(Event(data=data))
-            q.task_done()
-
-    def stop(self):
-        for t in self.tails:
+            gevent.sleep(self.checkpoint)
+            self.registry.save(self.tails.values())
+
+    def _run(self):
+        self.registry = Registry(self.registry_path)
+        self.checkpointer = gevent.spawn(self._checkpoint)
+        self.watcher = self._watch()
+        if self.watcher:
+            # the registry may be in the directory watched for new files
+            self.watcher.ignore(self.registry_path, self.registry_path + '.tmp')
+        files = OpenFiles(self.max_open)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        interval = Tail.POLL_MIN
+        while True:
+            if self._discover(files):
+                interval = Tail.POLL_MIN
+            if self.watcher and not glob.has_magic(directory) and self.watcher.watch(directory):
+                self.watcher.wait(directory, self.rescan)
+            else:
+                gevent.sleep(interval)
+                interval = min(interval * 2, self.rescan)
+
+    def stop(self, deadline=None):
+        for t in self.tails.values():
             t.kill()
             t.join()
-        super(File, self).stop()
+        if self.checkpointer:
+            self.checkpointer.kill()
+            # the offsets are of the lines already put onto the output
+            self.registry.save(self.tails.values())
+        if self.watcher:
+            self.watcher.close()
+        # so if restarted (a reload failed), the files are tailed again
+        self.tails = {}
+        self.missing = {}
+        super(File, self).stop(deadline)
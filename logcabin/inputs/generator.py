@@ -0,0 +1,146 @@
+import copy
+import time
+import random
+import datetime
+import gevent
+
+from ..event import Event
+from ..util import ConfigException
+from .. import trace
+from .input import Input
+
+def _check_template(template):
+    """Format the template strings once, so those with fields other than {n}
+    and {r} (eg. a literal '{') fail on configuration, not in the greenlet."""
+    for k, v in template.iteritems():
+        if isinstance(v, basestring) and '{' in v:
+            try:
+                v.format(n=0, r=0)
+            except (KeyError, IndexError, ValueError, AttributeError) as ex:
+                raise ConfigException('invalid template value for %s: %r (%s)' % (k, v, ex))
+
+class Generator(Input):
+    """Generates synthetic events, for load testing a pipeline.
+
+    Events are created either from a template, or by replaying the lines of a
+    sample file in a loop (as the field 'data', like the File input).
+
+    Template values may be callables, called with the event number, or strings
+    formatted with {n} - the event number - and {r} - a random number below
+    cardinality. Other values are copied into each event.
+
+    Events are generated at a target rate, ramped up from zero over ramp
+    seconds if given. With rate=None they are generated as fast as possible:
+    only as fast as the pipeline takes them if the next stage has a max_queue,
+    otherwise its queue grows without bound. Every report seconds the achieved
+    and target rates are logged: when the pipeline is saturated, the achieved
+    rate falls short of the target.
+
+    :param map template: fields of the events to generate
+    :param string sample: file of sample lines to replay
+    :param float rate: target events per second, or None for as fast as
+      possible (default: 1000)
+    :param float ramp: seconds to ramp up to the target rate (optional)
+    :param integer count: number of events to generate (default: unlimited)
+    :param integer cardinality: number of distinct values of {r} (default: 100)
+    :param float jitter: randomize the timestamps up to this many seconds into
+      the past (default: 0)
+    :param float report: interval between reports of the rate, in seconds
+      (default: 10)
+
+    Example::
+
+        Generator(template={'host': 'web{r}', 'message': 'request {n}'},
+            cardinality=20, rate=5000, ramp=60)
+        Generator(sample='sample.log', rate=1000)
+    """
+
+    # events generated between yielding to other greenlets
+    CHUNK = 100
+
+    def __init__(self, template=None, sample=None, rate=1000, ramp=None, count=None,
+            cardinality=100, jitter=0, report=10, **kwargs):
+        if (template is None) == (sample is None):
+            raise ValueError('one of template or sample is required')
+        if ramp and not rate:
+            raise ValueError('ramp requires a target rate')
+        if template is not None:
+            _check_template(template)
+        super(Generator, self).__init__(**kwargs)
+        self.template = template
+        self.sample = sample
+        self.rate = rate
+        self.ramp = ramp
+        self.count = count
+        self.cardinality = cardinality
+        self.jitter = jitter
+        self.report = report
+        self.sent = 0
+
+    def _due(self, elapsed):
+        """The number of events due to have been generated after elapsed
+        seconds, at the target rate."""
+        if self.ramp and elapsed < self.ramp:
+            return self.rate * elapsed * elapsed / (2.0 * self.ramp)
+        if self.ramp:
+            return self.rate * (elapsed - self.ramp / 2.0)
+        return self.rate * elapsed
+
+    def _factory(self):
+        """Return a function creating the nth event."""
+        if self.sample:
+            lines = [line.rstrip('\n') for line in file(self.sample)]
+            if not lines:
+                raise ValueError('sample file is empty: %s' % self.sample)
+            return lambda n: Event(data=lines[n % len(lines)])
+
+        fields = []
+        for k, v in self.template.iteritems():
+            if callable(v):
+                fields.append((k, v))
+            elif isinstance(v, basestring) and '{' in v:
+                fields.append((k, lambda n, v=v: v.format(n=n, r=random.randrange(self.cardinality))))
+            elif isinstance(v, (dict, list)):
+                fields.append((k, lambda n, v=v: copy.deepcopy(v)))
+            else:
+                fields.append((k, lambda n, v=v: v))
+
+        def create(n):
+            ev = Event((k, f(n)) for k, f in fields)
+            if self.jitter:
+                ev.timestamp -= datetime.timedelta(seconds=random.uniform(0, self.jitter))
+            return ev
+        return create
+
+    def _run(self):
+        create = self._factory()
+        start = last = time.time()
+        last_sent = last_due = 0
+        while self.count is None or self.sent < self.count:
+            now = time.time()
+            if self.rate:
+                due = int(self._due(now - start))
+                if self.sent >= due:
+                    gevent.sleep(min(0.01, (self.sent + 1 - due) / float(self.rate)))
+                    continue
+                n = min(due - self.sent, self.CHUNK)
+            else:
+                due = None
+                n = self.CHUNK
+            if self.count is not None:
+                n = min(n, self.count - self.sent)
+
+            for i in xrange(n):
+                self.output.put(trace.stamp(create(self.sent)))
+                self.sent += 1
+            gevent.sleep() # yield for other stages
+
+            if now - last >= self.report:
+                achieved = (self.sent - last_sent) / (now - last)
+                if due is None:
+                    self.logger.info('Generated %.1f/s' % achieved)
+                else:
+                    self.logger.info('Generated %.1f/s, target %.1f/s' % (
+                        achieved, (due - last_due) / (now - last)))
+                last, last_sent, last_due = now, self.sent, due
+        self.logger.info('Generated %d events' % self.sent)
@@ -0,0 +1,236 @@
+import time
+import gevent.server
+import gevent.pool
+import gevent.socket
+
+from ..common import DRAIN_TIMEOUT
+from ..event import Event
+from ..util import Batch, put_events
+from .. import trace
+from .input import Input
+
+class LineFramer(object):
+    """Splits a stream into messages separated by newlines.
+
+    Messages longer than max_line bytes are truncated, the rest of them being
+    skipped, so at most max_line bytes are buffered.
+
+    >>> f = LineFramer(4)
+    >>> f.feed('ab\\ncd'), f.feed('e\\nfghij'), f.feed('k\\nl'), f.end()
+    (['ab'], ['cde', 'fghi'], [], ['l'])
+    >>> f.truncated
+    1
+    """
+
+    def __init__(self, max_line):
+        self.max_line = max_line
+        self.partial = ''
+        self.skipping = False
+        self.truncated = 0
+
+    def feed(self, data):
+        """Return the complete messages, with data appended to the stream."""
+        if self.skipping:
+            n = data.find('\n')
+            if n < 0:
+                return []
+            data = data[n + 1:]
+            self.skipping = False
+        data = self.partial + data
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        if len(data) > self.max_line:
+            # some of the lines may be too long
+            for n, line in enumerate(lines):
+                if len(line) > self.max_line:
+                    lines[n] = line[:self.max_line]
+                    self.truncated += 1
+            if len(self.partial) > self.max_line:
+                lines.append(self.partial[:self.max_line])
+                self.truncated += 1
+                self.partial = ''
+                self.skipping = True
+        return lines
+
+    def end(self):
+        """Return the incomplete last message at the end of the stream."""
+        partial, self.partial = self.partial, ''
+        return [partial] if partial else []
+
+class OctetFramer(object):
+    """Splits a stream into octet counted messages (RFC 6587): each is
+    preceded by its length in bytes, then a space.
+
+    Messages longer than max_line bytes are truncated, the rest of them being
+    skipped. Raises ValueError if the framing is invalid.
+
+    >>> f = OctetFramer(4)
+    >>> f.feed('2 ab3 c'), f.feed('de6 fghi'), f.feed('jk1 l'), f.end()
+    (['ab'], ['cde', 'fghi'], ['l'], [])
+    >>> f.feed('x')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid octet count: 'x'
+    """
+
+    # digits of the longest valid octet count
+    DIGITS = 10
+
+    def __init__(self, max_line):
+        self.max_line = max_line
+        self.partial = ''
+        self.skip = 0
+        self.truncated = 0
+
+    def feed(self, data):
+        """Return the complete messages, with data appended to the stream."""
+        if self.skip:
+            n = min(self.skip, len(data))
+            data = data[n:]
+            self.skip -= n
+        data = self.partial + data
+        messages = []
+        pos = 0
+        while pos < len(data):
+            space = data.find(' ', pos, pos + self.DIGITS + 1)
+            if space < 0:
+                if len(data) - pos > self.DIGITS or not data[pos:].isdigit():
+                    raise ValueError('invalid octet count: %r' % data[pos:pos + self.DIGITS])
+                break
+            count = data[pos:space]
+            if not count.isdigit():
+                raise ValueError('invalid octet count: %r' % count)
+            length = int(count)
+            if length > self.max_line:
+                if len(data) - space - 1 < self.max_line:
+                    break
+                messages.append(data[space + 1:space + 1 + self.max_line])
+                self.truncated += 1
+                end = space + 1 + length
+                self.skip = max(end - len(data), 0)
+                pos = min(end, len(data))
+                continue
+            end = space + 1 + length
+            if end > len(data):
+                break
+            messages.append(data[space + 1:end])
+            pos = end
+        self.partial = data[pos:]
+        return messages
+
+    def end(self):
+        """An incomplete last message at the end of the stream is dropped."""
+        self.partial = ''
+        return []
+
+FRAMING = {
+    'newline': LineFramer,
+    'octet': OctetFramer,
+}
+
+class Tcp(Input):
+    """Receives messages over tcp connections.
+
+    Creates events with the field 'data' set to each message received, framed
+    either by newlines, or by octet counts as in RFC 6587 (syslog over tcp).
+
+    Each connection is read in large blocks, split into messages in bulk, and
+    the messages put onto the output together. While the output is full, the
+    connections aren't read, so clients are slowed down by tcp flow control
+    rather than the messages being buffered without limit.
+
+    On stop, connections are no longer accepted, and those open are closed
+    once the data already received from them has been read, the incomplete
+    last message of each included, within the drain deadline.
+
+    :param integer port: listening port
+    :param string framing: newline or octet (default: newline)
+    :param integer max_line: maximum length of messages in bytes, longer
+      messages are truncated (default: 1048576)
+    :param integer max_connections: maximum number of concurrent connections,
+      others wait to be accepted (default: 10000)
+
+    Example::
+
+        Tcp(port=5140)
+        Tcp(port=6514, framing='octet', max_line=65536)
+    """
+
+    # bytes read at a time
+    BLOCK = 1 << 16
+
+    def __init__(self, port, framing='newline', max_line=1 << 20, max_connections=10000, **kwargs):
+        if framing not in FRAMING:
+            raise ValueError('framing should be newline or octet')
+        super(Tcp, self).__init__(**kwargs)
+        self.port = port
+        self.framing = framing
+        self.max_line = max_line
+        self.max_connections = max_connections
+        self.listener = None
+        self.server = None
+        # sockets of the open connections
+        self.connections = set()
+
+    def takeover(self, old):
+        if self.port == old.port and old.server is not None:
+            # share the listening socket, so no connections are refused
+            self.listener = old.server.socket.dup()
+
+    def handback(self, old):
+        # the old pipeline listens on its own socket, or rebinds the port
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def start(self):
+        self.server = gevent.server.StreamServer(self.listener or ('', self.port), self._handle,
+            spawn=gevent.pool.Pool(self.max_connections))
+        self.server.start()
+        super(Tcp, self).start()
+
+    def stop(self, deadline=None):
+        super(Tcp, self).stop(deadline)
+        if deadline is None:
+            deadline = time.time() + DRAIN_TIMEOUT
+        # the handlers read what was received, then reach the end of the
+        # stream, rather than waiting on clients for more
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(gevent.socket.SHUT_RD)
+            except gevent.socket.error:
+                pass
+        # handlers still running at the deadline (eg. blocked on a full
+        # output) are killed
+        self.server.stop(timeout=max(deadline - time.time(), 0))
+        self.listener = None
+
+    def _handle(self, sock, address):
+        peer = '%s:%d' % address[:2]
+        self.logger.debug('Connected: %s' % peer)
+        framer = FRAMING[self.framing](self.max_line)
+        self.connections.add(sock)
+        try:
+            while True:
+                data = sock.recv(self.BLOCK)
+                if not data:
+                    self._put(framer.end())
+                    break
+                truncated = framer.truncated
+                # blocks while the output is full, so reading pauses
+                self._put(framer.feed(data))
+                if framer.truncated > truncated:
+                    self.logger.warn('Truncated %d messages over %d bytes from %s' % (
+                        framer.truncated - truncated, self.max_line, peer))
+        except ValueError as ex:
+            self.logger.warn('Closing connection from %s: %s' % (peer, ex))
+        except gevent.socket.error as ex:
+            self.logger.debug('Connection error from %s: %s' % (peer, ex))
+        finally:
+            self.connections.discard(sock)
+            sock.close()
+            self.logger.debug('Disconnected: %s' % peer)
+
+    def _put(self, messages):
+        if messages:
+            put_events(self.output, Batch(trace.stamp(Event(data=m)) for m in messages))
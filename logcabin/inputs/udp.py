@@ -1,31 +1,143 @@
+import os
+import sys
+import errno
 import gevent
 import gevent.socket
+from gevent.socket import wait_read
 
 from ..event import Event
+from ..util import Batch, put_events
+from .. import trace
 from .input import Input
 
+# files listing the udp sockets of the system, with their kernel counters
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+def socket_stats(sock, paths=PROC_NET_UDP):
+    """Return the bytes queued to be received by a udp socket, and the number
+    of packets the kernel dropped as the queue was full, or None if they're
+    unavailable (eg. not on Linux)."""
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in paths:
+        try:
+            lines = file(path).readlines()
+        except IOError:
+            continue
+        for line in lines[1:]:
+            fields = line.split()
+            # sl local rem st tx_queue:rx_queue tr:tm retrnsmt uid timeout inode ref pointer drops
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[4].split(':')[1], 16), int(fields[12])
+    return None
+
 class Udp(Input):
     """Receives from a udp port.
 
     Creates events with the field 'data' set to the packet received.
 
+    Pending packets are received together into a reused buffer, yielding to
+    the other stages once for the lot rather than after each. The packets
+    dropped by the kernel as the receive buffer was full are exposed as the
+    logcabin_udp_drops_total metric.
+
     :param integer port: listening port
+    :param integer max_size: maximum size of packets in bytes, larger packets
+      are truncated (default: 65535)
+    :param integer rcvbuf: size of the kernel receive buffer in bytes, to hold
+      bursts (default: the system default)
+    :param boolean reuseport: bind with SO_REUSEPORT, so several processes
+      can share the port (default: false)
 
     Example::
 
         Udp(port=6000)
+        Udp(port=6000, rcvbuf=8388608, reuseport=True)
     """
 
-    def __init__(self, port):
-        super(Udp, self).__init__()
+    # packets received before yielding
+    DRAIN = 1000
+
+    def __init__(self, port, max_size=65535, rcvbuf=None, reuseport=False, **kwargs):
+        if reuseport and not hasattr(gevent.socket, 'SO_REUSEPORT'):
+            raise ValueError('reuseport is not supported on this platform')
+        super(Udp, self).__init__(**kwargs)
         self.port = port
-        self.sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_DGRAM)
-        self.sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_BROADCAST, 1)
-        self.sock.bind(('', self.port))
+        self.max_size = max_size
+        self.rcvbuf = rcvbuf
+        self.reuseport = reuseport
+        self.sock = None
+
+    def takeover(self, old):
+        if self.port == old.port:
+            # reuse the bound socket, so no packets are missed
+            self.sock = old.sock
+            old.sock = None
+
+    def handback(self, old):
+        if self.sock is None:
+            return
+        if old.sock is None and self.port == old.port:
+            old.sock = self.sock
+        else:
+            self.sock.close()
+        self.sock = None
+
+    def start(self):
+        if self.sock is None:
+            self.sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_DGRAM)
+            self.sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_BROADCAST, 1)
+            if self.reuseport:
+                self.sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEPORT, 1)
+            if self.rcvbuf:
+                self.sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_RCVBUF, self.rcvbuf)
+                # linux doubles the size asked for (for its bookkeeping), after
+                # capping it to net.core.rmem_max
+                size = self.sock.getsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_RCVBUF)
+                if sys.platform.startswith('linux'):
+                    size /= 2
+                if size < self.rcvbuf:
+                    self.logger.warn('Receive buffer limited to %d bytes, raise net.core.rmem_max' % size)
+            self.sock.bind(('', self.port))
+        super(Udp, self).start()
+
+    def stop(self, deadline=None):
+        super(Udp, self).stop(deadline)
+        # close, unless handed over to a new pipeline
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def socket_stats(self):
+        """Return (bytes queued, packets dropped) of the socket, or None."""
+        if self.sock is None:
+            return None
+        return socket_stats(self.sock)
+
+    def _recv(self, sock, buf):
+        """Wait for a packet, then receive any others pending."""
+        view = memoryview(buf)
+        packets = []
+        wait_read(sock.fileno())
+        while len(packets) < self.DRAIN:
+            try:
+                n = sock.recv_into(buf)
+            except gevent.socket.error as ex:
+                if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+            packets.append(view[:n].tobytes())
+        return packets
 
     def _run(self):
+        sock = self.sock
+        # receive without waiting, as _recv waits for the socket first
+        sock.setblocking(0)
+        buf = bytearray(self.max_size)
         while True:
-            data = self.sock.recv(4096)
-            self.logger.debug('Received: %r' % data)
-            self.output.put(Event(data=data))
+            events = Batch()
+            for data in self._recv(sock, buf):
+                self.logger.debug('Received: %r', data)
+                events.append(trace.stamp(Event(data=data)))
+            if events:
+                put_events(self.output, events)
             gevent.sleep() # yield for other stages
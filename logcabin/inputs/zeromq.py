@@ -1,44 +1,129 @@
 from ..event import Event
+from ..util import Batch, put_events
+from .. import trace
+from .. import transport
 from .input import Input
 import gevent
 import zmq.green as zmq
 
+def set_hwm(sock, option, hwm):
+    """Set the high water mark of a socket, on any version of zeromq."""
+    if hasattr(zmq, option):
+        sock.setsockopt(getattr(zmq, option), hwm)
+    else:
+        sock.setsockopt(zmq.HWM, hwm)
+
 class Zeromq(Input):
     """Receives from a zeromq socket.
 
-    Creates events with the field 'data' set to the packet received.
+    With the raw format, creates events with the field 'data' set to the
+    packet received. With the msgpack format, receives the batches of events
+    sent by the Zeromq output in that format (any other packets are still
+    received as raw).
+
+    Pending packets are received together, yielding to the other stages once
+    for the lot rather than after each.
 
     :param string address: zeromq address to bind on (default: `tcp://*:2120`)
     :param string mode: connect or bind (default: bind)
     :param string socket: PULL or SUB (default: PULL)
+    :param string format: raw or msgpack (default: raw)
+    :param integer hwm: high water mark, the number of packets queued by the
+      socket (default: the zeromq default)
 
     Example::
 
         Zeromq(address='tcp://*:2121', mode='bind', socker='PULL')
+        Zeromq(address='tcp://*:2122', format='msgpack', hwm=1000)
     """
-    def __init__(self, address='tcp://*:2120', mode='bind', socket='PULL'):
+
+    # packets received before yielding
+    DRAIN = 1000
+
+    def __init__(self, address='tcp://*:2120', mode='bind', socket='PULL', format='raw',
+            hwm=None, **kwargs):
         if mode not in ('connect', 'bind'):
             raise ValueError('mode should be connect or bind')
         if socket not in ('PULL', 'SUB'):
             raise ValueError('socket should be PULL or SUB')
-        super(Zeromq, self).__init__()
-        self.ctx = zmq.Context()
-        self.sock = self.ctx.socket(getattr(zmq, socket))
+        if format not in ('raw', 'msgpack'):
+            raise ValueError('format should be raw or msgpack')
+        if format == 'msgpack':
+            transport._require_msgpack()
+        super(Zeromq, self).__init__(**kwargs)
         self.address = address
-        if address == 'tcp://*':
-            self.sock.bind_to_random_port(address)
-        elif mode == 'connect':
-            self.sock.connect(self.address)
+        self.mode = mode
+        self.socket = socket
+        self.format = format
+        self.hwm = hwm
+        self.sock = None
+
+    def takeover(self, old):
+        if (self.address, self.mode, self.socket) == (old.address, old.mode, old.socket):
+            # reuse the socket, so no messages are missed
+            self.ctx, self.sock = old.ctx, old.sock
+            old.sock = None
+
+    def handback(self, old):
+        if self.sock is None:
+            return
+        if old.sock is None and (self.address, self.mode, self.socket) == \
+                (old.address, old.mode, old.socket):
+            old.ctx, old.sock = self.ctx, self.sock
         else:
-            self.sock.bind(self.address)
+            self.sock.close()
+        self.sock = None
+
+    def start(self):
+        if self.sock is None:
+            self.ctx = zmq.Context()
+            self.sock = self.ctx.socket(getattr(zmq, self.socket))
+            if self.hwm is not None:
+                set_hwm(self.sock, 'RCVHWM', self.hwm)
+            if self.address == 'tcp://*':
+                self.sock.bind_to_random_port(self.address)
+            elif self.mode == 'connect':
+                self.sock.connect(self.address)
+            else:
+                self.sock.bind(self.address)
+        super(Zeromq, self).start()
+
+    def _recv(self, sock):
+        """Wait for a packet, then receive any others pending."""
+        packets = [sock.recv()]
+        while len(packets) < self.DRAIN:
+            try:
+                packets.append(sock.recv(zmq.NOBLOCK))
+            except zmq.ZMQError as ex:
+                if ex.errno != zmq.EAGAIN:
+                    raise
+                break
+        return packets
+
+    def _events(self, data):
+        if self.format == 'msgpack':
+            try:
+                events = transport.decode(data)
+            except ValueError as ex:
+                self.logger.warn('Dropped packet: %s' % ex)
+                return []
+            if events is not None:
+                return [trace.stamp(event) for event in events]
+        return [trace.stamp(Event(data=data))]
 
     def _run(self):
+        sock = self.sock
         try:
             while True:
-                data = self.sock.recv()
-                self.logger.debug('Received: %r' % data)
-                self.output.put(Event(data=data))
+                events = Batch()
+                for data in self._recv(sock):
+                    self.logger.debug('Received: %r', data)
+                    events.extend(self._events(data))
+                if events:
+                    put_events(self.output, events)
                 gevent.sleep() # yield for other stages
         finally:
-            # cleanup
-            self.sock.close()
+            # cleanup, unless handed over to a new pipeline
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
@@ -0,0 +1,133 @@
+import bisect
+import logging
+from gevent.pywsgi import WSGIServer
+
+class Histogram(object):
+    """Cumulative histogram of observed values, with fixed bucket bounds."""
+
+    # processing times, in seconds
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+        0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, n=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += n
+        self.sum += value * n
+        self.count += n
+
+    def cumulative(self):
+        """Yield (upper bound, count of values <= bound), ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+class StageMetrics(object):
+    """Counters of the events processed by a stage."""
+
+    def __init__(self):
+        self.events_in = 0
+        self.events_out = 0
+        self.errors = 0
+        self.processing = Histogram()
+
+def _label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _bound(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def render(pipeline):
+    """Render the metrics of every stage in the pipeline, in the prometheus
+    text exposition format."""
+    from common import ProcessingStage
+
+    stages = [(path, s) for path, s in pipeline.walk()
+        if isinstance(s, ProcessingStage)]
+    counters = [
+        ('events_in_total', 'counter', 'Events received by the stage.',
+            lambda s: s.stage_metrics.events_in),
+        ('events_out_total', 'counter', 'Events passed on by the stage.',
+            lambda s: s.stage_metrics.events_out),
+        ('errors_total', 'counter', 'Events the stage failed to process.',
+            lambda s: s.stage_metrics.errors),
+        ('dropped_total', 'counter', 'Events dropped from the full input queue of the stage.',
+            lambda s: s.input.dropped),
+        ('queue_depth', 'gauge', 'Items waiting on the input queue of the stage.',
+            lambda s: s.input.qsize() + getattr(s.input, 'spilled', 0)),
+    ]
+
+    lines = []
+    for name, kind, doc, value in counters:
+        lines.append('# HELP logcabin_stage_%s %s' % (name, doc))
+        lines.append('# TYPE logcabin_stage_%s %s' % (name, kind))
+        for path, s in stages:
+            lines.append('logcabin_stage_%s{stage="%s"} %s' % (name, _label(path), value(s)))
+
+    name = 'logcabin_stage_processing_seconds'
+    lines.append('# HELP %s Time taken by the stage to process each event.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for path, s in stages:
+        h = s.stage_metrics.processing
+        for bound, count in h.cumulative():
+            lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, _label(path), _bound(bound), count))
+        lines.append('%s_sum{stage="%s"} %r' % (name, _label(path), h.sum))
+        lines.append('%s_count{stage="%s"} %d' % (name, _label(path), h.count))
+
+    name = 'logcabin_switch_hits_total'
+    lines.append('# HELP %s Events taken by each case of the switch.' % name)
+    lines.append('# TYPE %s counter' % name)
+    for path, s in stages:
+        for n, hits in enumerate(getattr(s, 'hits', ())):
+            lines.append('%s{stage="%s",case="case[%d]"} %d' % (name, _label(path), n, hits))
+
+    # (bytes queued, packets dropped) of the sockets of udp inputs
+    sockets = [(path, s.socket_stats()) for path, s in pipeline.walk()
+        if hasattr(s, 'socket_stats')]
+    sockets = [(path, stats) for path, stats in sockets if stats is not None]
+    gauges = [
+        ('udp_receive_queue_bytes', 'gauge', 'Bytes waiting in the receive buffer of the socket.', 0),
+        ('udp_drops_total', 'counter', 'Packets dropped by the kernel as the receive buffer was full.', 1),
+    ]
+    for name, kind, doc, n in gauges:
+        lines.append('# HELP logcabin_%s %s' % (name, doc))
+        lines.append('# TYPE logcabin_%s %s' % (name, kind))
+        for path, stats in sockets:
+            lines.append('logcabin_%s{stage="%s"} %d' % (name, _label(path), stats[n]))
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsServer(object):
+    """HTTP server exposing the metrics of the pipeline stages on /metrics.
+
+    :param pipeline: the pipeline
+    :param integer port: listening port
+    """
+
+    def __init__(self, pipeline, port):
+        self.logger = logging.getLogger('MetricsServer')
+        self.pipeline = pipeline
+        self.port = port
+        self.server = WSGIServer(('', port), self._handle, log=None)
+
+    def _handle(self, environ, start_response):
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found\n']
+        body = render(self.pipeline)
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [body]
+
+    def start(self):
+        self.server.start()
+        self.logger.info('Serving metrics on port %d' % self.port)
+
+    def stop(self):
+        self.server.stop()
@@ -1,4 +1,5 @@
 from .output import Output
+from ..template import Template
 import gevent
 import gevent.monkey
 gevent.monkey.patch_socket()
@@ -21,17 +22,19 @@ class Elasticsearch(Output):
 
     RETRIES = 10
 
-    def __init__(self, index, type, host='localhost', port=9200):
-        super(Elasticsearch, self).__init__()
+    def __init__(self, index, type, host='localhost', port=9200, **kwargs):
+        super(Elasticsearch, self).__init__(**kwargs)
         self.host = host
         self.port = port
         self.index = index
         self.type = type
+        self.index_template = Template(index)
+        self.type_template = Template(type)
 
     def process(self, event):
         data = event.to_json()
-        index = event.format(self.index)
-        itype = event.format(self.type)
+        index = self.index_template.format(event)
+        itype = self.type_template.format(event)
         if not index:
             raise ValueError("index is empty")
         if not itype:
@@ -4,6 +4,7 @@ import gevent
 import subprocess
 import datetime
 from ..event import Event
+from ..template import Template
 from ..util import Periodic
 
 class File(Output):
@@ -26,9 +27,10 @@ class File(Output):
 
         File(filename='mylogs.log', max_size=10, compress='gz')
     """
-    def __init__(self, filename, max_size=None, max_count=10, compress=None):
-        super(File, self).__init__()
+    def __init__(self, filename, max_size=None, max_count=10, compress=None, **kwargs):
+        super(File, self).__init__(**kwargs)
         self.filename = filename
+        self.template = Template(filename)
         self.max_size = max_size
         self.max_count = max_count
         if compress is True:
@@ -39,6 +41,8 @@ class File(Output):
         self.compress = compress
         self.last_filename = None
         self.last_event = None
+        # stage replaced on a reload, which checks rotation until this starts
+        self.previous = None
 
         if 'timestamp' in self.filename:
             # if the log file name is timestamped, periodically check if it has
@@ -54,19 +58,38 @@ class File(Output):
             self._rotate(self.last_filename, self.last_event, self.last_event)
             self.last_filename = filename 
 
+    def takeover(self, old):
+        super(File, self).takeover(old)
+        if self.filename == old.filename:
+            self.last_filename = old.last_filename
+            self.last_event = old.last_event
+            self.previous = old
+
+    def handback(self, old):
+        if old.periodic is not None and old.periodic.dead:
+            # killed when this started
+            old.periodic = Periodic(old.periodic.period, old._check_rotate)
+            old.periodic.start()
+
     def start(self):
         super(File, self).start()
+        if self.previous is not None:
+            # leave checking for rotation to the new stage
+            if self.previous.periodic is not None:
+                self.previous.periodic.kill()
+            self.last_filename = self.previous.last_filename
+            self.last_event = self.previous.last_event
         if self.periodic is not None:
             self.periodic.start()
 
-    def stop(self):
+    def stop(self, deadline=None):
         if self.periodic is not None:
             self.periodic.kill()
             self.periodic.join()
-        super(File, self).stop()
+        super(File, self).stop(deadline)
 
     def process(self, event):
-        filename = event.format(self.filename)
+        filename = self.template.format(event)
         if self.max_size and os.path.exists(filename) and os.path.getsize(filename) > self.max_size:
             self._rotate(filename, self.last_event, event)
 
@@ -17,8 +17,8 @@ class Graphite(Output):
         Graphite(host='graphite')
     """
 
-    def __init__(self, host='localhost', port=2004):
-        super(Graphite, self).__init__()
+    def __init__(self, host='localhost', port=2004, **kwargs):
+        super(Graphite, self).__init__(**kwargs)
         self.host = host
         self.port = port
         self._metrics = []
@@ -9,8 +9,8 @@ class Log(Output):
 
         Log(message="event:")
     """
-    def __init__(self, message=''):
-        super(Log, self).__init__()
+    def __init__(self, message='', **kwargs):
+        super(Log, self).__init__(**kwargs)
         self.message = message
         if message:
             self.message += ' '
@@ -14,8 +14,8 @@ class Mongodb(Output):
         Mongodb(host="mongodb", database="logs")
     """
 
-    def __init__(self, host='localhost', port=27017, database='test', collection='events'):
-        super(Mongodb, self).__init__()
+    def __init__(self, host='localhost', port=27017, database='test', collection='events', **kwargs):
+        super(Mongodb, self).__init__(**kwargs)
         self.host = host
         self.port = port
         self.database = database
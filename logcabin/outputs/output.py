@@ -1,4 +1,77 @@
-from ..common import ProcessingStage
+import time
+import gevent
+
+from ..common import ProcessingStage, DRAIN_TIMEOUT
+from ..spool import SpoolQueue
+from .. import trace
 
 class Output(ProcessingStage):
-    pass
+    """Base class for outputs.
+
+    Common parameters to outputs:
+    :param string spool: directory to spool queued events to when the output
+      falls behind (optional). Events still queued on shutdown are kept here,
+      and sent on the next start.
+    :param integer spool_memory: number of queued events held in memory before
+      spooling to disk (default: 10000)
+    """
+
+    def __init__(self, spool=None, spool_memory=10000, **kwargs):
+        super(Output, self).__init__(**kwargs)
+        self.spool = spool
+        self.spool_memory = spool_memory
+        self.spool_queue = None
+        self.handed_over = False
+        # stage replaced on a reload, whose spool this shares
+        self.spool_owner = None
+
+    def takeover(self, old):
+        if self.spool and self.spool == old.spool:
+            # share the spool, rather than both using its files
+            self.spool_queue = old.spool_queue
+            self.spool_owner = old
+
+    def start(self):
+        super(Output, self).start()
+        if self.spool_owner is not None:
+            self.spool_owner.handed_over = True
+
+    def setup(self, q):
+        if not self.spool:
+            return super(Output, self).setup(q)
+        self.output = q
+        if self.spool_queue is None:
+            self.spool_queue = SpoolQueue(self.spool, self.spool_memory)
+        self.input = self.spool_queue
+        return self.input
+
+    def stop(self, deadline=None):
+        owner = self.spool_owner
+        if owner is not None and not owner.stopping:
+            # a reload failed after this started: the old output carries on
+            # consuming the spool, so it isn't closed
+            owner.handed_over = False
+            return self._stop_shared(deadline)
+        if not self.handed_over:
+            return super(Output, self).stop(deadline)
+        # the replacement output carries on consuming the spool
+        self._stop_shared(deadline)
+
+    def _stop_shared(self, deadline):
+        """Stop consuming a spool another output consumes too, just waiting for
+        any events being processed."""
+        if deadline is None:
+            deadline = time.time() + DRAIN_TIMEOUT
+        metrics = self.stage_metrics
+        with gevent.Timeout(max(deadline - time.time(), 0), False):
+            while metrics.events_in > metrics.processing.count:
+                gevent.sleep(0.01)
+        self.stopping = True
+        gevent.killall([self.g] + self.consumers, block=True)
+        self.logger.debug('Stopped, leaving the spool open')
+
+    def _done(self, events, start, dequeued):
+        super(Output, self)._done(events, start, dequeued)
+        if dequeued is not None:
+            # the output is done with the events, so they are complete
+            trace.complete(events, trace.now())
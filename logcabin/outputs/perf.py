@@ -2,27 +2,47 @@ import time
 import gevent
 
 from .output import Output
+from ..common import ProcessingStage
+from .. import trace
 
 class Perf(Output):
     """Simple performance counter output.
 
+    With tracing enabled (the --trace option), this also reports the p50, p99
+    and max latency of events from input to being done with by an output, and
+    the time spent queued for and processed in each stage. Place it after the
+    outputs in a sequence to include them, eg.::
+
+        Elasticsearch()
+        Perf()
+
     :param integer period: interval between reports in seconds
 
     Example::
 
         Perf(period=5)
     """
-    def __init__(self, period=60):
-        super(Perf, self).__init__()
+    def __init__(self, period=60, **kwargs):
+        super(Perf, self).__init__(**kwargs)
         self.period = period
         self.now = time.time()
         self.count = 0
+        self.latency = trace.Latency()
+        self.reporter = None
 
     def start(self):
         super(Perf, self).start()
+        trace.collectors.append(self.latency)
 
         # spawn additional greenlet to do periodic reporting
-        gevent.spawn(self._report)
+        self.reporter = gevent.spawn(self._report)
+
+    def stop(self, deadline=None):
+        if self.reporter is not None:
+            self.reporter.kill()
+            self.reporter = None
+        super(Perf, self).stop(deadline)
+        trace.collectors.remove(self.latency)
 
     def _report(self):
         while True:
@@ -32,8 +52,16 @@ class Perf(Output):
             if self.count > 0:
                 self.logger.info('%d in %ds (%.1f/s)' % (
                     self.count, now-self.now, self.count/(now-self.now)))
+            if self.latency.total:
+                for name, values in self.latency.summary():
+                    self.logger.info('%s: p50=%.1fms p99=%.1fms max=%.1fms' % (
+                        (name,) + tuple(v * 1000 for v in values)))
             self.now = now
             self.count = 0
 
+    def _done(self, events, start, dequeued):
+        # only counts events, so isn't counted as an output done with them
+        ProcessingStage._done(self, events, start, dequeued)
+
     def process(self, event):
         self.count += 1
@@ -2,6 +2,8 @@ from .output import Output
 import boto
 import boto.s3.key
 
+from ..template import Template
+
 class S3(Output):
     """Uploads to an S3 bucket.
 
@@ -22,16 +24,18 @@ class S3(Output):
     :param string path: the path
     """
 
-    def __init__(self, access_key, secret_key, bucket, path):
-        super(S3, self).__init__()
+    def __init__(self, access_key, secret_key, bucket, path, **kwargs):
+        super(S3, self).__init__(**kwargs)
         self.access_key = access_key
         self.secret_key = secret_key
         self.bucket = bucket
         self.path = path
+        self.bucket_template = Template(bucket)
+        self.path_template = Template(path)
 
     def process(self, event):
-        bucket = event.format(self.bucket)
-        path = event.format(self.path)
+        bucket = self.bucket_template.format(event)
+        path = self.path_template.format(event)
 
         filename = event['filename']
         self.logger.info('Uploading %s to s3://%s/%s' % (filename, bucket, path))
@@ -1,5 +1,46 @@
 from flow import Sequence
+from inputs.input import Input
 
 class Pipeline(Sequence):
     def register(self):
         pass # noop
+
+    def setup(self, q):
+        ret = super(Pipeline, self).setup(q)
+        # name each stage by its position in the pipeline
+        for path, s in self.walk():
+            s.stage_path = path
+        return ret
+
+    def _matching(self, old):
+        """Yield (path, stage, old stage) for the stages matching those of the
+        old pipeline by their path and type."""
+        stages = dict(old.walk())
+        for path, s in self.walk():
+            o = stages.get(path)
+            if s is not self and type(o) is type(s):
+                yield path, s, o
+
+    def takeover(self, old):
+        """Take over the resources of the stages of the old pipeline."""
+        for path, s, o in self._matching(old):
+            self.logger.debug('Taking over %s' % path)
+            s.takeover(o)
+
+    def handback(self, old):
+        """Give back the resources taken over from the old pipeline, when this
+        one failed to set up or start."""
+        for path, s, o in self._matching(old):
+            s.handback(o)
+
+    def start_inputs(self):
+        """Restart the inputs stopped by stop_inputs()."""
+        for path, s in self.walk():
+            if isinstance(s, Input):
+                s.start()
+
+    def stop_inputs(self, deadline=None):
+        """Stop just the inputs, so no new events enter the pipeline."""
+        for path, s in self.walk():
+            if isinstance(s, Input):
+                s.stop(deadline)
@@ -0,0 +1,108 @@
+import os
+import time
+import signal
+import logging
+import collections
+import gevent
+
+class Profiler(object):
+    """Sampling profiler, attributing samples to the pipeline stages.
+
+    While running, the stack is sampled every interval seconds of cpu time.
+    Each sample is attributed to the innermost stage on the stack - so events
+    passed on to fused stages are counted against them - or else to the stage
+    whose greenlet was running.
+
+    :param pipeline: the pipeline
+    :param float interval: sampling interval, in seconds of cpu time
+    """
+
+    def __init__(self, pipeline, interval=0.005):
+        self.logger = logging.getLogger('Profiler')
+        self.pipeline = pipeline
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.running = False
+
+    def start(self):
+        self.stages = {}
+        self.greenlets = {}
+        for path, stage in self.pipeline.walk():
+            self.stages[id(stage)] = path
+            for g in [getattr(stage, 'g', None)] + getattr(stage, 'consumers', []):
+                if g is not None:
+                    self.greenlets[g] = path
+
+        self.samples.clear()
+        self.started = time.time()
+        self.running = True
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        # restart system calls the samples interrupt, rather than failing them
+        # with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+        signal.siginterrupt(signal.SIGPROF, True)
+        self.running = False
+        self.logger.info('Collected %d samples in %.1fs' % (
+            sum(self.samples.itervalues()), time.time() - self.started))
+
+    def _sample(self, signum, frame):
+        stack = []
+        path = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+            if path is None and code.co_argcount:
+                path = self.stages.get(id(frame.f_locals.get(code.co_varnames[0])))
+            frame = frame.f_back
+        if path is None:
+            path = self.greenlets.get(gevent.getcurrent(), 'other')
+        stack.reverse()
+        self.samples[(path, tuple(stack))] += 1
+
+    def collapsed(self):
+        """Yield the samples in the collapsed stack format used by
+        flamegraph.pl, rooted at the stage path."""
+        for (path, stack), count in sorted(self.samples.iteritems()):
+            yield '%s;%s %d' % (path, ';'.join(stack), count)
+
+    def report(self, top=20):
+        """Return a report of the functions using the most cpu in each stage."""
+        stages = collections.defaultdict(lambda: (collections.Counter(), collections.Counter()))
+        for (path, stack), count in self.samples.iteritems():
+            own, cumulative = stages[path]
+            own[stack[-1]] += count
+            for function in set(stack):
+                cumulative[function] += count
+
+        total = float(sum(self.samples.itervalues())) or 1.0
+        lines = []
+        for path, (own, cumulative) in sorted(stages.items(),
+                key=lambda (path, counters): -sum(counters[0].itervalues())):
+            samples = sum(own.itervalues())
+            lines.append('%s: %d samples (%.1f%%)' % (path, samples, 100 * samples / total))
+            lines.append('    %8s %8s  %s' % ('self', 'total', 'function'))
+            for function, count in own.most_common(top):
+                lines.append('    %7.1f%% %7.1f%%  %s' % (100 * count / total,
+                    100 * cumulative[function] / total, function))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write(self, directory):
+        """Write the collapsed stacks and report into directory, returning
+        their paths."""
+        name = time.strftime('profile-%Y%m%d-%H%M%S', time.localtime(self.started))
+        collapsed = os.path.join(directory, name + '.collapsed')
+        with file(collapsed, 'w') as fout:
+            for line in self.collapsed():
+                print >>fout, line
+        report = os.path.join(directory, name + '.txt')
+        with file(report, 'w') as fout:
+            fout.write(self.report())
+        self.logger.info('Wrote profile to %s and %s' % (collapsed, report))
+        return collapsed, report
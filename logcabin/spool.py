@@ -0,0 +1,218 @@
+import os
+import time
+import shutil
+import struct
+import logging
+import cPickle as pickle
+
+from util import StageQueue, count_events
+
+class SpoolQueue(StageQueue):
+    """A stage queue that spills to disk.
+
+    Up to memory events are held in memory. Beyond that, items are serialized
+    onto append-only segment files in directory, and read back in order as the
+    queue is consumed. Fully read segments are deleted.
+
+    close() writes any items still held in memory to disk, in front of the
+    spilled items, so the whole backlog is restored when a queue is next
+    created on the same directory. The read position is also checkpointed
+    every checkpoint seconds while reading back, so after a crash the items
+    already read aren't restored again (those read but still held in memory
+    are lost).
+    """
+
+    HEADER = struct.Struct('!L')
+
+    def __init__(self, directory, memory=10000, segment_size=16*1024*1024, checkpoint=5):
+        super(SpoolQueue, self).__init__()
+        self.logger = logging.getLogger('SpoolQueue')
+        self.directory = directory
+        self.memory = memory
+        self.segment_size = segment_size
+        self.checkpoint = checkpoint
+        self.checkpointed = time.time()
+        self.writer = None
+        self.reader = None
+        self.offset = 0
+        self.spilled = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.segments = self._list_segments()
+        events = self._load_position()
+        if self.spilled:
+            self.logger.info('Restored %d spooled events from %s' % (events, directory))
+        self._refill()
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            base, ext = os.path.splitext(name)
+            if ext == '.spool':
+                segments.append(int(base))
+        return sorted(segments)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '%d.spool' % segment)
+
+    def _position_path(self):
+        return os.path.join(self.directory, 'position')
+
+    def _load_position(self):
+        path = self._position_path()
+        if os.path.exists(path):
+            segment, offset = map(int, file(path).read().split())
+            # any earlier segments have already been consumed
+            while self.segments and self.segments[0] < segment:
+                os.unlink(self._segment_path(self.segments.pop(0)))
+            if self.segments and self.segments[0] == segment:
+                self.offset = offset
+
+        # count the records remaining, and the events in them
+        events = 0
+        for segment in self.segments:
+            with file(self._segment_path(segment), 'rb') as fin:
+                if segment == self.segments[0]:
+                    fin.seek(self.offset)
+                for data in self._records(fin):
+                    self.spilled += 1
+                    events += count_events(pickle.loads(data))
+        return events
+
+    def _save_position(self):
+        path = self._position_path()
+        segment = self.segments[0] if self.segments else 0
+        with file(path + '.tmp', 'w') as fout:
+            print >>fout, segment, self.offset
+        os.rename(path + '.tmp', path)
+        self.checkpointed = time.time()
+
+    def _records(self, fin):
+        """Read records from a segment file, up to the end of the last whole record."""
+        while True:
+            header = fin.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            length, = self.HEADER.unpack(header)
+            data = fin.read(length)
+            if len(data) < length:
+                return
+            yield data
+
+    def _write(self, fout, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        fout.write(self.HEADER.pack(len(data)))
+        fout.write(data)
+
+    def _spill(self, item):
+        if self.writer is None or self.writer.tell() >= self.segment_size:
+            if self.writer is not None:
+                self.writer.close()
+            segment = self.segments[-1] + 1 if self.segments else 0
+            self.segments.append(segment)
+            self.writer = file(self._segment_path(segment), 'ab')
+            self.logger.debug('Spooling to segment %d' % segment)
+        self._write(self.writer, item)
+        self.spilled += 1
+
+    def _read(self):
+        while True:
+            if self.writer is not None and len(self.segments) == 1:
+                # records of the segment being read may still be buffered
+                self.writer.flush()
+            if self.reader is None:
+                self.reader = file(self._segment_path(self.segments[0]), 'rb')
+                self.reader.seek(self.offset)
+
+            for data in self._records(self.reader):
+                self.offset = self.reader.tell()
+                self.spilled -= 1
+                if time.time() - self.checkpointed >= self.checkpoint:
+                    self._save_position()
+                return pickle.loads(data)
+
+            # segment exhausted, move onto the next
+            self.reader.close()
+            self.reader = None
+            if len(self.segments) == 1:
+                # ... unless it is still being written to
+                return None
+            os.unlink(self._segment_path(self.segments.pop(0)))
+            self.offset = 0
+
+    def _refill(self):
+        # read at least one item, so a get never waits while items are spilled
+        while self.spilled and (self.events < self.memory or not self.qsize()):
+            item = self._read()
+            if item is None:
+                break
+            super(SpoolQueue, self).put(item)
+
+        if not self.spilled and self.segments:
+            # everything on disk has been read back, start afresh
+            self._close_files()
+            for segment in self.segments:
+                os.unlink(self._segment_path(segment))
+            self.segments = []
+            self.offset = 0
+            self._save_position()
+
+    def _close_files(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def put(self, item, block=True, timeout=None):
+        # once spilling, keep spilling until the disk backlog is read back, so
+        # the order is preserved
+        if self.spilled or self.events >= self.memory:
+            self._spill(item)
+            if not self.qsize():
+                # read it straight back, for any get waiting
+                self._refill()
+        else:
+            super(SpoolQueue, self).put(item, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        if self.spilled and self.events <= self.memory / 2:
+            self._refill()
+        return super(SpoolQueue, self).get(block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        """Write the items held in memory onto disk."""
+        items = []
+        while self.qsize():
+            items.append(super(SpoolQueue, self).get(False))
+            self.task_done()
+
+        self._close_files()
+        if items or self.offset:
+            segment = self.segments[0] - 1 if self.segments else 0
+            consumed = None
+            with file(self._segment_path(segment), 'wb') as fout:
+                for item in items:
+                    self._write(fout, item)
+                if self.offset:
+                    # carry over the unread remainder of the current segment
+                    consumed = self.segments.pop(0)
+                    with file(self._segment_path(consumed), 'rb') as fin:
+                        fin.seek(self.offset)
+                        shutil.copyfileobj(fin, fout)
+            self.segments.insert(0, segment)
+            self.offset = 0
+            self.spilled += len(items)
+            self._save_position()
+            if consumed is not None:
+                os.unlink(self._segment_path(consumed))
+            if items:
+                self.logger.info('Spooled %d events to %s' % (
+                    sum(count_events(i) for i in items), self.directory))
+        elif self.segments:
+            self._save_position()
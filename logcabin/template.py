@@ -0,0 +1,165 @@
+"""Format strings for events, parsed once rather than for every event."""
+
+import datetime
+from string import Formatter
+
+class DefaultFormatter(Formatter):
+    default = ''
+
+    def get_value(self, key, args, kwargs):
+        # Try standard formatting, then return 'unknown key'
+        try:
+            return Formatter.get_value(self, key, args, kwargs)
+        except KeyError:
+            return self.default
+
+# strftime directives, by the finest unit of time they depend on
+_UNITS = {}
+for unit, directives in enumerate(['aAbBdDFhjmuUwWxyY', 'HIkpl', 'MR', 'ScTX']):
+    _UNITS.update(dict.fromkeys(directives, unit))
+
+# functions of a datetime, changing with each unit of time
+_KEYS = [
+    lambda d: d.toordinal(),
+    lambda d: (d.toordinal(), d.hour),
+    lambda d: (d.toordinal(), d.hour, d.minute),
+    lambda d: (d.toordinal(), d.hour, d.minute, d.second),
+]
+
+def _strftime_key(spec):
+    """Return a function of a datetime changing whenever the formatting with
+    spec may, or None if it isn't known.
+
+    >>> _strftime_key('%Y.%m.%d') is _KEYS[0]
+    True
+    >>> _strftime_key('%Y-%m-%d/%H%M%S') is _KEYS[3]
+    True
+    >>> _strftime_key('%H:%M:%S.%f')
+    """
+    unit = 0
+    parts = spec.split('%')
+    n = 1
+    while n < len(parts):
+        part = parts[n]
+        if not part:
+            # %%, the next part is literal text
+            n += 2
+            continue
+        if part[0] not in _UNITS:
+            return None
+        unit = max(unit, _UNITS[part[0]])
+        n += 1
+    return _KEYS[unit]
+
+class _CachedStrftime(object):
+    """Formats datetimes with a strftime spec, reusing the last result until
+    the key of the datetime changes."""
+
+    def __init__(self, spec, key):
+        self.spec = spec
+        self.key = key
+        self.last = (None, None)
+
+    def __call__(self, value):
+        if type(value) is not datetime.datetime:
+            return format(value, self.spec)
+        key = self.key(value)
+        last_key, result = self.last
+        if key != last_key:
+            result = format(value, self.spec)
+            self.last = (key, result)
+        return result
+
+def _field_formatter(spec):
+    key = '%' in spec and _strftime_key(spec)
+    if key:
+        return _CachedStrftime(spec, key)
+    return lambda value: format(value, spec)
+
+class Template(object):
+    """A format string, parsed once for formatting events (see Event.format).
+
+    Fields are looked up directly in the event, and datetimes formatted with
+    strftime specs are only formatted again when the result may change, eg.
+    ``{timestamp:%Y.%m.%d}`` once a day. Fields with attribute or index lookups
+    (eg. ``{a.b}``) or nested specs are formatted by string.Formatter.
+
+    :param string fmt: the format string
+    :param boolean raise_missing: raise KeyError for missing fields, rather
+      than formatting them as empty
+
+    >>> from logcabin.event import Event
+    >>> t = Template('logs-{type}-{timestamp:%Y.%m.%d}')
+    >>> t.format(Event(type='x', timestamp=datetime.datetime(2013, 1, 2, 3, 4)))
+    'logs-x-2013.01.02'
+    >>> t.format(Event(timestamp=datetime.datetime(2013, 1, 2, 5, 6)))
+    'logs--2013.01.02'
+    """
+
+    def __init__(self, fmt, raise_missing=False):
+        self.fmt = fmt
+        self.raise_missing = raise_missing
+        self.parts = self._parse(fmt)
+
+    @staticmethod
+    def _parse(fmt):
+        """Return the (literal text, field, conversion, formatter) parts of
+        fmt, or None to use string.Formatter."""
+        parts = []
+        try:
+            parsed = list(Formatter().parse(fmt))
+        except ValueError:
+            # invalid, so raise the error when formatting as before
+            return None
+        for literal, name, spec, conversion in parsed:
+            if name is None:
+                parts.append((literal, None, None, None))
+                continue
+            if '.' in name or '[' in name or '{' in spec:
+                return None
+            if name.isdigit():
+                name = int(name)
+            parts.append((literal, name, conversion, _field_formatter(spec)))
+        return parts
+
+    def format(self, event, args=None):
+        if self.parts is None:
+            formatter = self.raise_missing and Formatter() or DefaultFormatter()
+            return formatter.vformat(self.fmt, args, event)
+
+        result = []
+        for literal, name, conversion, formatter in self.parts:
+            result.append(literal)
+            if name is None:
+                continue
+            if type(name) is int:
+                value = args[name]
+            else:
+                try:
+                    value = event[name]
+                except KeyError:
+                    if self.raise_missing:
+                        raise
+                    value = DefaultFormatter.default
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            result.append(formatter(value))
+        return ''.join(result)
+
+    __call__ = format
+
+# templates compiled by Event.format
+_compiled = {}
+
+def compiled(fmt, raise_missing=False):
+    """Return the Template for a format string, compiling it once."""
+    try:
+        return _compiled[fmt, raise_missing]
+    except KeyError:
+        if len(_compiled) >= 10000:
+            # formats built per event, so don't keep them all
+            _compiled.clear()
+        t = _compiled[fmt, raise_missing] = Template(fmt, raise_missing)
+        return t
@@ -0,0 +1,161 @@
+"""Optional tracing of the latency of events through the pipeline.
+
+When enabled, inputs stamp each event with its ingest time, stage queues
+stamp the events put onto them, and each processing stage records a span -
+the times the event was queued for the stage, taken off the queue, and done
+with - onto the event's trace. This is
+kept aside from the event fields, so is never output.
+
+When an output is done with an event, the spans recorded since are passed to
+the registered collectors (see Perf).
+"""
+
+import time
+import ctypes
+import ctypes.util
+import collections
+
+from statistics import percentile
+
+# off by default, as it costs a little for every event in every stage
+enabled = False
+
+# Latency objects gathering the traces of completed events
+collectors = []
+
+def enable():
+    global enabled
+    enabled = True
+
+def _monotonic():
+    """Return a monotonic clock function, falling back to time.time where
+    clock_gettime is not available."""
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    CLOCK_MONOTONIC = 1
+    ts = timespec()
+    ref = ctypes.byref(ts)
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ref)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+now = _monotonic()
+
+class Trace(object):
+    """The ingest time of an event, and its spans through the stages, as
+    (stage path, enqueued, dequeued, done) tuples."""
+
+    __slots__ = ('ingest', 'spans', 'reported', 'enqueued')
+
+    def __init__(self, ingest):
+        self.ingest = ingest
+        self.spans = []
+        # spans already passed to the collectors
+        self.reported = 0
+        # time put onto the queue of the next stage, if it has one
+        self.enqueued = None
+
+    def __getstate__(self):
+        return (self.ingest, self.spans, self.reported)
+
+    def __setstate__(self, state):
+        self.ingest, self.spans, self.reported = state
+        self.enqueued = None
+
+    def copy(self):
+        """Copy the trace, for a fork of the event."""
+        t = Trace(self.ingest)
+        t.spans = list(self.spans)
+        t.reported = self.reported
+        t.enqueued = self.enqueued
+        return t
+
+def get(event):
+    return event._trace
+
+def stamp(event):
+    """Start tracing an event, if enabled. Returns the event."""
+    if enabled:
+        object.__setattr__(event, '_trace', Trace(now()))
+    return event
+
+def enqueue(events):
+    """Stamp the time events are put onto the queue of a stage."""
+    queued = now()
+    for event in events:
+        t = get(event)
+        if t is not None:
+            t.enqueued = queued
+
+def record(events, path, dequeued, done):
+    """Record a span of the given stage for each of the events. Those not
+    stamped by a queue (eg. passed directly to a fused stage) were queued once
+    done with by the previous stage, or ingested."""
+    for event in events:
+        t = get(event)
+        if t is not None:
+            enqueued = t.enqueued
+            if enqueued is None:
+                enqueued = t.spans[-1][3] if t.spans else t.ingest
+            t.enqueued = None
+            t.spans.append((path, enqueued, dequeued, done))
+
+def complete(events, done):
+    """Pass the traces of events an output is done with to the collectors."""
+    for event in events:
+        t = get(event)
+        if t is not None:
+            spans = t.spans[t.reported:]
+            t.reported = len(t.spans)
+            for collector in collectors:
+                collector.add(spans, done - t.ingest)
+
+class Latency(object):
+    """Collects the end-to-end latency of events, and the time they spent
+    queued for and processed in each stage."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = []
+        self.queued = collections.defaultdict(list)
+        self.processing = collections.defaultdict(list)
+
+    def add(self, spans, total):
+        self.total.append(total)
+        for path, enqueued, dequeued, done in spans:
+            self.queued[path].append(dequeued - enqueued)
+            self.processing[path].append(done - dequeued)
+
+    def summary(self):
+        """Return (name, (p50, p99, max)) for the end-to-end latency, then the
+        queued and processing times of each stage, and reset.
+
+        >>> l = Latency()
+        >>> l.add([('Pipeline/Json', 1.0, 1.5, 1.75)], 1.0)
+        >>> l.add([('Pipeline/Json', 2.0, 2.0, 2.25)], 0.5)
+        >>> for name, values in l.summary():
+        ...     print name, values
+        end-to-end (0.75, 0.995, 1.0)
+        Pipeline/Json queued (0.25, 0.495, 0.5)
+        Pipeline/Json processing (0.25, 0.25, 0.25)
+        """
+        summary = [('end-to-end', _quantiles(self.total))]
+        for path in sorted(self.queued):
+            summary.append(('%s queued' % path, _quantiles(self.queued[path])))
+            summary.append(('%s processing' % path, _quantiles(self.processing[path])))
+        self.reset()
+        return summary
+
+def _quantiles(values):
+    values.sort()
+    return (percentile(values, 0.5), percentile(values, 0.99), values[-1])
@@ -0,0 +1,124 @@
+"""Batched binary transport of events between logcabin instances (see the
+Zeromq input and output).
+
+A message is a header - a byte never starting valid msgpack or json, then a
+byte identifying the compression - followed by a msgpack array of the events.
+Datetimes are packed as a msgpack extension type, so survive the round trip
+(normalized to UTC, as they're serialized to json).
+"""
+
+import struct
+import zlib
+import datetime
+
+from event import Event, UTC
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = '\xc1'
+
+# msgpack extension type of datetimes, as microseconds since the epoch
+DATETIME = 1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+# compression name => (header byte, function returning (compress, decompress))
+COMPRESSION = {
+    None: ('0', lambda: (str, str)),
+    'zlib': ('z', lambda: (lambda data: zlib.compress(data, 1), zlib.decompress)),
+    'lz4': ('4', _lz4),
+}
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is not None:
+            obj = obj.astimezone(UTC).replace(tzinfo=None)
+        delta = obj - EPOCH
+        us = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return msgpack.ExtType(DATETIME, struct.pack('>q', us))
+    raise TypeError('%r is not serializable' % (obj,))
+
+def _ext_hook(code, data):
+    if code == DATETIME:
+        return EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', data)[0])
+    return msgpack.ExtType(code, data)
+
+def _require_msgpack():
+    if msgpack is None:
+        raise ValueError('the msgpack format requires the msgpack module')
+
+class Encoder(object):
+    """Encodes events into messages.
+
+    :param string compress: None, 'zlib' or 'lz4'
+    :param integer max_bytes: maximum size of a message before compression,
+      unless a single event is larger
+    """
+
+    def __init__(self, compress=None, max_bytes=1 << 20):
+        _require_msgpack()
+        if compress not in COMPRESSION:
+            raise ValueError('compress should be one of: %s' % ', '.join(
+                str(k) for k in sorted(COMPRESSION)))
+        code, functions = COMPRESSION[compress]
+        self.header = HEADER + code
+        self.compress = functions()[0]
+        self.max_bytes = max_bytes
+        self.packer = msgpack.Packer(default=_default, use_bin_type=True)
+
+    def messages(self, events):
+        """Yield the messages encoding the events."""
+        packed = []
+        size = 0
+        for event in events:
+            data = self.packer.pack(event)
+            if packed and size + len(data) > self.max_bytes:
+                yield self._message(packed)
+                packed = []
+                size = 0
+            packed.append(data)
+            size += len(data)
+        if packed:
+            yield self._message(packed)
+
+    def _message(self, packed):
+        body = self.packer.pack_array_header(len(packed)) + ''.join(packed)
+        return self.header + self.compress(body)
+
+# header byte => decompress
+_decompressors = {}
+
+def decode(message):
+    """Return the events in a message, or None if it isn't a batch of events.
+    Raises ValueError if the message is invalid.
+    """
+    if message[:1] != HEADER:
+        return None
+    _require_msgpack()
+
+    code = message[1:2]
+    decompress = _decompressors.get(code)
+    if decompress is None:
+        for name, (c, functions) in COMPRESSION.iteritems():
+            if c == code:
+                decompress = _decompressors[code] = functions()[1]
+                break
+        else:
+            raise ValueError('unknown compression: %r' % code)
+
+    try:
+        events = []
+        for fields in msgpack.unpackb(decompress(message[2:]), ext_hook=_ext_hook, raw=False):
+            event = dict.__new__(Event)
+            dict.update(event, fields)
+            events.append(event)
+        return events
+    except Exception as ex:
+        raise ValueError('invalid message: %s' % ex)
@@ -1,5 +1,10 @@
 import time
 import gevent
+import gevent.event
+from gevent.queue import Full, JoinableQueue
+
+from event import Event
+import trace
 
 class ConfigException(Exception):
     pass
@@ -11,12 +16,196 @@ def dynamic_class(modname, classname):
         mod = getattr(mod, m)
     return getattr(mod, classname)
 
+class Batch(list):
+    """A list of events, passed between stages as a single queue item."""
+
+def put_events(q, events):
+    """Put a list of events onto a queue, as a single batch if the queue
+    supports it, otherwise one by one."""
+    if hasattr(q, 'put_batch'):
+        q.put_batch(events)
+    else:
+        for event in events:
+            q.put(event)
+
+class StageQueue(JoinableQueue):
+    """The input queue of a stage. Items are either events or batches of
+    events.
+
+    The queue may be bounded to maxsize events (rather than items, as a batch
+    may hold thousands), with overflow determining what happens to the events
+    beyond it:
+
+    - block: wait for space (backpressure onto the upstream stages). A batch
+      is let in whole once there is any space.
+    - drop_newest: drop the events being put
+    - drop_oldest: drop the oldest events queued to make space
+    - drop_tagged: drop the events being put that have any of overflow_tags,
+      otherwise wait for space
+
+    The number of events queued is counted in events, and those dropped in
+    dropped.
+    """
+
+    OVERFLOW = ('block', 'drop_newest', 'drop_oldest', 'drop_tagged')
+
+    def __init__(self, maxsize=None, overflow='block', overflow_tags=()):
+        if overflow not in self.OVERFLOW:
+            raise ValueError('overflow should be one of: %s' % ', '.join(self.OVERFLOW))
+        # unbounded in items, the events are limited in put()
+        super(StageQueue, self).__init__()
+        self.max_events = maxsize
+        self.overflow = overflow
+        self.overflow_tags = overflow_tags
+        self.events = 0
+        self.dropped = 0
+        self.not_full = gevent.event.Event()
+        self.not_full.set()
+
+    def _put(self, item):
+        super(StageQueue, self)._put(item)
+        self.events += count_events(item)
+        if self.full():
+            self.not_full.clear()
+
+    def _get(self):
+        item = super(StageQueue, self)._get()
+        self.events -= count_events(item)
+        if not self.full():
+            self.not_full.set()
+        return item
+
+    def full(self):
+        return self.max_events is not None and self.events >= self.max_events
+
+    def put(self, item, block=True, timeout=None):
+        if trace.enabled:
+            # queued from now, including any wait for space
+            trace.enqueue(item if isinstance(item, Batch) else (item,))
+        if self.max_events is not None and self.overflow != 'block':
+            space = self.max_events - self.events
+            if count_events(item) > space:
+                if self.overflow == 'drop_newest':
+                    item = self._drop_newest(item, space)
+                elif self.overflow == 'drop_oldest':
+                    item = self._drop_oldest(item)
+                else:
+                    item = self._drop_tagged(item)
+                if not item:
+                    return
+        if self.full():
+            if not block:
+                raise Full
+            with gevent.Timeout(timeout, Full):
+                while self.full():
+                    self.not_full.wait()
+        super(StageQueue, self).put(item)
+
+    def _drop_newest(self, item, space):
+        if space > 0 and isinstance(item, Batch):
+            self.dropped += len(item) - space
+            return Batch(item[:space])
+        self.dropped += count_events(item)
+        return None
+
+    def _drop_oldest(self, item):
+        excess = self.events + count_events(item) - self.max_events
+        while excess > 0 and self.qsize():
+            oldest = self.get_nowait()
+            self.task_done()
+            if isinstance(oldest, Batch) and len(oldest) > excess:
+                # keep the newer events of the batch
+                requeue(self, Batch(oldest[excess:]), 0)
+                self.dropped += excess
+                return item
+            self.dropped += count_events(oldest)
+            excess -= count_events(oldest)
+        if excess > 0:
+            # more events than fit at all
+            self.dropped += excess
+            item = Batch(item[excess:]) if isinstance(item, Batch) else None
+        return item
+
+    def _drop_tagged(self, item):
+        if isinstance(item, Batch):
+            kept = Batch(ev for ev in item if not self._tagged(ev))
+            self.dropped += len(item) - len(kept)
+            return kept
+        elif self._tagged(item):
+            self.dropped += 1
+            return None
+        return item
+
+    def _tagged(self, event):
+        tags = event.tags
+        for tag in self.overflow_tags:
+            if tag in tags:
+                return True
+        return False
+
+    def put_batch(self, events):
+        if not isinstance(events, Batch):
+            events = Batch(events)
+        self.put(events)
+
+    def close(self):
+        """Called when the stage owning the queue stops."""
+        pass
+
+def requeue(q, item, items=1):
+    """Put an item taken from a queue back at its head, eg. when the consumer
+    is stopped part way through processing it, so it is processed again (or
+    spooled) rather than lost.
+
+    The item may combine several taken from the queue (see
+    ProcessingStage._get_batch), in which case items is their number.
+    """
+    q._put(item)
+    q.queue.rotate(1)
+    for n in xrange(items):
+        q.task_done()
+
+def count_events(item):
+    """Number of events in a queue item."""
+    if isinstance(item, Batch):
+        return len(item)
+    return 1
+
+def _fork(item):
+    """Fork the events of a queue item."""
+    if isinstance(item, Event):
+        return item.fork()
+    return Batch(ev.fork() for ev in item)
+
 class BroadcastQueue(list):
-    """Queue-like object that broadcasts to all child queues."""
+    """Queue-like object that broadcasts to all child queues.
+
+    Each queue after the first is given forks of the events (see Event.fork),
+    so changes made by one branch aren't seen by the others.
+    """
 
     def put(self, obj):
-        for q in self:
-            q.put(obj)
+        self._broadcast(obj, lambda q, obj: q.put(obj))
+
+    def put_batch(self, events):
+        self._broadcast(events, put_events)
+
+    def _broadcast(self, item, put):
+        # each queue applies its own overflow policy. Full queues are put to
+        # last, so a branch waiting for space doesn't hold up the others.
+        full = []
+        for n, q in enumerate(self):
+            if n:
+                item = _fork(item)
+            if q.full():
+                full.append((q, item))
+            else:
+                put(q, item)
+        for q, item in full:
+            put(q, item)
+
+    def full(self):
+        return any(q.full() for q in self)
 
     def join(self):
         for q in self:
@@ -0,0 +1,132 @@
+import os
+import time
+import errno
+import fcntl
+import signal
+import struct
+import logging
+import cPickle as pickle
+import gevent
+from gevent.socket import wait_read, wait_write
+
+HEADER = struct.Struct('!L')
+
+class WorkerProcess(object):
+    """A forked worker process, which applies a function to the objects sent
+    to it, and returns the results.
+
+    The parent communicates over a pair of pipes, cooperatively with the other
+    greenlets. The worker blocks on them, and exits when the parent closes its
+    end. The worker closes the other files it inherits (eg. the sockets of
+    inputs, the pipes of other workers).
+    """
+
+    # seconds to wait for a worker to exit, before it is killed
+    STOP_TIMEOUT = 5
+
+    def __init__(self, function):
+        self.logger = logging.getLogger('WorkerProcess')
+        request_r, request_w = os.pipe()
+        result_r, result_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _close_fds((request_r, result_w))
+                # leave the parent to handle ctrl-c
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self._serve(request_r, result_w, function)
+            except:
+                self.logger.exception('Worker failed')
+            finally:
+                os._exit(0)
+
+        os.close(request_r)
+        os.close(result_w)
+        self.pid = pid
+        self.fout = request_w
+        self.fin = result_r
+        for fd in (self.fout, self.fin):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.logger.debug('Started worker %d' % pid)
+
+    def _serve(self, fin, fout, function):
+        while True:
+            header = _read(fin, HEADER.size)
+            if not header:
+                return
+            length, = HEADER.unpack(header)
+            obj = pickle.loads(_read(fin, length))
+            data = pickle.dumps(function(obj), pickle.HIGHEST_PROTOCOL)
+            _write(fout, HEADER.pack(len(data)) + data)
+
+    def call(self, obj):
+        """Send obj to the worker, and wait for the result."""
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        _write(self.fout, HEADER.pack(len(data)) + data, wait_write)
+        header = _read(self.fin, HEADER.size, wait_read)
+        if not header:
+            raise EOFError('worker %d exited' % self.pid)
+        length, = HEADER.unpack(header)
+        return pickle.loads(_read(self.fin, length, wait_read))
+
+    def stop(self, deadline=None):
+        """Stop the worker, and wait for it to exit until the deadline, then
+        kill it."""
+        for fd in (self.fout, self.fin):
+            os.close(fd)
+        if deadline is None:
+            deadline = time.time() + self.STOP_TIMEOUT
+        # poll, rather than blocking the other greenlets in waitpid
+        interval = 0.001
+        while os.waitpid(self.pid, os.WNOHANG)[0] == 0:
+            if time.time() >= deadline:
+                self.logger.warn('Killing worker %d, still running' % self.pid)
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+                break
+            gevent.sleep(interval)
+            interval = min(interval * 2, 0.1)
+        self.logger.debug('Stopped worker %d' % self.pid)
+
+def _close_fds(keep):
+    """Close the file descriptors inherited by a child, but for stdio and
+    those in keep."""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = xrange(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def _read(fd, n, wait=None):
+    """Read exactly n bytes, or '' at end of file."""
+    chunks = []
+    while n:
+        try:
+            data = os.read(fd, n)
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+            wait(fd)
+            continue
+        if not data:
+            return ''
+        chunks.append(data)
+        n -= len(data)
+    return ''.join(chunks)
+
+def _write(fd, data, wait=None):
+    while data:
+        try:
+            n = os.write(fd, data)
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+            wait(fd)
+            continue
+        data = data[n:]
@@ -54,7 +54,8 @@ setup(
     zip_safe=False,
     entry_points={
         'console_scripts':
-        ['logcabin = logcabin:main']
+        ['logcabin = logcabin:main',
+         'logcabin-bench = logcabin.bench:main']
     },
     cmdclass={
         'tag': tag,
@@ -0,0 +1,56 @@
+from unittest import TestCase
+from mock import Mock
+import gevent
+import time
+
+from logcabin import bench
+from logcabin.event import Event
+
+class BenchTests(TestCase):
+    def test_filters(self):
+        results = bench.bench_filters(events=50, repeat=1)
+        self.assertEquals(sorted(name for name, cls, conf, make_event in bench.FILTERS),
+            sorted(results))
+        for name, result in results.iteritems():
+            # the sample events are all valid
+            self.assertEquals(0, result['errors'], name)
+            self.assert_(result['events_per_second'] > 0)
+
+    def test_wait_received(self):
+        stage = Mock()
+        stage.stage_metrics.events_in = 0
+        def deliver():
+            for n in xrange(3):
+                gevent.sleep(0.02)
+                stage.stage_metrics.events_in += 1
+        gevent.spawn(deliver)
+        start = time.time()
+        # waits for the events in flight, rather than the inputs being idle
+        end = bench._wait_received(stage, 3)
+        self.assertEquals(3, stage.stage_metrics.events_in)
+        self.assert_(0.05 < end - start < 0.5)
+
+        # an event lost is only waited on until none arrive for a while
+        start = time.time()
+        end = bench._wait_received(stage, 4, quiet=0.05)
+        self.assert_(end - start < 0.01)
+        self.assert_(time.time() - start >= 0.05)
+
+    def test_skip_unserved(self):
+        from logcabin.pipeline import Pipeline
+        from logcabin.filters.noop import Noop
+        from logcabin.outputs.output import Output
+
+        class Mongodb(Output):
+            def process(self, event):
+                raise IOError('connection refused')
+
+        pipeline = Pipeline()
+        with pipeline:
+            Noop()
+            Mongodb()
+        pipeline.setup(None)
+        self.assertEquals(['Pipeline/Mongodb'], bench.StandIns.skip_unserved(pipeline))
+        # its events are discarded, rather than failing
+        pipeline.stages[1]._process(Event(n=1))
+        self.assertEquals(0, pipeline.stages[1].stage_metrics.errors)
@@ -0,0 +1,207 @@
+from unittest import TestCase
+import gevent
+from gevent.queue import Queue
+import time
+
+from logcabin.event import Event
+from logcabin.context import DummyContext
+from logcabin.common import ProcessingStage
+from logcabin.util import Batch, StageQueue
+from logcabin.filters import mutate
+
+from testhelper import assertEventEquals
+
+class Recorder(ProcessingStage):
+    """Records the size of each batch processed, dropping events with drop set."""
+    def __init__(self, **kwargs):
+        super(Recorder, self).__init__(**kwargs)
+        self.batches = []
+
+    def process_batch(self, events):
+        self.batches.append(len(events))
+        return super(Recorder, self).process_batch(events)
+
+    def process(self, event):
+        return not event.drop
+
+class BatchTests(TestCase):
+    def create(self, stage, events=[], output=None):
+        self.output = output if output is not None else Queue()
+        self.i = stage
+        self.input = stage.setup(self.output)
+        for ev in events:
+            self.input.put(ev)
+        stage.start()
+        return stage
+
+    def wait(self, timeout=1.0, events=1):
+        with gevent.Timeout(timeout):
+            while self.input.qsize():
+                gevent.sleep(0.0)
+            while self.output.qsize() < events:
+                gevent.sleep(0.0)
+
+        if events:
+            return [self.output.get() for n in xrange(events)]
+
+    def tearDown(self):
+        self.i.stop()
+
+    def test_batch(self):
+        with DummyContext():
+            stage = Recorder(batch_size=10, batch_timeout=0.1)
+        self.create(stage, [Event(n=n) for n in xrange(5)])
+
+        q = self.wait(events=5)
+        self.assertEquals([0, 1, 2, 3, 4], [ev.n for ev in q])
+        self.assertEquals([5], stage.batches)
+
+    def test_batch_size(self):
+        with DummyContext():
+            stage = Recorder(batch_size=2)
+        self.create(stage, [Event(n=n) for n in xrange(5)])
+
+        self.wait(events=5)
+        self.assertEquals([2, 2, 1], stage.batches)
+
+    def test_drop(self):
+        with DummyContext():
+            stage = Recorder(batch_size=10)
+        self.create(stage, [Event(n=1), Event(n=2, drop=True), Event(n=3)])
+
+        q = self.wait(events=2)
+        self.assertEquals([1, 3], [ev.n for ev in q])
+
+    def test_bulk_put(self):
+        # a batch is enqueued as a single item onto another stage queue
+        with DummyContext():
+            stage = Recorder(batch_size=10)
+        self.create(stage, [Event(n=1), Event(n=2)], output=StageQueue())
+
+        q = self.wait(events=1)
+        self.assert_(isinstance(q[0], Batch))
+        self.assertEquals([1, 2], [ev.n for ev in q[0]])
+
+    def test_adapter(self):
+        # stages implementing only process() work in batch mode
+        with DummyContext():
+            stage = mutate.Mutate(set={'b': 2}, batch_size=10)
+        self.create(stage, [Event(a=1), Batch([Event(a=2), Event(a=3)])])
+
+        q = self.wait(events=3)
+        for n, ev in enumerate(q):
+            assertEventEquals(self, Event(a=n+1, b=2), ev)
+
+class Slow(ProcessingStage):
+    def process(self, event):
+        gevent.sleep(0.01)
+
+class DrainTests(TestCase):
+    def create(self, events):
+        with DummyContext():
+            self.i = Slow()
+        self.output = Queue()
+        self.input = self.i.setup(self.output)
+        self.i.start()
+        for ev in events:
+            self.input.put(ev)
+
+    def test_drain(self):
+        self.create([Event(n=n) for n in xrange(5)])
+        self.i.stop()
+        self.assertEquals(5, self.output.qsize())
+        self.assertEquals(0, self.input.unfinished_tasks)
+
+    def test_deadline(self):
+        self.create([Event(n=n) for n in xrange(100)])
+        start = time.time()
+        self.i.stop(time.time() + 0.05)
+        self.assert_(time.time() - start < 0.5)
+        self.assert_(self.output.qsize() < 100)
+
+class Blocked(ProcessingStage):
+    """Blocks processing the events, eg. retrying an unavailable server."""
+    def process(self, event):
+        gevent.sleep(10)
+
+class RequeueTests(TestCase):
+    def create(self, items, **kwargs):
+        with DummyContext():
+            self.i = Blocked(**kwargs)
+        self.input = self.i.setup(Queue())
+        self.i.start()
+        for item in items:
+            self.input.put(item)
+        gevent.sleep(0.01)
+        self.i.stop(time.time() + 0.05)
+
+    def assertRequeued(self, expected):
+        self.assertEquals(expected, sorted(ev.n for item in self.input.queue
+            for ev in (item if isinstance(item, Batch) else [item])))
+        self.assertEquals(len(self.input.queue), self.input.unfinished_tasks)
+
+    def test_event(self):
+        self.create([Event(n=n) for n in xrange(3)])
+        # the event being processed is back at the head
+        self.assertEquals([0, 1, 2], [ev.n for ev in self.input.queue])
+        self.assertEquals(3, self.input.unfinished_tasks)
+
+    def test_batch(self):
+        self.create([Event(n=n) for n in xrange(3)], batch_size=2)
+        self.assertEquals(Batch, type(self.input.queue[0]))
+        self.assertRequeued([0, 1, 2])
+
+    def test_concurrency(self):
+        self.create([Event(n=n) for n in xrange(5)], concurrency=2)
+        self.assertRequeued([0, 1, 2, 3, 4])
+
+    def test_partitions(self):
+        self.create([Batch(Event(n=n) for n in xrange(300))], concurrency=2,
+            partition_key='{n}')
+        self.assertRequeued(range(300))
+
+class Sleeper(ProcessingStage):
+    """Sleeps for each event, recording the order they are processed in."""
+    def __init__(self, **kwargs):
+        super(Sleeper, self).__init__(**kwargs)
+        self.processed = []
+
+    def process(self, event):
+        gevent.sleep(event.sleep)
+        self.processed.append(event.n)
+
+class ConcurrencyTests(TestCase):
+    def create(self, events, **kwargs):
+        with DummyContext():
+            self.i = Sleeper(**kwargs)
+        self.output = Queue()
+        self.input = self.i.setup(self.output)
+        self.i.start()
+        for ev in events:
+            self.input.put(ev)
+
+    def tearDown(self):
+        self.i.stop()
+
+    def test_concurrency(self):
+        self.create([Event(n=n, sleep=0.05) for n in xrange(8)], concurrency=8)
+        start = time.time()
+        self.input.join()
+        self.assert_(time.time() - start < 0.2)
+        self.assertEquals(8, self.output.qsize())
+
+    def test_partition_key(self):
+        events = [Event(n=n, host=n % 3, sleep=0.02 * (n % 2)) for n in xrange(12)]
+        self.create(events[:6], concurrency=4, partition_key='{host}')
+        self.input.put(Batch(events[6:]))
+        self.i.stop()
+
+        self.assertEquals(12, self.output.qsize())
+        # events of each host are processed in order
+        for host in xrange(3):
+            self.assertEquals([n for n in xrange(12) if n % 3 == host],
+                [n for n in self.i.processed if n % 3 == host])
+
+    def test_invalid(self):
+        self.create([], concurrency=2)
+        self.assertRaises(ValueError, Sleeper, concurrency=0)
@@ -0,0 +1,58 @@
+from unittest import TestCase
+import copy
+import pickle
+
+from logcabin.event import Event
+from logcabin import trace
+
+class SlotsTests(TestCase):
+    # the trace and sharing state are kept in slots, aside from the fields
+
+    def setUp(self):
+        trace.enable()
+
+    def tearDown(self):
+        trace.enabled = False
+
+    def test_no_dict(self):
+        ev = Event(a=1)
+        self.assertFalse(hasattr(ev, '__dict__'))
+        self.assertEquals(None, ev._shared)
+        self.assertEquals(['a', 'timestamp'], sorted(ev))
+
+    def test_pickle(self):
+        ev = trace.stamp(Event(a=1, tags=['x']))
+        fork = ev.fork()
+        fork.add_tag('y')
+        for protocol in (0, 2):
+            for e in (ev, fork):
+                restored = pickle.loads(pickle.dumps(e, protocol))
+                # a plain event, with the trace but nothing shared
+                self.assertEquals(Event, type(restored))
+                self.assertEquals(dict(e), dict(restored))
+                self.assertEquals(None, restored._shared)
+                self.assertEquals(None, restored._json)
+                self.assert_(trace.get(restored) is not None)
+
+    def test_copy(self):
+        ev = trace.stamp(Event(a=1, tags=['x']))
+        fork = ev.fork()
+        for c in (copy.copy(fork), copy.deepcopy(fork)):
+            self.assertEquals(Event, type(c))
+            self.assertEquals(None, c._shared)
+            self.assert_(trace.get(c) is not None)
+            c.add_tag('y')
+        # the copies don't modify the tags shared with the other forks
+        self.assertEquals(['x'], ev.tags)
+
+    def test_add_tag(self):
+        ev = Event()
+        for tag in ('a', 'b', 'a'):
+            ev.add_tag(tag)
+        self.assertEquals(['a', 'b'], ev.tags)
+        # nor on a fork sharing the tags
+        fork = ev.fork()
+        fork.add_tag('b')
+        fork.add_tag('c')
+        self.assertEquals(['a', 'b', 'c'], fork.tags)
+        self.assertEquals(['a', 'b'], ev.tags)
@@ -4,8 +4,9 @@ from gevent.queue import Queue
 
 from logcabin.event import Event
 from logcabin.context import Context, DummyContext
-from logcabin.flow import If, Switch, Sequence
-from logcabin.filters import mutate
+from logcabin.flow import If, Switch, Route, Sequence, Parallel, Fanout
+from logcabin.filters import json, mutate, python, stats
+from logcabin.outputs import log
 
 from testhelper import assertEventEquals
 
@@ -51,6 +52,50 @@ class SequenceTests(FlowTests):
         q = self.wait()
         assertEventEquals(self, Event(a=1, b=2), q[0])
 
+class FusedSequenceTests(FlowTests):
+    def create_stage(self, fuse=True):
+        with Sequence() as test:
+            json.Json(on_error='tag')
+            python.Python(function=lambda ev: ev.a != 2)
+            mutate.Mutate(set={'b': 2}, fuse=fuse)
+            log.Log()
+        return test
+
+    def test_fused(self):
+        test = self.create({},
+            [Event(data='{"a": 1}'), Event(data='{"a": 2}'), Event(data='invalid')])
+        self.assertEquals([False, True, True, False], [s.fused for s in test.stages])
+
+        q = self.wait(events=2)
+        assertEventEquals(self, Event(a=1, b=2), q[0])
+        # errors are tagged and continue down the chain
+        assertEventEquals(self, Event(data='invalid', message='No JSON object could be decoded', tags=['error'], b=2), q[1])
+
+    def test_unfused(self):
+        test = self.create({'fuse': False},
+            [Event(data='{"a": 1}')])
+        self.assertEquals([False, True, False, False], [s.fused for s in test.stages])
+
+        q = self.wait()
+        assertEventEquals(self, Event(a=1, b=2), q[0])
+
+class FanoutTests(FlowTests):
+    def create_stage(self):
+        with Fanout() as test:
+            mutate.Mutate(set={'branch': 1}, unset=['b'])
+            python.Python(function=lambda ev: ev.add_tag('two'))
+        return test
+
+    def test_branches_independent(self):
+        self.create({}, [Event(a=1, b=2, tags=['x'])])
+        with gevent.Timeout(1.0):
+            while self.output.qsize() < 2:
+                gevent.sleep(0.0)
+        self.i.stop()
+        q = sorted([self.output.get(), self.output.get()], key=lambda ev: ev.branch)
+        assertEventEquals(self, Event(a=1, b=2, tags=['x', 'two']), q[0])
+        assertEventEquals(self, Event(a=1, branch=1, tags=['x']), q[1])
+
 class SwitchTests(FlowTests):
     def create_stage(self):
         with Switch() as test:
@@ -86,6 +131,62 @@ class SwitchTests(FlowTests):
         q = self.wait()
         assertEventEquals(self, Event(b=False), q[0])
 
+class SwitchDispatchTests(FlowTests):
+    def create_stage(self, reorder=False):
+        with Switch(reorder=reorder) as test:
+            with test('type == "a"'):
+                mutate.Mutate(set={'b': 'a'})
+            with test('type in ("b", "c")'):
+                mutate.Mutate(set={'b': 'bc'})
+            with test('tags'):
+                mutate.Mutate(set={'b': 'tagged'})
+            with test('type == "d"'):
+                mutate.Mutate(set={'b': 'd'})
+            with test.default:
+                mutate.Mutate(set={'b': None})
+        return test
+
+    def test_lookup(self):
+        self.create({}, [Event(type=t) for t in 'abcd'] + [Event(type='d', tags=['x']), Event(type=['a'])])
+        q = self.wait(events=6)
+        self.assertEquals([None, 'a', 'bc', 'bc', 'd', 'tagged'], sorted(ev.b for ev in q))
+        # the equality cases before the tags case are a single lookup
+        self.assertEquals([[0, 1], [2], [3], [4]], [cases for match, cases in self.i.dispatch])
+        self.assertEquals([1, 2, 1, 1, 1], self.i.hits)
+
+    def test_reorder(self):
+        self.create({'reorder': True})
+        self.i.REORDER_INTERVAL = 3
+        for ev in [Event(type='d'), Event(type='d'), Event(type='a'), Event()]:
+            self.input.put(ev)
+        self.wait(events=4)
+        # the default stays last
+        self.assertEquals([[3], [0, 1], [2], [4]], [cases for match, cases in self.i.dispatch])
+
+class RouteTests(FlowTests):
+    def create_stage(self):
+        with Route(field='type') as test:
+            with test('a'):
+                mutate.Mutate(set={'b': 1})
+            with test('b', 'c'):
+                mutate.Mutate(set={'b': 2})
+            with test.default:
+                mutate.Mutate(set={'b': False})
+        return test
+
+    def test_route(self):
+        self.create({}, [Event(type='c'), Event(type='a'), Event()])
+        q = self.wait(events=3)
+        self.assertEquals([False, 1, 2], sorted(ev.b for ev in q))
+        self.assertEquals([1, 1, 1], self.i.hits)
+
+    def test_duplicate(self):
+        with DummyContext():
+            route = Route(field='type')
+            with route('a'):
+                pass
+            self.assertRaises(ValueError, route, 'b', 'a')
+
 class IfTests(FlowTests):
     def create_stage(self):
         test = If(lambda ev: ev.a == 1)
@@ -104,3 +205,43 @@ class IfTests(FlowTests):
             [Event(a=2)])
         q = self.wait()
         assertEventEquals(self, Event(a=2), q[0])
+
+class IfSnippetTests(IfTests):
+    def create_stage(self):
+        test = If('a == 1')
+        with test:
+            mutate.Mutate(set={'b': 1})
+        return test
+
+class ParallelTests(FlowTests):
+    def create_stage(self, ordered=True):
+        with Parallel(workers=2, ordered=ordered, batch_size=2) as test:
+            mutate.Mutate(set={'b': 2})
+            python.Python(function=lambda ev: ev.a != 3)
+        return test
+
+    def test_ordered(self):
+        self.create({},
+            [Event(a=n) for n in xrange(10)])
+        q = self.wait(events=9)
+        self.assertEquals([0, 1, 2, 4, 5, 6, 7, 8, 9], [ev.a for ev in q])
+        assertEventEquals(self, Event(a=0, b=2), q[0])
+
+    def test_unordered(self):
+        self.create({'ordered': False},
+            [Event(a=n) for n in xrange(10)])
+        q = self.wait(events=9)
+        self.assertEquals([0, 1, 2, 4, 5, 6, 7, 8, 9], sorted(ev.a for ev in q))
+
+    def test_filters_only(self):
+        with DummyContext():
+            with Parallel():
+                self.assertRaises(ValueError, log.Log)
+                # stateful filters would keep state per worker
+                self.assertRaises(ValueError, stats.Stats, metrics={'total': 'n'})
+
+    def test_options(self):
+        # these would process events in the parent, bypassing the workers
+        for option in ({'concurrency': 2}, {'partition_key': '{a}'}, {'fuse': False}):
+            with DummyContext():
+                self.assertRaises(ValueError, Parallel, **option)
@@ -0,0 +1,57 @@
+from unittest import TestCase
+import gevent
+import mock
+import os
+
+from logcabin import inotify
+
+from testhelper import TempDirectory
+
+class WatcherTests(TestCase):
+    def setUp(self):
+        self.watcher = inotify.Watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def test_modify(self):
+        with TempDirectory():
+            with file('test.log', 'w') as fout:
+                self.assert_(self.watcher.watch('test.log'))
+                self.assertEquals(False, self.watcher.wait('test.log', 0.01))
+
+                print >>fout, 'abc'
+                fout.flush()
+                self.assertEquals(True, self.watcher.wait('test.log', 1.0))
+                self.assertEquals(False, self.watcher.wait('test.log', 0.01))
+
+    def test_create_move(self):
+        with TempDirectory():
+            self.watcher.watch('test.log')
+            self.watcher.watch('.')
+            file('test.log', 'w').close()
+            self.assertEquals(True, self.watcher.wait('test.log', 1.0))
+
+            os.rename('test.log', 'test.log.1')
+            self.assertEquals(True, self.watcher.wait('test.log', 1.0))
+            # the directory is woken by changes to its entries
+            self.assertEquals(True, self.watcher.wait('.', 0.01))
+
+    def test_ignore(self):
+        with TempDirectory():
+            self.watcher.watch('.')
+            self.watcher.ignore('state', 'state.tmp')
+            file('state.tmp', 'w').close()
+            os.rename('state.tmp', 'state')
+            self.assertEquals(False, self.watcher.wait('.', 0.05))
+
+    def test_watch_again(self):
+        # once watched, the path isn't looked up on the file system again
+        with TempDirectory():
+            self.assert_(self.watcher.watch('test.log'))
+            with mock.patch('os.path.isdir', side_effect=AssertionError):
+                self.assert_(self.watcher.watch('test.log'))
+                self.assertEquals(False, self.watcher.wait('test.log', 0.01))
+
+    def test_missing_directory(self):
+        self.assertEquals(False, self.watcher.watch('/nonexistent/test.log'))
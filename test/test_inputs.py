@@ -1,14 +1,21 @@
-from unittest import TestCase
+from unittest import TestCase, SkipTest
 import zmq.green as zmq
 import gevent
 import gevent.socket as socket
 from gevent.queue import Queue
 import random
 import os
+import time
+import datetime
+import errno
+import logging
+from mock import Mock, patch
 
 from logcabin.event import Event
 from logcabin.context import DummyContext
-from logcabin.inputs import udp, zeromq, file as fileinput
+from logcabin.util import ConfigException
+from logcabin.inputs import udp, tcp, zeromq, file as fileinput, generator
+from logcabin.outputs import zeromq as zmqoutput
 
 from testhelper import TempDirectory, assertEventEquals
 
@@ -46,6 +53,26 @@ class ZeromqTests(InputTests):
         q = self.waitForQueue()
         assertEventEquals(self, Event(data='abc'), q[0])
 
+    def test_msgpack(self):
+        conf = {'address': 'ipc://testipc', 'format': 'msgpack', 'hwm': 100}
+        self.create(conf)
+
+        sent = [Event(n=n, timestamp=datetime.datetime(2013, 1, 1, 0, 0, n)) for n in xrange(3)]
+        with DummyContext():
+            output = zmqoutput.Zeromq(address=conf['address'], format='msgpack', compress='zlib')
+        output.setup(None)
+        output.start()
+        try:
+            # a raw packet is still received as such
+            output.sock.send('abc')
+            for ev in sent:
+                output.input.put(ev)
+            q = self.waitForQueue(events=4)
+        finally:
+            output.stop()
+        assertEventEquals(self, Event(data='abc'), q[0])
+        self.assertEquals(sent, q[1:])
+
 class UdpTests(InputTests):
     cls = udp.Udp
 
@@ -60,6 +87,101 @@ class UdpTests(InputTests):
         q = self.waitForQueue()
         assertEventEquals(self, Event(data='abc'), q[0])
 
+    def test_burst(self):
+        conf = {'port': random.randint(1024, 65535), 'rcvbuf': 1 << 20, 'reuseport': True}
+        i = self.create(conf)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sent = ['x' * 8000] + [str(n) for n in xrange(100)]
+        for data in sent:
+            sock.sendto(data, ('127.0.0.1', conf['port']))
+        # none dropped by the kernel
+        self.assertEquals(0, i.socket_stats()[1])
+
+        q = self.waitForQueue(events=len(sent))
+        self.assertEquals(sent, [ev.data for ev in q])
+
+    def test_rcvbuf_limited(self):
+        if not os.path.exists('/proc/sys/net/core/rmem_max'):
+            raise SkipTest('not on linux')
+        # between rmem_max and double it, which is what linux reports
+        rcvbuf = int(file('/proc/sys/net/core/rmem_max').read()) * 3 / 2
+        with patch.object(logging.getLogger('Udp'), 'warn') as warn:
+            self.create({'port': random.randint(1024, 65535), 'rcvbuf': rcvbuf})
+        self.assertEquals(1, warn.call_count)
+
+    def test_socket_stats(self):
+        with TempDirectory():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            inode = os.fstat(sock.fileno()).st_ino
+            with file('udp', 'w') as fout:
+                print >>fout, '   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops'
+                print >>fout, '  1: 00000000:1770 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1 2 ffff8800 5'
+                print >>fout, '  2: 00000000:1771 00000000:0000 07 00000000:00000A00 00:00000000 00000000     0        0 %d 2 ffff8800 12' % inode
+            self.assertEquals((2560, 12), udp.socket_stats(sock, ['missing', 'udp']))
+            self.assertEquals(None, udp.socket_stats(sock, ['missing']))
+
+class TcpTests(InputTests):
+    cls = tcp.Tcp
+
+    def connect(self, port):
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_lines(self):
+        conf = {'port': random.randint(1024, 65535)}
+        self.create(conf)
+
+        a = self.connect(conf['port'])
+        b = self.connect(conf['port'])
+        a.sendall('abc\nde')
+        b.sendall('xyz\n')
+        gevent.sleep(0.01)
+        a.sendall('f\n')
+
+        q = self.waitForQueue(events=3)
+        self.assertEquals(['abc', 'def', 'xyz'], sorted(ev.data for ev in q))
+
+    def test_octet(self):
+        conf = {'port': random.randint(1024, 65535), 'framing': 'octet', 'max_line': 5}
+        self.create(conf)
+
+        sock = self.connect(conf['port'])
+        sock.sendall('3 abc11 hello world3 a\nb')
+        q = self.waitForQueue(events=3)
+        self.assertEquals(['abc', 'hello', 'a\nb'], [ev.data for ev in q])
+
+    def test_backpressure(self):
+        conf = {'port': random.randint(1024, 65535)}
+        self.create(conf)
+        # a full output
+        self.output = self.i.output = Queue(1)
+
+        sock = self.connect(conf['port'])
+        lines = ['line %d' % n for n in xrange(10000)]
+        sock.sendall('\n'.join(lines) + '\n')
+        gevent.sleep(0.01)
+        self.assertEquals(1, self.output.qsize())
+
+        received = []
+        with gevent.Timeout(1.0):
+            while len(received) < len(lines):
+                received.append(self.output.get().data)
+        self.i.stop()
+        self.assertEquals(lines, received)
+
+    def test_stop(self):
+        conf = {'port': random.randint(1024, 65535)}
+        self.create(conf)
+        sock = self.connect(conf['port'])
+        sock.sendall('abc\nde')
+        gevent.sleep(0.01)
+        # the connection stays open, its incomplete last line is passed on
+        self.i.stop(time.time() + 1.0)
+        self.assertEquals(['abc', 'de'], [ev.data for ev in self.output.queue])
+        self.assertEquals('', sock.recv(1))
+
 class FileTests(InputTests):
     cls = fileinput.File
 
@@ -75,6 +197,7 @@ class FileTests(InputTests):
                 gevent.sleep(0.01)
                 print >>fin, 'def'
 
+            self.assertNotEqual(None, self.i.watcher)
             q = self.waitForQueue(events=2)
             assertEventEquals(self, Event(data='abc'), q[0])
             assertEventEquals(self, Event(data='def'), q[1])
@@ -145,6 +268,170 @@ class FileTests(InputTests):
             q = self.waitForQueue(events=1)
             assertEventEquals(self, Event(data='def'), q[0])
 
+    def test_partial_line(self):
+        with TempDirectory():
+            with file('test1.log', 'w') as fin:
+                fin.write('abc\nde')
+            conf = {'path': 'test*.log'}
+            self.create(conf)
+
+            q = self.waitForQueue(events=1)
+            assertEventEquals(self, Event(data='abc'), q[0])
+            # the offset is of the last complete line
+            st = os.stat('test1.log')
+            self.assertEquals('%d %d 4 %r test1.log\n' % (st.st_dev, st.st_ino, st.st_mtime),
+                file('.test*.log.registry').read())
+
+            with file('test1.log', 'a') as fin:
+                fin.write('f\nghi\n')
+
+            self.create(conf)
+            q = self.waitForQueue(events=2)
+            assertEventEquals(self, Event(data='def'), q[0])
+            assertEventEquals(self, Event(data='ghi'), q[1])
+
+    def test_blocks(self):
+        with TempDirectory():
+            lines = ['line %d' % n for n in xrange(100)]
+            with file('test1.log', 'w') as fin:
+                fin.write('\n'.join(lines) + '\n')
+            with patch.object(fileinput.Tail, 'BLOCK', 16):
+                self.create({'path': 'test*.log'})
+                q = self.waitForQueue(events=100)
+            self.assertEquals(lines, [ev.data for ev in q])
+
+    def test_rediscover(self):
+        with TempDirectory():
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+            self.create({'path': 'test*.log', 'inotify': False, 'rescan': 0.05})
+            with gevent.Timeout(1.0):
+                while self.output.qsize() < 1:
+                    gevent.sleep(0.01)
+
+            with file('test2.log', 'w') as fin:
+                print >>fin, 'def'
+            q = self.waitForQueue(events=2)
+            self.assertEquals(['abc', 'def'], [ev.data for ev in q])
+
+    def test_max_open(self):
+        with TempDirectory():
+            for n in xrange(3):
+                with file('test%d.log' % n, 'w') as fin:
+                    print >>fin, 'a%d' % n
+            i = self.create({'path': 'test*.log', 'max_open': 1})
+            with gevent.Timeout(1.0):
+                while self.output.qsize() < 3:
+                    gevent.sleep(0.01)
+            self.assertEquals(1, len([t for t in i.tails.values() if t.fin]))
+
+            # closed files are reopened where they were left
+            for n in xrange(3):
+                with file('test%d.log' % n, 'a') as fin:
+                    print >>fin, 'b%d' % n
+            q = self.waitForQueue(events=6)
+            self.assertEquals(['a0', 'a1', 'a2', 'b0', 'b1', 'b2'], sorted(ev.data for ev in q))
+
+    def test_max_open_limit(self):
+        # files are only opened with a slot free, not closed once over the limit
+        acquire = fileinput.OpenFiles.acquire
+        sizes = []
+        def record(files, tail):
+            acquire(files, tail)
+            sizes.append(len(files.open))
+        with TempDirectory():
+            for n in xrange(5):
+                with file('test%d.log' % n, 'w') as fin:
+                    print >>fin, 'a%d' % n
+            with patch.object(fileinput.OpenFiles, 'acquire', record):
+                self.create({'path': 'test*.log', 'max_open': 2})
+                q = self.waitForQueue(events=5)
+            self.assertEquals(['a0', 'a1', 'a2', 'a3', 'a4'], sorted(ev.data for ev in q))
+            self.assertEquals(2, max(sizes))
+
+    def test_open_failed(self):
+        opened = []
+        def fail_once(path, *args):
+            if path == 'test1.log' and not opened:
+                opened.append(path)
+                raise IOError(errno.EMFILE, 'Too many open files')
+            return open(path, *args)
+        with TempDirectory():
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+            with patch('logcabin.inputs.file.file', side_effect=fail_once, create=True):
+                self.create({'path': 'test*.log', 'rescan': 0.05, 'inotify': False})
+                q = self.waitForQueue()
+            # the failed tail is retried
+            self.assertEquals(['test1.log'], opened)
+            self.assertEquals('abc', q[0].data)
+
+    def test_reap(self):
+        with TempDirectory():
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+            i = self.create({'path': 'test*.log', 'rescan': 0.05})
+            with gevent.Timeout(1.0):
+                while self.output.qsize() < 1:
+                    gevent.sleep(0.01)
+            os.remove('test1.log')
+            with gevent.Timeout(1.0):
+                while i.tails:
+                    gevent.sleep(0.01)
+            self.waitForQueue(events=0)
+            # the offset of the file gone isn't kept
+            self.assertEquals('', file('.test*.log.registry').read())
+
+    def test_resume_rotated(self):
+        with TempDirectory():
+            with file('test.log', 'w') as fin:
+                print >>fin, 'abc'
+            conf = {'path': 'test.log*'}
+            self.create(conf)
+            q = self.waitForQueue(events=1)
+
+            # the offset follows the file renamed
+            os.rename('test.log', 'test.log.1')
+            with file('test.log.1', 'a') as fin:
+                print >>fin, 'def'
+            with file('test.log', 'w') as fin:
+                print >>fin, 'ghi'
+
+            self.create(conf)
+            q = self.waitForQueue(events=2)
+            self.assertEquals(['def', 'ghi'], sorted(ev.data for ev in q))
+
+    def test_checkpoint(self):
+        with TempDirectory():
+            os.mkdir('state')
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+            self.create({'path': 'test*.log', 'statedir': 'state', 'checkpoint': 0.01})
+            with gevent.Timeout(1.0):
+                while self.output.qsize() < 1:
+                    gevent.sleep(0.01)
+            gevent.sleep(0.05)
+
+            # saved before stopping
+            registry = fileinput.Registry('state/test*.log.registry')
+            st = os.stat('test1.log')
+            self.assertEquals(4, registry.claim((st.st_dev, st.st_ino), 'test1.log', st))
+            self.waitForQueue(events=0)
+
+    def test_resume_offset_file(self):
+        with TempDirectory():
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+                print >>fin, 'def'
+            # as saved by earlier versions
+            with file('test1.log.offset', 'w') as fout:
+                print >>fout, 4
+
+            self.create({'path': 'test*.log'})
+            q = self.waitForQueue(events=1)
+            assertEventEquals(self, Event(data='def'), q[0])
+            self.assertEquals(False, os.path.exists('test1.log.offset'))
+
     def test_truncated(self):
         with TempDirectory():
             conf = {'path': 'test*.log'}
@@ -166,3 +453,98 @@ class FileTests(InputTests):
             self.create(conf)
 
             self.waitForQueue(events=0)
+
+    def test_polling(self):
+        with TempDirectory():
+            conf = {'path': 'test*.log', 'inotify': False}
+            i = self.create(conf)
+
+            gevent.sleep(0.01)
+            with file('test1.log', 'w') as fin:
+                print >>fin, 'abc'
+            # the tail backs off while the file is unchanged
+            gevent.sleep(0.2)
+            self.assertEquals(None, i.watcher)
+            self.assert_(i.tails['test1.log'].interval > fileinput.Tail.POLL_MIN)
+            with file('test1.log', 'a') as fin:
+                print >>fin, 'def'
+
+            q = self.waitForQueue(events=2)
+            assertEventEquals(self, Event(data='abc'), q[0])
+            assertEventEquals(self, Event(data='def'), q[1])
+
+class RegistryTests(TestCase):
+    def test_save(self):
+        with TempDirectory():
+            file('test.log', 'w').close()
+            file('other.log', 'w').close()
+            st = os.stat('test.log')
+            with file('test.registry', 'w') as fout:
+                print >>fout, '%d %d 30 %r test.log' % (st.st_dev, st.st_ino, st.st_mtime)
+                print >>fout, '1 3 40 1.5 gone.log'
+                print >>fout, '1 5 60 1.5 other.log'
+                print >>fout, 'invalid'
+            registry = fileinput.Registry('test.registry')
+            self.assertEquals(None, registry.claim((1, 1), 'gone.log', Mock()))
+            self.assertEquals(40, registry.claim((1, 3), 'gone.log', Mock()))
+
+            tail = Mock(identity=(1, 4), offset=50, mtime=2.5, path='a b.log')
+            registry.save([tail])
+            # files loaded are kept until claimed, while still at their path -
+            # not when another file is there
+            self.assertEquals('1 4 50 2.5 a b.log\n%d %d 30 %r test.log\n'
+                % (st.st_dev, st.st_ino, st.st_mtime), file('test.registry').read())
+            self.assertEquals(False, os.path.exists('test.registry.tmp'))
+
+    def test_claim_reused_inode(self):
+        with TempDirectory():
+            with file('test.registry', 'w') as fout:
+                for n in xrange(5):
+                    print >>fout, '1 %d 40 1.5 test.log' % n
+            registry = fileinput.Registry('test.registry')
+            # renamed, or rotated and since written to
+            self.assertEquals(40, registry.claim((1, 0), 'old.log', Mock(st_size=40, st_mtime=1.5)))
+            self.assertEquals(40, registry.claim((1, 1), 'test.log.1', Mock(st_size=50, st_mtime=2.5)))
+            # elsewhere, and smaller or modified since: another file reused the inode
+            self.assertEquals(None, registry.claim((1, 2), 'new.log', Mock(st_size=30, st_mtime=1.5)))
+            self.assertEquals(None, registry.claim((1, 3), 'new.log', Mock(st_size=50, st_mtime=2.5)))
+
+class GeneratorTests(InputTests):
+    cls = generator.Generator
+
+    def test_template(self):
+        self.create({'template': {'n': lambda n: n, 'host': 'web{r}', 'message': 'request {n}',
+            'level': 'info'}, 'cardinality': 3, 'count': 30})
+        q = self.waitForQueue(events=30)
+        self.assertEquals(range(30), [ev.n for ev in q])
+        self.assertEquals('request 5', q[5].message)
+        self.assertEquals('info', q[5].level)
+        self.assert_(set(ev.host for ev in q) <= set(['web0', 'web1', 'web2']))
+
+    def test_sample(self):
+        with TempDirectory():
+            with file('sample.log', 'w') as fout:
+                print >>fout, 'abc'
+                print >>fout, 'def'
+            self.create({'sample': 'sample.log', 'count': 3})
+            q = self.waitForQueue(events=3)
+            self.assertEquals(['abc', 'def', 'abc'], [ev.data for ev in q])
+
+    def test_rate(self):
+        start = time.time()
+        self.create({'template': {}, 'rate': 200, 'count': 20})
+        self.waitForQueue(events=20)
+        self.assert_(0.08 < time.time() - start < 0.5)
+
+    def test_ramp(self):
+        with DummyContext():
+            i = self.cls(template={}, rate=100, ramp=10)
+        self.assertEquals(125, i._due(5))
+        self.assertEquals(1500, i._due(20))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.cls)
+        self.assertRaises(ValueError, self.cls, template={}, rate=None, ramp=10)
+        # fields other than {n} and {r} fail on creation, not in the greenlet
+        self.assertRaises(ConfigException, self.cls, template={'message': 'a {b}'})
+        self.assertRaises(ConfigException, self.cls, template={'message': 'a { b'})
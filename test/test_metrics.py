@@ -0,0 +1,100 @@
+from unittest import TestCase
+import gevent
+import gevent.socket as socket
+import random
+
+from logcabin.event import Event
+from logcabin.pipeline import Pipeline
+from logcabin.flow import Switch
+from logcabin.filters import json, mutate
+from logcabin.inputs import udp
+from logcabin.outputs import log
+from logcabin.metrics import Histogram, MetricsServer, render
+
+class HistogramTests(TestCase):
+    def test_observe(self):
+        h = Histogram((1, 2))
+        h.observe(0.5)
+        h.observe(1.5, 2)
+        h.observe(3)
+        self.assertEquals([(1, 1), (2, 3), (float('inf'), 4)], list(h.cumulative()))
+        self.assertEquals(6.5, h.sum)
+        self.assertEquals(4, h.count)
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline()
+        with self.pipeline:
+            json.Json(on_error='tag')
+            with Switch() as case:
+                with case('a == 1'):
+                    mutate.Mutate(set={'b': 1})
+                with case.default:
+                    log.Log()
+                    log.Log()
+        self.input = self.pipeline.setup(None)
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.pipeline.stop()
+
+    def wait(self, stage, events):
+        with gevent.Timeout(1.0):
+            while stage.stage_metrics.events_in < events:
+                gevent.sleep(0.0)
+
+    def test_paths(self):
+        self.assertEquals([
+            'Pipeline',
+            'Pipeline/Json',
+            'Pipeline/Switch',
+            'Pipeline/Switch/case[0]',
+            'Pipeline/Switch/case[0]/Mutate',
+            'Pipeline/Switch/case[1]',
+            'Pipeline/Switch/case[1]/Log[0]',
+            'Pipeline/Switch/case[1]/Log[1]',
+        ], [path for path, s in self.pipeline.walk()])
+
+    def test_render(self):
+        self.input.put(Event(data='{"a": 1}'))
+        self.input.put(Event(data='invalid'))
+        self.wait(self.pipeline.stages[1].cases[1][1].stages[1], 1)
+
+        text = render(self.pipeline)
+        self.assert_('logcabin_stage_events_in_total{stage="Pipeline/Json"} 2\n' in text)
+        self.assert_('logcabin_stage_events_out_total{stage="Pipeline/Json"} 2\n' in text)
+        self.assert_('logcabin_stage_errors_total{stage="Pipeline/Json"} 1\n' in text)
+        self.assert_('logcabin_stage_events_in_total{stage="Pipeline/Switch/case[0]/Mutate"} 1\n' in text)
+        self.assert_('logcabin_stage_events_in_total{stage="Pipeline/Switch/case[1]/Log[1]"} 1\n' in text)
+        self.assert_('logcabin_stage_queue_depth{stage="Pipeline/Json"} 0\n' in text)
+        self.assert_('logcabin_switch_hits_total{stage="Pipeline/Switch",case="case[1]"} 1\n' in text)
+        self.assert_('logcabin_stage_processing_seconds_bucket{stage="Pipeline/Json",le="+Inf"} 2\n' in text)
+        self.assert_('logcabin_stage_processing_seconds_count{stage="Pipeline/Json"} 2\n' in text)
+
+    def test_server(self):
+        port = random.randint(1024, 65535)
+        server = MetricsServer(self.pipeline, port)
+        server.start()
+        try:
+            sock = socket.create_connection(('localhost', port))
+            sock.sendall('GET /metrics HTTP/1.0\r\n\r\n')
+            text = sock.makefile().read()
+            self.assert_(text.startswith('HTTP/1.1 200 OK'))
+            self.assert_('logcabin_stage_events_in_total{stage="Pipeline/Json"} 0\n' in text)
+        finally:
+            server.stop()
+
+class SocketMetricsTests(TestCase):
+    def test_udp(self):
+        pipeline = Pipeline()
+        with pipeline:
+            udp.Udp(port=random.randint(1024, 65535))
+            log.Log()
+        pipeline.setup(None)
+        pipeline.start()
+        try:
+            text = render(pipeline)
+        finally:
+            pipeline.stop()
+        self.assert_('logcabin_udp_receive_queue_bytes{stage="Pipeline/Udp"} 0\n' in text)
+        self.assert_('logcabin_udp_drops_total{stage="Pipeline/Udp"} 0\n' in text)
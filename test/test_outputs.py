@@ -300,3 +300,38 @@ class ZeromqTests(OutputTests):
 
         data = sock.recv()
         self.assertEquals(ev.to_json(), data)
+
+class SpoolTests(OutputTests):
+    cls = log.Log
+
+    def test_spool(self):
+        with TempDirectory():
+            self.create({'spool': 'spool', 'spool_memory': 1})
+            self.i.stop()
+
+            # spooled events survive the output stopping
+            for n in xrange(3):
+                self.input.put(Event(n=n))
+            self.input.close()
+
+            self.create({'spool': 'spool', 'spool_memory': 1})
+            self.assertEquals(3, self.input.qsize() + self.input.spilled)
+            self.waitForEmpty()
+            self.assertEquals(0, self.input.spilled)
+            self.i.stop()
+
+    def test_spool_processing(self):
+        # the event being processed when stopped is spooled too
+        with TempDirectory():
+            self.create({'spool': 'spool', 'spool_memory': 1})
+            with mock.patch.object(self.i, 'process', side_effect=lambda ev: gevent.sleep(10)):
+                for n in xrange(3):
+                    self.input.put(Event(n=n))
+                gevent.sleep(0.01)
+                self.i.stop(time.time() + 0.2)
+
+            self.create({'spool': 'spool', 'spool_memory': 1})
+            self.assertEquals(3, self.input.qsize() + self.input.spilled)
+            self.waitForEmpty()
+            self.i.stop()
+            self.assertEquals([0, 1, 2], [ev.n for ev in self.output.queue])
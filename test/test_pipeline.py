@@ -0,0 +1,204 @@
+from unittest import TestCase
+import gevent
+import gevent.socket as socket
+import random
+import mock
+import os
+
+from logcabin.event import Event
+from logcabin.pipeline import Pipeline
+from logcabin.inputs import udp
+from logcabin.filters import stats
+from logcabin.outputs.output import Output
+
+from testhelper import TempDirectory
+
+class Collect(Output):
+    def __init__(self, **kwargs):
+        super(Collect, self).__init__(**kwargs)
+        self.events = []
+
+    def process(self, event):
+        gevent.sleep(0.001)
+        self.events.append(event)
+
+class Broken(Output):
+    def start(self):
+        raise socket.error('Address already in use')
+
+class ReloadTests(TestCase):
+    def create(self, **conf):
+        pipeline = Pipeline()
+        with pipeline:
+            udp.Udp(port=self.port)
+            stats.Stats(period=60, metrics={'total': 'n'})
+            Collect(**conf)
+        return pipeline
+
+    def reload(self, old, **conf):
+        new = self.create(**conf)
+        new.takeover(old)
+        new.setup(None)
+        old.stop_inputs()
+        new.start()
+        return new
+
+    def send(self, *values):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for n in values:
+            sock.sendto(str(n), ('127.0.0.1', self.port))
+
+    def wait(self, output, events):
+        with gevent.Timeout(1.0):
+            while len(output.events) < events:
+                gevent.sleep(0.01)
+
+    def setUp(self):
+        self.port = random.randint(1024, 65535)
+
+    def test_reload(self):
+        old = self.create()
+        old.setup(None)
+        old.start()
+        self.send(1, 2)
+        self.wait(old.stages[2], 2)
+        # sent before the reload, but not yet received
+        self.send(3, 4)
+
+        new = self.reload(old)
+        # the socket is handed over, so isn't closed by the old pipeline
+        self.assert_(old.stages[0].sock is None)
+        self.send(5)
+        old.stop()
+        self.wait(new.stages[2], 3)
+        new.stop()
+        # ... but is once the new pipeline stops, freeing the port
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM).bind(('', self.port))
+
+        events = old.stages[2].events + new.stages[2].events
+        self.assertEquals(['1', '2', '3', '4', '5'], sorted(ev.data for ev in events))
+        # the stats carry on from the old pipeline
+        self.assert_(new.stages[1].timers is old.stages[1].timers)
+
+    def test_spool(self):
+        with TempDirectory():
+            old = self.create(spool='spool')
+            old.setup(None)
+            old.start()
+            self.send(*range(10))
+            new = self.reload(old, spool='spool')
+            old.stop()
+            self.assert_(new.stages[2].input is old.stages[2].input)
+
+            self.wait(new.stages[2], 10 - len(old.stages[2].events))
+            new.stop()
+            events = old.stages[2].events + new.stages[2].events
+            self.assertEquals(sorted(str(n) for n in xrange(10)), sorted(ev.data for ev in events))
+
+    def test_spool_reload_start_failed(self):
+        with TempDirectory():
+            old = self.create(spool='spool')
+            old.setup(None)
+            old.start()
+            new = self.create(spool='spool')
+            with new:
+                Broken()
+            new.takeover(old)
+            new.setup(None)
+            old.stop_inputs()
+            # fails after the new output sharing the spool has started
+            self.assertRaises(socket.error, new.start)
+            new.handback(old)
+            old.start_inputs()
+
+            # the old output carries on with the spool, still open
+            output = old.stages[2]
+            self.assertFalse(output.handed_over)
+            self.assertFalse(old.stages[1].periodic.dead)
+            self.send(1, 2)
+            self.wait(output, 2)
+            old.stop()
+            self.assertEquals(['1', '2'], sorted(ev.data for ev in output.events))
+            self.assertEquals([], new.stages[2].events)
+
+    def test_reload_failed(self):
+        from logcabin.__main__ import LogCabin
+        app = LogCabin()
+        app.opts = mock.Mock(config=os.path.join(os.path.dirname(__file__), 'config/bad.py'))
+        app.logger = mock.Mock()
+        app.pipeline = pipeline = self.create()
+        app.reloading = True
+        app.reload()
+        # the running pipeline is kept
+        self.assert_(app.pipeline is pipeline)
+        self.assertEquals(1, app.logger.error.call_count)
+        self.assertFalse(app.reloading)
+
+    def test_reload_start_failed(self):
+        from logcabin.__main__ import LogCabin
+        busy = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        busy.bind(('', 0))
+        with TempDirectory():
+            with file('config.py', 'w') as fout:
+                print >>fout, 'from inputs.udp import Udp'
+                print >>fout, 'from filters.stats import Stats'
+                print >>fout, 'Udp(port=%d)' % busy.getsockname()[1]
+                print >>fout, "Stats(period=60, metrics={'total': 'n'})"
+            app = LogCabin()
+            app.opts = mock.Mock(config='config.py')
+            app.logger = mock.Mock()
+            app.pipeline = old = self.create()
+            old.setup(None)
+            old.start()
+            app.reloading = True
+            # the new Udp input can't bind
+            app.reload()
+        busy.close()
+
+        # the old pipeline carries on, with its inputs restarted
+        self.assert_(app.pipeline is old)
+        self.assertEquals(1, app.logger.exception.call_count)
+        self.assertFalse(old.stages[1].periodic.dead)
+        self.send(1)
+        self.wait(old.stages[2], 1)
+        old.stop()
+
+    def test_reload_start_failed_handback(self):
+        from logcabin.__main__ import LogCabin
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        busy.bind(('', 0))
+        busy.listen(1)
+        with TempDirectory():
+            with file('config.py', 'w') as fout:
+                print >>fout, 'from inputs.tcp import Tcp'
+                print >>fout, 'from inputs.udp import Udp'
+                print >>fout, 'Tcp(port=%d)' % busy.getsockname()[1]
+                print >>fout, 'Udp(port=%d)' % self.port
+            app = LogCabin()
+            app.opts = mock.Mock(config='config.py')
+            app.logger = mock.Mock()
+            app.pipeline = old = self.create()
+            old.setup(None)
+            old.start()
+            sock = old.stages[0].sock
+            app.reload()
+        busy.close()
+
+        # the new Udp input took over the socket, but never started, so
+        # gives it back
+        self.assert_(app.pipeline is old)
+        self.assert_(old.stages[0].sock is sock)
+        self.send(1)
+        self.wait(old.stages[2], 1)
+        old.stop()
+
+class PathTests(TestCase):
+    def test_stage_path(self):
+        from logcabin.inputs import file as fileinput
+        pipeline = Pipeline()
+        with pipeline:
+            fileinput.File(path='test*.log')
+        pipeline.setup(None)
+        # the stage's own configuration is left alone
+        self.assertEquals('test*.log', pipeline.stages[0].path)
+        self.assertEquals('Pipeline/File', pipeline.stages[0].stage_path)
@@ -0,0 +1,63 @@
+from unittest import TestCase
+import gevent
+import os
+import shutil
+import tempfile
+import time
+
+from logcabin.event import Event
+from logcabin.pipeline import Pipeline
+from logcabin.filters import mutate, python
+from logcabin.profiler import Profiler
+
+def burn(event):
+    end = time.clock() + 0.05
+    while time.clock() < end:
+        pass
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline()
+        with self.pipeline:
+            mutate.Mutate(set={'a': 1}, fuse=False)
+            python.Python(function=burn)
+        self.input = self.pipeline.setup(None)
+        self.pipeline.start()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.pipeline.stop()
+        shutil.rmtree(self.tempdir)
+
+    def profile(self, events):
+        profiler = Profiler(self.pipeline, interval=0.001)
+        profiler.start()
+        try:
+            for n in xrange(events):
+                self.input.put(Event(n=n))
+            with gevent.Timeout(5.0):
+                self.input.join()
+                while self.pipeline.stages[-1].stage_metrics.events_in < events:
+                    gevent.sleep(0.01)
+        finally:
+            profiler.stop()
+        return profiler
+
+    def test_attribution(self):
+        profiler = self.profile(4)
+        counts = {}
+        for (path, stack), count in profiler.samples.iteritems():
+            counts[path] = counts.get(path, 0) + count
+        # most of the time is spent burning cpu in the python stage
+        self.assert_(counts.get('Pipeline/Python', 0) > sum(counts.values()) / 2)
+
+    def test_write(self):
+        profiler = self.profile(2)
+        collapsed, report = profiler.write(self.tempdir)
+
+        lines = file(collapsed).read().splitlines()
+        self.assert_(any(l.startswith('Pipeline/Python;') and 'burn (test_profiler.py' in l
+            for l in lines))
+        self.assert_(all(l.rsplit(' ', 1)[1].isdigit() for l in lines))
+        self.assert_(file(report).read().startswith('Pipeline/Python:'))
+        self.assertEquals(os.path.dirname(collapsed), self.tempdir)
@@ -0,0 +1,111 @@
+from unittest import TestCase
+import os
+import gevent
+
+from logcabin.event import Event
+from logcabin.spool import SpoolQueue
+from logcabin.util import Batch
+
+from testhelper import TempDirectory
+
+class SpoolQueueTests(TestCase):
+    def drain(self, q):
+        events = []
+        while q.qsize():
+            events.append(q.get().n)
+            q.task_done()
+        return events
+
+    def test_memory(self):
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=10)
+            for n in xrange(5):
+                q.put(Event(n=n))
+            self.assertEquals(0, q.spilled)
+            self.assertEquals(range(5), self.drain(q))
+
+    def test_memory_events(self):
+        # the memory holds events, whether or not in batches
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=4)
+            for n in xrange(3):
+                q.put(Batch([Event(n=n), Event(n=n)]))
+            self.assertEquals((2, 1), (q.qsize(), q.spilled))
+
+    def test_spill(self):
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=4, segment_size=100)
+            for n in xrange(20):
+                q.put(Event(n=n))
+            self.assertEquals(4, q.qsize())
+            self.assertEquals(16, q.spilled)
+            self.assert_(len(os.listdir('spool')) > 1)
+
+            self.assertEquals(range(20), self.drain(q))
+            self.assertEquals(0, q.spilled)
+            self.assertEquals(['position'], os.listdir('spool'))
+
+    def test_close(self):
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=4, segment_size=100)
+            for n in xrange(10):
+                q.put(Event(n=n))
+            q.put(Batch([Event(n=10), Event(n=11)]))
+            self.assertEquals(0, q.get().n)
+            q.task_done()
+            q.close()
+
+            q = SpoolQueue('spool', memory=4, segment_size=100)
+            events = []
+            while q.qsize():
+                item = q.get()
+                events.extend(ev.n for ev in (item if isinstance(item, Batch) else [item]))
+            self.assertEquals(range(1, 12), events)
+
+    def test_close_partial(self):
+        # the read position within a segment is kept over restarts
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=2)
+            for n in xrange(10):
+                q.put(Event(n=n))
+            self.assertEquals([0, 1, 2], [q.get().n for i in xrange(3)])
+            q.close()
+
+            q = SpoolQueue('spool', memory=2)
+            self.assertEquals(range(3, 10), self.drain(q))
+
+    def test_checkpoint(self):
+        # the read position is saved while reading, so kept without a close
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=2, checkpoint=0)
+            for n in xrange(10):
+                q.put(Event(n=n))
+            # 2 is read back from disk to refill the memory
+            self.assertEquals([0, 1], [q.get().n for i in xrange(2)])
+
+            q = SpoolQueue('spool', memory=2)
+            self.assertEquals(7, q.spilled)
+            self.assertEquals(range(3, 10), self.drain(q))
+
+    def test_read_buffered(self):
+        # items still buffered by the writer are read
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=1)
+            for n in xrange(3):
+                q.put(Event(n=n))
+            self.assertEquals([0, 1], [q.get().n for i in xrange(2)])
+            q.put(Event(n=3))
+            with gevent.Timeout(1):
+                self.assertEquals([2, 3], [q.get().n for i in xrange(2)])
+            self.assertEquals(0, q.spilled)
+
+    def test_no_memory(self):
+        with TempDirectory():
+            q = SpoolQueue('spool', memory=0)
+            getter = gevent.spawn(q.get)
+            gevent.sleep()
+            q.put(Event(n=0))
+            q.put(Event(n=1))
+            with gevent.Timeout(1):
+                self.assertEquals(0, getter.get().n)
+                self.assertEquals(1, q.get().n)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+from datetime import datetime
+from mock import patch
+
+from logcabin.event import Event
+from logcabin.template import Template
+
+class TemplateTests(TestCase):
+    def test_fields(self):
+        t = Template('{a}/{b!r}/{c:>3}/{0}')
+        self.assertEquals("1/'x'/  2/arg", t.format(Event(a=1, b='x', c=2), ['arg']))
+        self.assertEquals("/''/   /arg", t.format(Event(), ['arg']))
+
+    def test_raise_missing(self):
+        t = Template('{a}.{b}', raise_missing=True)
+        self.assertEquals('1.2', t.format(Event(a=1, b=2)))
+        self.assertRaises(KeyError, t.format, Event(a=1))
+
+    def test_fallback(self):
+        # as formatted by string.Formatter
+        t = Template('{a[0]}-{b.year}-{c:{d}}')
+        self.assertEquals(None, t.parts)
+        ev = Event(a=[1], b=datetime(2013, 1, 1), c=2, d='>3')
+        self.assertEquals('1-2013-  2', t.format(ev))
+
+    def test_strftime_cached(self):
+        t = Template('logstash-{timestamp:%Y.%m.%d}')
+        with patch('logcabin.template.format', create=True) as m:
+            m.side_effect = format
+            for hour in (1, 2, 3):
+                t.format(Event(timestamp=datetime(2013, 1, 1, hour)))
+            self.assertEquals(1, m.call_count)
+        self.assertEquals('logstash-2013.01.02', t.format(Event(timestamp=datetime(2013, 1, 2))))
+
+    def test_strftime_uncached(self):
+        t = Template('{timestamp:%H:%M:%S.%f} {n:.0%}')
+        ev = Event(timestamp=datetime(2013, 1, 1, 1, 2, 3, 4), n=0.5)
+        self.assertEquals('01:02:03.000004 50%', t.format(ev))
+        ev = Event(timestamp=datetime(2013, 1, 1, 1, 2, 3, 5), n=0.25)
+        self.assertEquals('01:02:03.000005 25%', t.format(ev))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+import gevent
+import pickle
+
+from logcabin.event import Event
+from logcabin.util import Batch, StageQueue
+from logcabin.pipeline import Pipeline
+from logcabin.filters import mutate
+from logcabin.outputs.output import Output
+from logcabin import trace
+
+class TraceTests(TestCase):
+    def setUp(self):
+        trace.enable()
+        self.latency = trace.Latency()
+        trace.collectors.append(self.latency)
+
+        self.pipeline = Pipeline()
+        with self.pipeline:
+            mutate.Mutate(set={'a': 1})
+            mutate.Mutate(set={'b': 1}, fuse=False)
+            self.out = Output()
+        self.input = self.pipeline.setup(None)
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.pipeline.stop()
+        trace.collectors.remove(self.latency)
+        trace.enabled = False
+
+    def wait(self, events):
+        with gevent.Timeout(1.0):
+            while self.out.stage_metrics.events_in < events:
+                gevent.sleep(0.0)
+
+    def test_spans(self):
+        ev = trace.stamp(Event(n=1))
+        self.input.put(ev)
+        self.wait(1)
+
+        t = trace.get(ev)
+        self.assertEquals(['Pipeline/Mutate[0]', 'Pipeline/Mutate[1]', 'Pipeline/Output'],
+            [span[0] for span in t.spans])
+        last = t.ingest
+        for path, enqueued, dequeued, done in t.spans:
+            # stamped when put onto the stage's queue
+            self.assert_(last <= enqueued <= dequeued <= done)
+            last = done
+        # kept aside from the event fields
+        self.assert_('_trace' not in ev)
+
+    def test_enqueued(self):
+        # events taken off a queue together were each queued from when put
+        q = StageQueue()
+        events = [trace.stamp(Event(n=n)) for n in xrange(2)]
+        q.put(Batch(events[:1]))
+        gevent.sleep(0.01)
+        q.put(events[1])
+        trace.record(events, 'Pipeline/Json', trace.now(), trace.now())
+        first, second = [trace.get(ev).spans[0] for ev in events]
+        self.assert_(second[1] - first[1] >= 0.01)
+        self.assert_(first[2] - first[1] >= 0.01)
+
+    def test_collect(self):
+        for n in xrange(3):
+            self.input.put(trace.stamp(Event(n=n)))
+        self.input.put(Event(n=4))
+        self.wait(4)
+
+        self.assertEquals(3, len(self.latency.total))
+        self.assertEquals(3, len(self.latency.processing['Pipeline/Output']))
+        names = [name for name, values in self.latency.summary()]
+        self.assertEquals('end-to-end', names[0])
+        self.assert_('Pipeline/Mutate[1] queued' in names)
+        self.assertEquals([], self.latency.total)
+
+    def test_pickle(self):
+        # traces are carried with events to worker processes
+        ev = trace.stamp(Event(n=1))
+        trace.record([ev], 'Pipeline/Json', 1.0, 2.0)
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(ev, protocol))
+            self.assertEquals('Pipeline/Json', trace.get(copy).spans[0][0])
+            # kept aside from the fields
+            self.assertEquals(['n', 'timestamp'], sorted(copy))
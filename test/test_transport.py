@@ -0,0 +1,43 @@
+from unittest import TestCase
+from datetime import datetime
+import dateutil.tz
+
+from logcabin.event import Event
+from logcabin import transport
+
+class TransportTests(TestCase):
+    def roundtrip(self, events, **kwargs):
+        encoder = transport.Encoder(**kwargs)
+        decoded = []
+        for message in encoder.messages(events):
+            decoded.extend(transport.decode(message))
+        return decoded
+
+    def test_roundtrip(self):
+        ev = Event(s='x', u=u'\xe9', n=1, f=2.5, l=[1, 'a'], d={'a': None},
+            timestamp=datetime(2013, 1, 2, 3, 4, 5, 678901))
+        for compress in (None, 'zlib', 'lz4'):
+            decoded = self.roundtrip([ev], compress=compress)
+            self.assertEquals([ev], decoded)
+            self.assertEquals(Event, type(decoded[0]))
+            self.assertEquals(str, type(decoded[0].s))
+            self.assertEquals(unicode, type(decoded[0].u))
+
+    def test_utc(self):
+        tz = dateutil.tz.tzoffset(None, 3600)
+        decoded = self.roundtrip([Event(timestamp=datetime(2013, 1, 1, 12, tzinfo=tz))])
+        self.assertEquals(datetime(2013, 1, 1, 11), decoded[0].timestamp)
+
+    def test_max_bytes(self):
+        events = [Event(n=n, data='x' * 100) for n in xrange(10)]
+        messages = list(transport.Encoder(max_bytes=500).messages(events))
+        self.assert_(len(messages) > 1)
+        # the header, array header, then the events
+        self.assert_(all(len(m) <= 2 + 1 + 500 for m in messages))
+        self.assertEquals(range(10), [ev.n for m in messages for ev in transport.decode(m)])
+
+    def test_invalid(self):
+        self.assertEquals(None, transport.decode('{"a": 1}'))
+        self.assertRaises(ValueError, transport.decode, '\xc1zgarbage')
+        self.assertRaises(ValueError, transport.decode, '\xc1?')
+        self.assertRaises(ValueError, transport.Encoder, compress='bz2')
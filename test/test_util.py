@@ -0,0 +1,136 @@
+from unittest import TestCase
+import json
+from gevent.queue import Full, Queue
+
+from logcabin.event import Event
+from logcabin.util import Batch, BroadcastQueue, StageQueue
+
+class StageQueueTests(TestCase):
+    def test_block(self):
+        q = StageQueue(2)
+        q.put(Event(n=1))
+        q.put(Event(n=2))
+        self.assertRaises(Full, q.put, Event(n=3), timeout=0.01)
+        self.assertEquals(0, q.dropped)
+
+    def test_drop_newest(self):
+        q = StageQueue(2, 'drop_newest')
+        for n in xrange(4):
+            q.put(Event(n=n))
+        self.assertEquals([0, 1], [q.get().n for i in xrange(q.qsize())])
+        self.assertEquals(2, q.dropped)
+
+    def test_drop_oldest(self):
+        q = StageQueue(2, 'drop_oldest')
+        for n in xrange(3):
+            q.put(Event(n=n))
+        q.put(Batch([Event(n=3), Event(n=4)]))
+        self.assertEquals([3, 4], [ev.n for ev in q.get()])
+        self.assertEquals(3, q.dropped)
+        # dropped events are not waited on by join
+        self.assertEquals(1, q.unfinished_tasks)
+
+    def test_drop_oldest_partial(self):
+        # part of a batch is dropped to make space
+        q = StageQueue(4, 'drop_oldest')
+        q.put(Batch([Event(n=0), Event(n=1)]))
+        q.put(Event(n=2))
+        q.put(Batch([Event(n=3), Event(n=4)]))
+        self.assertEquals(1, q.dropped)
+        self.assertEquals(3, q.unfinished_tasks)
+        self.assertEquals([1], [ev.n for ev in q.get()])
+        self.assertEquals(2, q.get().n)
+
+    def test_events(self):
+        # the limit is on events, not batches of them
+        q = StageQueue(2, 'drop_newest')
+        q.put(Batch([Event(n=0)]))
+        q.put(Batch([Event(n=1), Event(n=2)]))
+        q.put(Batch([Event(n=3)]))
+        self.assertEquals(2, q.events)
+        self.assertEquals([[0], [1]], [[ev.n for ev in q.get()] for i in xrange(q.qsize())])
+        self.assertEquals(2, q.dropped)
+
+    def test_block_events(self):
+        q = StageQueue(2)
+        q.put(Batch([Event(n=0), Event(n=1)]))
+        self.assertRaises(Full, q.put, Event(n=2), timeout=0.01)
+        q.get()
+        q.put(Event(n=2), timeout=0.01)
+
+    def test_drop_tagged(self):
+        q = StageQueue(1, 'drop_tagged', ['debug'])
+        q.put(Event(n=0))
+        q.put(Event(n=1, tags=['debug']))
+        self.assertRaises(Full, q.put, Event(n=2), timeout=0.01)
+        self.assertEquals(1, q.dropped)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, StageQueue, 1, 'drop_everything')
+
+class BroadcastQueueTests(TestCase):
+    def test_full_branch(self):
+        # a branch dropping events doesn't stop delivery to the others
+        slow = StageQueue(1, 'drop_newest')
+        fast = Queue()
+        q = BroadcastQueue([slow, fast])
+        for n in xrange(3):
+            q.put(Event(n=n))
+        self.assertEquals(1, slow.qsize())
+        self.assertEquals(2, slow.dropped)
+        self.assertEquals(3, fast.qsize())
+
+    def test_forks(self):
+        a, b = Queue(), Queue()
+        q = BroadcastQueue([a, b])
+        q.put(Event(n=1, tags=['x']))
+        q.put_batch([Event(n=2)])
+        first, second = b.get(), b.get()
+        first.n = 3
+        first.add_tag('y')
+        unchanged = a.get()
+        self.assertEquals((1, ['x']), (unchanged.n, unchanged.tags))
+        self.assertEquals(2, a.get().n)
+        self.assertEquals(2, second.n)
+
+    def test_forks_iterated(self):
+        # containers handed out by iterating an event aren't shared either
+        a, b = Queue(), Queue()
+        q = BroadcastQueue([a, b])
+        q.put(Event(n=1, tags=['x'], fields={'f': 1}))
+        changed = b.get()
+        for k, v in changed.iteritems():
+            if isinstance(v, list):
+                v.append('y')
+        for v in changed.values():
+            if isinstance(v, dict):
+                v['f'] = 2
+        changed.copy()['tags'].append('z')
+        unchanged = a.get()
+        self.assertEquals((['x'], {'f': 1}), (unchanged.tags, unchanged.fields))
+        self.assertEquals((['x', 'y', 'z'], {'f': 2}), (changed.tags, changed.fields))
+
+    def test_forks_serialized_once(self):
+        # reading a branch's tags keeps the serialization shared, until
+        # they're modified in place
+        a, b = Queue(), Queue()
+        q = BroadcastQueue([a, b])
+        q.put(Event(n=1, tags=['x']))
+        first, second = a.get(), b.get()
+        self.assert_('x' in second.tags)
+        self.assert_(second._json is not None)
+        self.assert_(first.to_json() is second.to_json())
+
+        second.tags.append('y')
+        self.assertEquals(['x', 'y'], json.loads(second.to_json())['tags'])
+        self.assertEquals(['x'], json.loads(first.to_json())['tags'])
+
+    def test_forks_serialized_shared(self):
+        # serializing doesn't copy the containers shared
+        a, b = Queue(), Queue()
+        q = BroadcastQueue([a, b])
+        q.put(Event(n=1, tags=['x']))
+        first, second = a.get(), b.get()
+        first.to_json()
+        self.assertEquals(set(['tags']), first._shared)
+        self.assert_(dict.__getitem__(first, 'tags') is dict.__getitem__(second, 'tags'))